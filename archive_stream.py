@@ -0,0 +1,390 @@
+# archive_stream.py
+"""
+On-the-fly tar/zip archives of remote directories.
+
+The directory is walked over SFTP and the archive is produced as a stream
+of chunks while it is read, so nothing is staged on the gateway and memory
+stays bounded. Small files are fetched ahead by a few workers so that a
+tree of many small files doesn't cost several round trips per file; large
+files are streamed through pipelined window reads.
+
+There is also a fast path that runs tar on the remote host over an exec
+channel and forwards its stdout.
+"""
+
+import shlex
+import stat
+import tarfile
+import threading
+import time
+import zipfile
+import zlib
+from collections import deque
+
+import ssh_executor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = (None, 'gzip', 'zstd')
+FORMATS = ('tar', 'zip')
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+
+
+def archive_filename(remote_dir, fmt='tar', compression=None):
+    name = remote_dir.rstrip('/').split('/')[-1] or 'root'
+    if fmt == 'zip':
+        return name + '.zip'
+    return name + {None: '.tar', 'gzip': '.tar.gz', 'zstd': '.tar.zst'}[compression]
+
+
+def check_options(fmt, compression, mode='sftp'):
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown archive format: {fmt}")
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression: {compression}")
+    if fmt == 'zip' and compression == 'zstd':
+        raise ValueError("zstd is only supported for tar archives")
+    # Remote archives are compressed by the remote zstd binary
+    if compression == 'zstd' and mode == 'sftp' and zstandard is None:
+        raise ValueError("zstd compression requires the zstandard package")
+
+
+def walk(ssh_client, remote_dir):
+    """
+    Depth-first walk of a remote directory. Yields (relative path, attr)
+    for every entry; directories are yielded before their contents.
+    """
+    remote_dir = remote_dir.rstrip('/') or '/'
+    pending = [('', remote_dir)]
+    while pending:
+        rel_dir, abs_dir = pending.pop()
+        try:
+            with ssh_client.sftp_pool.acquire() as sftp:
+                entries = sftp.listdir_attr(abs_dir)
+        except IOError as e:
+            # Unreadable directories are left empty in the archive
+            print(f"Skipping {abs_dir} in archive: {str(e)}")
+            continue
+        entries.sort(key=lambda a: a.filename)
+        subdirs = []
+        for attr in entries:
+            rel = rel_dir + attr.filename
+            yield rel, attr
+            if stat.S_ISDIR(attr.st_mode or 0):
+                subdirs.append((rel + '/', abs_dir.rstrip('/') + '/' + attr.filename))
+        pending.extend(reversed(subdirs))
+
+
+class WorkerChannels:
+    """
+    One dedicated SFTP channel per read-ahead worker thread, so small file
+    reads run side by side instead of queueing on the session's pool.
+    """
+
+    def __init__(self, ssh_client):
+        self.ssh_client = ssh_client
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.opened = []
+
+    def get(self):
+        sftp = getattr(self.local, 'sftp', None)
+        if sftp is None:
+            sftp = self.ssh_client.sftp_pool.open_dedicated()
+            self.local.sftp = sftp
+            with self.lock:
+                self.opened.append(sftp)
+        return sftp
+
+    def close(self):
+        with self.lock:
+            for sftp in self.opened:
+                try:
+                    sftp.close()
+                except Exception:
+                    pass
+            self.opened = []
+
+
+def _read_small_file(channels, path, size):
+    with channels.get().open(path, 'rb') as f:
+        if size <= 0:
+            return b''
+        return b''.join(f.readv([(0, size)]))
+
+
+def _read_link(channels, path):
+    return channels.get().readlink(path)
+
+
+def _fit(blocks, size):
+    """Yield exactly `size` bytes from blocks, truncating or zero-padding."""
+    remaining = size
+    for data in blocks:
+        if remaining <= 0:
+            break
+        data = data[:remaining]
+        remaining -= len(data)
+        yield data
+    while remaining > 0:
+        pad = min(remaining, 65536)
+        remaining -= pad
+        yield b'\0' * pad
+
+
+def iter_entries(ssh_client, remote_dir, workers=8, small_file_limit=1024 * 1024,
+                 lookahead_bytes=16 * 1024 * 1024, chunk_size=32768, window=8 * 1024 * 1024):
+    """
+    Walk remote_dir and yield (relative path, attr, content) in order, where
+    content is None for non-regular files or an iterator of data chunks.
+    Small files are read ahead by up to `workers` jobs on the host's
+    executor, bounded by lookahead_bytes.
+    """
+    remote_dir = remote_dir.rstrip('/') or '/'
+    base = '' if remote_dir == '/' else remote_dir
+    entries = walk(ssh_client, remote_dir)
+    executor = ssh_executor.for_client(ssh_client)
+    channels = WorkerChannels(ssh_client)
+    queue = deque()
+    queued_bytes = 0
+    # Reads submitted and not yet collected; more than `workers` would
+    # only fill the host's queue
+    in_flight = 0
+    exhausted = False
+
+    def fill():
+        nonlocal queued_bytes, in_flight, exhausted
+        while (not exhausted and queued_bytes < lookahead_bytes and len(queue) < workers * 8
+               and in_flight < workers):
+            item = next(entries, None)
+            if item is None:
+                exhausted = True
+                return
+            rel, attr = item
+            path = base + '/' + rel
+            task = None
+            mode = attr.st_mode or 0
+            if stat.S_ISREG(mode) and attr.st_size <= small_file_limit:
+                task = executor.submit(_read_small_file, channels, path, attr.st_size)
+                queued_bytes += attr.st_size
+            elif stat.S_ISLNK(mode):
+                task = executor.submit(_read_link, channels, path)
+            if task is not None:
+                in_flight += 1
+            queue.append((rel, path, attr, task))
+            # A large file is streamed when it's reached; stop reading ahead
+            if stat.S_ISREG(mode) and task is None:
+                return
+
+    try:
+        fill()
+        while queue:
+            rel, path, attr, task = queue.popleft()
+            mode = attr.st_mode or 0
+            if task is not None:
+                in_flight -= 1
+                try:
+                    result = task.result()
+                except IOError as e:
+                    print(f"Skipping {path} in archive: {str(e)}")
+                    result = None
+            if stat.S_ISREG(mode):
+                if task is not None:
+                    queued_bytes -= attr.st_size
+                    fill()
+                    if result is None:
+                        continue
+                    content = _fit([result], attr.st_size)
+                else:
+                    content = _fit(ssh_client.iter_file(path, 0, attr.st_size, chunk_size, window),
+                                   attr.st_size)
+                yield rel, attr, content
+                if task is None:
+                    fill()
+            elif stat.S_ISLNK(mode):
+                if result is not None:
+                    attr.link_target = result
+                    yield rel, attr, None
+                fill()
+            else:
+                yield rel, attr, None
+                fill()
+    finally:
+        for _, _, _, task in queue:
+            if task is not None:
+                task.cancel()
+        channels.close()
+
+
+class _Compressor:
+    def __init__(self, compression):
+        if compression == 'gzip':
+            self.obj = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif compression == 'zstd':
+            self.obj = zstandard.ZstdCompressor().compressobj()
+        else:
+            self.obj = None
+
+    def compress(self, data):
+        return self.obj.compress(data) if self.obj else data
+
+    def flush(self):
+        return self.obj.flush() if self.obj else b''
+
+
+def tar_stream(entries, root_name, compression=None):
+    """Produce a (optionally compressed) tar archive from iter_entries output."""
+    compressor = _Compressor(compression)
+    for rel, attr, content in entries:
+        info = tarfile.TarInfo(root_name + '/' + rel)
+        mode = attr.st_mode or 0
+        info.mode = stat.S_IMODE(mode)
+        info.mtime = attr.st_mtime or 0
+        info.uid = attr.st_uid or 0
+        info.gid = attr.st_gid or 0
+        if stat.S_ISDIR(mode):
+            info.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = getattr(attr, 'link_target', '') or ''
+        elif stat.S_ISREG(mode):
+            info.size = attr.st_size
+        else:
+            # Sockets, fifos and devices are skipped
+            continue
+        out = compressor.compress(info.tobuf(format=tarfile.PAX_FORMAT))
+        if out:
+            yield out
+        if content is not None:
+            for data in content:
+                out = compressor.compress(data)
+                if out:
+                    yield out
+            remainder = info.size % BLOCKSIZE
+            if remainder:
+                yield compressor.compress(b'\0' * (BLOCKSIZE - remainder))
+    # End of archive: two zero blocks
+    yield compressor.compress(b'\0' * (2 * BLOCKSIZE)) + compressor.flush()
+
+
+class _Sink:
+    """Unseekable file object collecting what zipfile writes."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_stream(entries, root_name, compression=None):
+    """Produce a zip archive from iter_entries output, deflated if compression is set."""
+    sink = _Sink()
+    method = zipfile.ZIP_DEFLATED if compression else zipfile.ZIP_STORED
+    with zipfile.ZipFile(sink, 'w', compression=method, allowZip64=True) as zf:
+        for rel, attr, content in entries:
+            mode = attr.st_mode or 0
+            mtime = time.localtime(max(attr.st_mtime or 0, 315532800))[:6]
+            if stat.S_ISDIR(mode):
+                info = zipfile.ZipInfo(root_name + '/' + rel + '/', mtime)
+                info.external_attr = (mode & 0xFFFF) << 16 | 0x10
+                zf.writestr(info, b'')
+            elif stat.S_ISREG(mode):
+                info = zipfile.ZipInfo(root_name + '/' + rel, mtime)
+                info.external_attr = (mode & 0xFFFF) << 16
+                info.compress_type = method
+                info.file_size = attr.st_size
+                with zf.open(info, 'w', force_zip64=attr.st_size > 0x7FFFFFFF) as w:
+                    for data in content:
+                        w.write(data)
+                        out = sink.drain()
+                        if out:
+                            yield out
+            else:
+                continue
+            out = sink.drain()
+            if out:
+                yield out
+    yield sink.drain()
+
+
+# Written to stderr with tar's exit status when its output is piped
+# through a compressor, whose status is the one the channel reports
+TAR_STATUS = 'tar-exit-status:'
+
+
+def remote_tar_command(remote_dir, compression=None):
+    """Shell command that writes a tar of remote_dir to stdout on the remote host."""
+    remote_dir = remote_dir.rstrip('/') or '/'
+    parent, _, name = remote_dir.rpartition('/')
+    parent = parent or '/'
+    name = name or '.'
+    command = f"tar -C {shlex.quote(parent)} -cf - {shlex.quote(name)}"
+    if compression is None:
+        return command
+    # pipefail isn't in every remote shell, so tar's status is reported
+    # separately
+    command = f"{{ {command}; echo {TAR_STATUS}$? >&2; }}"
+    if compression == 'gzip':
+        return command + " | gzip -c"
+    return command + " | zstd -q -c"
+
+
+def _tar_status(stderr_text):
+    """Split remote stderr into tar's reported exit status (None if absent) and the error text."""
+    status = None
+    lines = []
+    for line in stderr_text.splitlines():
+        if line.startswith(TAR_STATUS):
+            try:
+                status = int(line[len(TAR_STATUS):])
+            except ValueError:
+                pass
+        else:
+            lines.append(line)
+    return status, '\n'.join(lines).strip()
+
+
+def remote_tar_stream(ssh_client, remote_dir, compression=None, chunk_size=65536):
+    """
+    Run tar on the remote host over an exec channel and yield its stdout.
+    Raises IOError if the command fails, so the download is aborted instead
+    of ending with a truncated archive.
+    """
+    stdin, stdout, stderr = ssh_client.exec_command(remote_tar_command(remote_dir, compression))
+    channel = stdout.channel
+    try:
+        stdin.close()
+        while True:
+            data = channel.recv(chunk_size)
+            if not data:
+                break
+            yield data
+        status = channel.recv_exit_status()
+        tar_status, error = _tar_status(stderr.read().decode(errors='replace'))
+        if compression is None:
+            tar_status = status
+        elif tar_status is None:
+            raise IOError(f"Remote tar did not report its exit status: {error}")
+        if tar_status != 0 or status != 0:
+            raise IOError(f"Remote tar exited with status {tar_status or status}: {error}")
+    finally:
+        channel.close()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# bench_parallel.py - Throughput of parallel multi-channel transfers
+"""
+Measure download and upload throughput of the parallel transfer engine
+against the in-process stand-in SSH server, with injected latency, for a
+range of channel counts.
+
+    python benchmarks/bench_parallel.py --latency 50 --size 64 --concurrency 1 2 4 8
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from standin_server import StandinSSHServer, USERNAME, PASSWORD
+from local_sftp import SSHBoxClient
+from parallel_transfer import parallel_iter_file, ParallelWriter
+
+
+def bench_download(client, remote_path, size, concurrency, segment_size):
+    start = time.perf_counter()
+    received = 0
+    if concurrency > 1:
+        body = parallel_iter_file(client, remote_path, 0, size, concurrency, segment_size)
+    else:
+        body = client.iter_file(remote_path, 0, size)
+    for data in body:
+        received += len(data)
+    assert received == size, (received, size)
+    return time.perf_counter() - start
+
+
+def bench_upload(client, remote_path, payload, concurrency, segment_size):
+    start = time.perf_counter()
+    if concurrency > 1:
+        f = ParallelWriter(client, remote_path, concurrency, segment_size)
+    else:
+        f = client.open_write(remote_path)
+    for pos in range(0, len(payload), 65536):
+        f.write(payload[pos:pos + 65536])
+    f.close()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=50, help="round trip time in ms")
+    parser.add_argument("--bandwidth", type=float, default=0, help="link bandwidth in MB/s (0 = unlimited)")
+    parser.add_argument("--size", type=int, default=64, help="file size in MB")
+    parser.add_argument("--segment", type=int, default=4, help="segment size in MB")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    segment_size = args.segment * 1024 * 1024
+    workdir = tempfile.mkdtemp(prefix="bench_parallel_")
+    source = os.path.join(workdir, "source.bin")
+    payload = os.urandom(size)
+    with open(source, "wb") as f:
+        f.write(payload)
+
+    server = StandinSSHServer("/", latency_ms=args.latency,
+                              bandwidth_bps=args.bandwidth * 1024 * 1024)
+    client = SSHBoxClient("127.0.0.1", server.port, USERNAME, PASSWORD)
+
+    results = []
+    for n in args.concurrency:
+        down = bench_download(client, source, size, n, segment_size)
+        up = bench_upload(client, os.path.join(workdir, f"upload_{n}.bin"), payload, n, segment_size)
+        results.append({
+            "concurrency": n,
+            "download_mb_s": round(args.size / down, 2),
+            "upload_mb_s": round(args.size / up, 2)
+        })
+        print(f"concurrency={n:<3} download {args.size / down:8.2f} MB/s   upload {args.size / up:8.2f} MB/s")
+
+    client.close()
+    server.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+    print(json.dumps({
+        "latency_ms": args.latency,
+        "bandwidth_mb_s": args.bandwidth,
+        "size_mb": args.size,
+        "results": results
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
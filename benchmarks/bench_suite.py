@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+# bench_suite.py - End-to-end benchmarks of the SFTP API and terminals
+"""
+Run the real unified server (FastAPI app and Tornado terminal handler) in
+this process against the in-process stand-in SSH server, optionally behind
+a latency/bandwidth shaping proxy, and measure it over HTTP and WebSocket
+like a browser would:
+
+- download   GET /getFile of a large file
+- upload     streamed multipart POST /uploadfile of a large file
+- listing    /listFiles and /listFilesStream of directories with 10, 10k
+             and 500k entries (generated by the stand-in, not on disk)
+- users      concurrent users logging in, listing and downloading
+- moves      /rename of many small files, one at a time and concurrently
+- echo       keystroke round trips through a /terminals shell
+
+Results are written as JSON (stdout, or --output) so runs can be kept and
+compared; --compare prints the change against an earlier result file.
+Progress goes to stderr.
+
+    python benchmarks/bench_suite.py --latency 20 --output run.json
+    python benchmarks/bench_suite.py --scenarios listing echo --compare run.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import urlencode
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import tornado.httpclient
+import tornado.websocket
+import uvicorn
+
+from standin_server import StandinSSHServer, USERNAME, PASSWORD
+
+SCENARIOS = ("download", "upload", "listing", "users", "moves", "echo")
+MB = 1024 * 1024
+VIRTUAL_ROOT = "/standin-virtual"
+REQUEST_TIMEOUT = 3600
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered))) - 1))]
+
+
+def latency_summary(seconds, prefix=""):
+    """p50/p95/p99/max of a list of durations, in milliseconds."""
+    ms = [s * 1000 for s in seconds]
+    return {
+        f"{prefix}p50_ms": round(percentile(ms, 50), 3),
+        f"{prefix}p95_ms": round(percentile(ms, 95), 3),
+        f"{prefix}p99_ms": round(percentile(ms, 99), 3),
+        f"{prefix}max_ms": round(max(ms), 3),
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def write_random_file(path, size):
+    with open(path, "wb") as f:
+        for pos in range(0, size, MB):
+            f.write(os.urandom(min(MB, size - pos)))
+
+
+class Harness:
+    """The stand-in SSH server, the unified server and an HTTP client."""
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="bench_suite_")
+        users = {USERNAME: PASSWORD}
+        users.update({f"{USERNAME}{i}": PASSWORD for i in range(args.users)})
+        self.ssh = StandinSSHServer(
+            "/", latency_ms=args.latency, bandwidth_bps=args.bandwidth * MB, users=users,
+            virtual_dirs={f"{VIRTUAL_ROOT}/{n}": n for n in args.listing_sizes})
+        self.host_ip = f"127.0.0.1:{self.ssh.port}"
+
+        # Sessions (with their passwords) and cached downloads of the run
+        # are kept out of the working tree and removed afterwards. The
+        # session sweeper starts on import and resolves ./state against
+        # the working directory, so the import happens inside appdir.
+        self.appdir = tempfile.mkdtemp(prefix="bench_suite_app_")
+        os.chdir(self.appdir)
+        try:
+            import shared_state
+            shared_state.use_state_dir(os.path.join(self.appdir, "state"))
+        finally:
+            os.chdir(REPO_ROOT)
+
+        # Imported late so the stand-in is up before the app reads its config
+        import unified_server
+        self.terminal_port = free_port()
+        unified_server.config["terminal_port"] = self.terminal_port
+        unified_server.config["download_cache_path"] = os.path.join(self.appdir, "cache")
+        self.server = uvicorn.Server(uvicorn.Config(
+            unified_server.app, host="127.0.0.1", port=0, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            if not self.thread.is_alive():
+                raise RuntimeError("Server failed to start")
+            time.sleep(0.05)
+        self.base = f"http://127.0.0.1:{self.server.servers[0].sockets[0].getsockname()[1]}"
+        self.http = None
+
+    async def start_client(self):
+        tornado.httpclient.AsyncHTTPClient.configure(
+            None, max_clients=max(16, self.args.users * 2), max_body_size=1 << 40)
+        self.http = tornado.httpclient.AsyncHTTPClient()
+
+    async def call(self, path, payload):
+        """POST a JSON request and return its data, raising if it did not succeed."""
+        response = await self.http.fetch(
+            self.base + path, method="POST", body=json.dumps(payload),
+            headers={"Content-Type": "application/json"}, request_timeout=REQUEST_TIMEOUT)
+        result = json.loads(response.body)
+        if not result.get("status"):
+            raise RuntimeError(f"{path} failed: {result.get('msg')}")
+        return result.get("data")
+
+    async def login(self, username=USERNAME):
+        return await self.call("/login", {"hostIp": self.host_ip, "username": username,
+                                          "password": PASSWORD})
+
+    async def download(self, remote_path, username=USERNAME):
+        """GET /getFile, returning (bytes, seconds to first byte, seconds)."""
+        query = urlencode({"hostIp": self.host_ip, "username": username, "remotePath": remote_path})
+        received = 0
+        first_byte = None
+        started = time.perf_counter()
+
+        def on_chunk(chunk):
+            nonlocal received, first_byte
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+            received += len(chunk)
+
+        await self.http.fetch(f"{self.base}/getFile?{query}", streaming_callback=on_chunk,
+                              request_timeout=REQUEST_TIMEOUT)
+        return received, first_byte, time.perf_counter() - started
+
+    async def upload(self, local_path, location, filename, username=USERNAME):
+        """Streamed multipart POST /uploadfile of a local file."""
+        size = os.path.getsize(local_path)
+        boundary = uuid.uuid4().hex
+        head = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; "
+                f"filename=\"{filename}\"\r\nContent-Type: application/octet-stream\r\n\r\n").encode()
+        tail = f"\r\n--{boundary}--\r\n".encode()
+
+        async def produce(write):
+            await write(head)
+            with open(local_path, "rb") as f:
+                while True:
+                    data = f.read(MB)
+                    if not data:
+                        break
+                    await write(data)
+            await write(tail)
+
+        response = await self.http.fetch(
+            self.base + "/uploadfile", method="POST", body_producer=produce,
+            headers={
+                "Content-Type": f"multipart/form-data; boundary={boundary}",
+                "Content-Length": str(len(head) + size + len(tail)),
+                "upload-params": json.dumps({"hostIp": self.host_ip, "username": username,
+                                             "location": location}),
+                "file-size": str(size),
+            }, request_timeout=REQUEST_TIMEOUT)
+        result = json.loads(response.body)
+        if not result.get("status"):
+            raise RuntimeError(f"Upload failed: {result.get('msg')}")
+
+    def close(self):
+        self.server.should_exit = True
+        self.thread.join(30)
+        self.ssh.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+        shutil.rmtree(self.appdir, ignore_errors=True)
+
+
+async def bench_download(h):
+    size = h.args.size * MB
+    source = os.path.join(h.workdir, "download.bin")
+    write_random_file(source, size)
+    received, first_byte, seconds = await h.download(source)
+    assert received == size, (received, size)
+    os.remove(source)
+    return {"bytes": size, "seconds": round(seconds, 3), "ttfb_ms": round(first_byte * 1000, 3),
+            "mb_s": round(size / MB / seconds, 2)}
+
+
+async def bench_upload(h):
+    size = h.args.size * MB
+    source = os.path.join(h.workdir, "upload_source.bin")
+    target_dir = os.path.join(h.workdir, "uploads")
+    os.makedirs(target_dir)
+    write_random_file(source, size)
+    started = time.perf_counter()
+    await h.upload(source, target_dir, "upload.bin")
+    seconds = time.perf_counter() - started
+    assert os.path.getsize(os.path.join(target_dir, "upload.bin")) == size
+    shutil.rmtree(target_dir)
+    os.remove(source)
+    return {"bytes": size, "seconds": round(seconds, 3), "mb_s": round(size / MB / seconds, 2)}
+
+
+async def bench_listing(h):
+    results = {}
+    for n in h.args.listing_sizes:
+        location = f"{VIRTUAL_ROOT}/{n}"
+        payload = {"hostIp": h.host_ip, "username": USERNAME, "location": location}
+
+        started = time.perf_counter()
+        files = await h.call("/listFiles", dict(payload, refresh=True))
+        full = time.perf_counter() - started
+        assert len(files) == n, (len(files), n)
+
+        # Streamed NDJSON: time to the first entries and to the last
+        lines = 0
+        first = None
+        started = time.perf_counter()
+
+        def on_chunk(chunk):
+            nonlocal lines, first
+            if first is None:
+                first = time.perf_counter() - started
+            lines += chunk.count(b"\n")
+
+        await h.http.fetch(h.base + "/listFilesStream", method="POST", body=json.dumps(payload),
+                           headers={"Content-Type": "application/json"},
+                           streaming_callback=on_chunk, request_timeout=REQUEST_TIMEOUT)
+        streamed = time.perf_counter() - started
+        assert lines == n, (lines, n)
+
+        results[str(n)] = {
+            "list_seconds": round(full, 3),
+            "list_entries_s": round(n / full),
+            "stream_first_ms": round(first * 1000, 3),
+            "stream_seconds": round(streamed, 3),
+            "stream_entries_s": round(n / streamed),
+        }
+        log(f"  listing {n:>7}: listFiles {full:.3f}s, stream first {first * 1000:.1f}ms, total {streamed:.3f}s")
+    return results
+
+
+async def bench_users(h):
+    size = h.args.user_file_size * MB
+    source = os.path.join(h.workdir, "shared.bin")
+    write_random_file(source, size)
+    logins, listings, downloads = [], [], []
+
+    async def user(username):
+        started = time.perf_counter()
+        await h.login(username)
+        logins.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        await h.call("/listFiles", {"hostIp": h.host_ip, "username": username,
+                                    "location": h.workdir, "refresh": True})
+        listings.append(time.perf_counter() - started)
+        received, _, seconds = await h.download(source, username)
+        assert received == size
+        downloads.append(seconds)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(f"{USERNAME}{i}") for i in range(h.args.users)))
+    wall = time.perf_counter() - started
+    os.remove(source)
+    result = {"users": h.args.users, "seconds": round(wall, 3),
+              "aggregate_mb_s": round(size * h.args.users / MB / wall, 2)}
+    result.update(latency_summary(logins, "login_"))
+    result.update(latency_summary(listings, "list_"))
+    result.update(latency_summary(downloads, "download_"))
+    return result
+
+
+async def bench_moves(h):
+    a = os.path.join(h.workdir, "moves_a")
+    b = os.path.join(h.workdir, "moves_b")
+    os.makedirs(a)
+    os.makedirs(b)
+    names = [f"small{i:05d}.txt" for i in range(h.args.moves)]
+    for name in names:
+        with open(os.path.join(a, name), "wb") as f:
+            f.write(os.urandom(256))
+
+    results = {}
+    src, dst = a, b
+    for concurrency in h.args.move_concurrency:
+        pending = list(names)
+        latencies = []
+
+        async def mover():
+            while pending:
+                name = pending.pop()
+                started = time.perf_counter()
+                await h.call("/rename", {"hostIp": h.host_ip, "username": USERNAME,
+                                         "oldPath": f"{src}/{name}", "newPath": f"{dst}/{name}"})
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(mover() for _ in range(concurrency)))
+        seconds = time.perf_counter() - started
+        assert len(os.listdir(dst)) == len(names)
+        result = {"files": len(names), "seconds": round(seconds, 3), "ops_s": round(len(names) / seconds, 1)}
+        result.update(latency_summary(latencies))
+        results[str(concurrency)] = result
+        log(f"  moves x{concurrency}: {result['ops_s']} ops/s")
+        # Move them back on the next round
+        src, dst = dst, src
+
+    shutil.rmtree(a)
+    shutil.rmtree(b)
+    return results
+
+
+async def bench_echo(h):
+    query = urlencode({"host": "127.0.0.1", "port": h.ssh.port, "username": USERNAME,
+                       "password": PASSWORD})
+    started = time.perf_counter()
+    ws = await tornado.websocket.websocket_connect(f"ws://127.0.0.1:{h.terminal_port}/terminals?{query}")
+    ws.write_message(json.dumps({"type": "open", "id": 1, "cols": 80, "rows": 24}))
+    while True:
+        message = await ws.read_message()
+        if message is None:
+            raise RuntimeError("Terminal closed while opening")
+        if isinstance(message, str) and json.loads(message).get("type") == "opened":
+            break
+    opened = time.perf_counter() - started
+
+    output = bytearray()
+
+    async def read_until(marker):
+        while marker not in output:
+            message = await ws.read_message()
+            if message is None:
+                raise RuntimeError("Terminal closed")
+            if isinstance(message, bytes):
+                output.extend(message[4:])
+
+    def send(data):
+        ws.write_message(struct.pack(">I", 1) + data, binary=True)
+
+    # The stand-in shell has no pty and so no echo; cat echoes each keystroke back
+    send(b"echo __bench_ready__; cat\n")
+    await read_until(b"__bench_ready__\n")
+    del output[:]
+
+    latencies = []
+    for i in range(h.args.keystrokes):
+        key = bytes([ord("a") + i % 26])
+        started = time.perf_counter()
+        send(key)
+        await read_until(key)
+        latencies.append(time.perf_counter() - started)
+        del output[:]
+
+    ws.write_message(json.dumps({"type": "close", "id": 1}))
+    ws.close()
+    result = {"keystrokes": len(latencies), "open_ms": round(opened * 1000, 3),
+              "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3)}
+    result.update(latency_summary(latencies))
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=REPO_ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=""):
+    """Numeric leaves of a result tree as {"a.b.c": value}."""
+    flat = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{name}"] = value
+    return flat
+
+
+def compare(baseline, current):
+    """Print the change of every metric present in both runs."""
+    before = flatten(baseline.get("scenarios", {}))
+    after = flatten(current["scenarios"])
+    log(f"Compared with {baseline.get('commit')} ({baseline.get('timestamp')}):")
+    for name in sorted(set(before) & set(after)):
+        if before[name]:
+            change = (after[name] - before[name]) / abs(before[name]) * 100
+            log(f"  {name:<40} {before[name]:>12} -> {after[name]:>12}  {change:+7.1f}%")
+
+
+async def run(h, scenarios):
+    await h.start_client()
+    await h.login()
+    results = {}
+    for name in scenarios:
+        log(f"Running {name}...")
+        results[name] = await globals()[f"bench_{name}"](h)
+        log(f"  {name}: {json.dumps(results[name])}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--latency", type=float, default=0, help="round trip time in ms")
+    parser.add_argument("--bandwidth", type=float, default=0, help="link bandwidth in MB/s (0 = unlimited)")
+    parser.add_argument("--size", type=int, default=64, help="download/upload file size in MB")
+    parser.add_argument("--listing-sizes", type=int, nargs="+", default=[10, 10000, 500000])
+    parser.add_argument("--users", type=int, default=8, help="concurrent users")
+    parser.add_argument("--user-file-size", type=int, default=8, help="file size each user downloads, in MB")
+    parser.add_argument("--moves", type=int, default=500, help="number of small files to move")
+    parser.add_argument("--move-concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--keystrokes", type=int, default=200)
+    parser.add_argument("--output", help="write the JSON result to this file")
+    parser.add_argument("--compare", help="earlier JSON result to compare with")
+    args = parser.parse_args()
+
+    # The app finds static/, dtmp/ and its state relative to the working directory
+    os.chdir(REPO_ROOT)
+    logging.disable(logging.INFO)
+    h = Harness(args)
+    try:
+        scenarios = asyncio.run(run(h, args.scenarios))
+    finally:
+        h.close()
+
+    result = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "parameters": {name: value for name, value in vars(args).items()
+                       if name not in ("output", "compare")},
+        "scenarios": scenarios,
+    }
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        log(f"Results written to {args.output}")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), result)
+
+
+if __name__ == "__main__":
+    main()
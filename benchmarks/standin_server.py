@@ -0,0 +1,437 @@
+# standin_server.py - An in-process SSH/SFTP server for benchmarks
+"""
+A small paramiko based SSH server that serves SFTP out of a local directory
+and runs exec/shell requests with the local shell. It is only meant to be a
+stand-in for a real sshd when measuring the gateway on localhost.
+
+An optional latency/bandwidth shaping proxy can be put in front of it to
+simulate a WAN link, and "virtual" directories with any number of generated
+entries can be served without creating files on disk.
+"""
+
+import itertools
+import os
+import socket
+import subprocess
+import threading
+import time
+import heapq
+import paramiko
+from paramiko import (
+    ServerInterface, SFTPServerInterface, SFTPServer, SFTPAttributes,
+    SFTPHandle, SFTP_OK, AUTH_SUCCESSFUL, AUTH_FAILED,
+    OPEN_SUCCEEDED,
+)
+
+USERNAME = "bench"
+PASSWORD = "bench"
+
+
+class StandinServer(ServerInterface):
+    def __init__(self, users):
+        # username -> password
+        self.users = users
+
+    def check_auth_password(self, username, password):
+        if username in self.users and self.users[username] == password:
+            return AUTH_SUCCESSFUL
+        return AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, channel, term, width, height,
+                                  pixelwidth, pixelheight, modes):
+        channel.pty_size = (width, height)
+        return True
+
+    def check_channel_window_change_request(self, channel, width, height,
+                                            pixelwidth, pixelheight):
+        channel.pty_size = (width, height)
+        return True
+
+    def check_channel_shell_request(self, channel):
+        threading.Thread(target=_run_command, args=(channel, None),
+                         daemon=True).start()
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=_run_command, args=(channel, command.decode()),
+                         daemon=True).start()
+        return True
+
+
+def _pump(src, channel, stderr=False):
+    send = channel.sendall_stderr if stderr else channel.sendall
+    try:
+        while True:
+            data = os.read(src, 32768)
+            if not data:
+                break
+            send(data)
+    except OSError:
+        pass
+
+
+def _run_command(channel, command):
+    """Run a command (or an interactive shell) and wire it to the channel."""
+    if command is None:
+        # Interactive shell: a plain "cat" style echo loop is enough to
+        # measure keystroke round trips without depending on a pty.
+        proc = subprocess.Popen(["sh", "-i"], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+    else:
+        proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def feed():
+        try:
+            while True:
+                data = channel.recv(32768)
+                if not data:
+                    break
+                proc.stdin.write(data)
+                proc.stdin.flush()
+        except Exception:
+            pass
+        try:
+            proc.stdin.close()
+        except Exception:
+            pass
+
+    threading.Thread(target=feed, daemon=True).start()
+    pumps = [threading.Thread(target=_pump, args=(proc.stdout.fileno(), channel))]
+    if proc.stderr is not None:
+        pumps.append(threading.Thread(target=_pump,
+                                      args=(proc.stderr.fileno(), channel, True)))
+    for t in pumps:
+        t.start()
+    for t in pumps:
+        t.join()
+    channel.send_exit_status(proc.wait())
+    channel.close()
+
+
+class StandinSFTPHandle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        # Only truncation is honoured; paramiko's set_file_attr would empty
+        # the file first
+        if attr._flags & attr.FLAG_SIZE:
+            try:
+                self.writefile.flush()
+                os.ftruncate(self.writefile.fileno(), attr.st_size)
+            except OSError as e:
+                return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+
+class StandinFolderHandle(SFTPHandle):
+    """
+    A directory handle that hands out entries in batches of up to 100 per
+    READDIR reply, like OpenSSH's sftp-server. paramiko's default handle
+    re-slices the whole listing on every reply, which is quadratic in the
+    directory size.
+    """
+
+    batch_size = 100
+
+    def __init__(self, entries):
+        super().__init__()
+        self.entries = iter(entries)
+
+    def _get_next_files(self):
+        return list(itertools.islice(self.entries, self.batch_size))
+
+
+class StandinSFTPSubsystem(SFTPServer):
+    def _open_folder(self, request_number, path):
+        resp = self.server.list_folder(path)
+        if isinstance(resp, int):
+            self._send_status(request_number, resp)
+            return
+        self._send_handle_response(request_number, StandinFolderHandle(resp), True)
+
+
+def _virtual_entries(count):
+    """Generated directory entries, the same on every call."""
+    for i in range(count):
+        attr = SFTPAttributes()
+        attr.filename = f"file{i:07d}.dat"
+        attr.st_mode = 0o100644
+        attr.st_size = (i * 7919) % 1048576
+        attr.st_uid = attr.st_gid = 1000
+        attr.st_atime = attr.st_mtime = 1700000000 + i
+        yield attr
+
+
+def _virtual_dir_attr():
+    attr = SFTPAttributes()
+    attr.st_mode = 0o040755
+    attr.st_size = 4096
+    attr.st_uid = attr.st_gid = 1000
+    attr.st_atime = attr.st_mtime = 1700000000
+    return attr
+
+
+class StandinSFTPServer(SFTPServerInterface):
+    """Serve SFTP requests from the local filesystem below ``root``."""
+
+    root = "/"
+    # Remote path -> number of generated entries
+    virtual_dirs = {}
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+
+    def _realpath(self, path):
+        return self.root + self.canonicalize(path)
+
+    def list_folder(self, path):
+        if self.canonicalize(path) in self.virtual_dirs:
+            return _virtual_entries(self.virtual_dirs[self.canonicalize(path)])
+        path = self._realpath(path)
+        try:
+            out = []
+            for fname in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.lstat(os.path.join(path, fname)))
+                attr.filename = fname
+                out.append(attr)
+            return out
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        if self.canonicalize(path) in self.virtual_dirs:
+            return _virtual_dir_attr()
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._realpath(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        if self.canonicalize(path) in self.virtual_dirs:
+            return _virtual_dir_attr()
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self._realpath(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def readlink(self, path):
+        try:
+            return os.readlink(self._realpath(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        path = self._realpath(path)
+        try:
+            binary_flag = getattr(os, "O_BINARY", 0)
+            flags |= binary_flag
+            mode = getattr(attr, "st_mode", None) or 0o666
+            fd = os.open(path, flags, mode)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if (flags & os.O_CREAT) and (attr is not None):
+            attr._flags &= ~attr.FLAG_PERMISSIONS
+            SFTPServer.set_file_attr(path, attr)
+        if flags & os.O_WRONLY:
+            fstr = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            fstr = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            fstr = "rb"
+        try:
+            f = os.fdopen(fd, fstr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        fobj = StandinSFTPHandle(flags)
+        fobj.filename = path
+        fobj.readfile = f
+        fobj.writefile = f
+        return fobj
+
+    def remove(self, path):
+        try:
+            os.remove(self._realpath(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self._realpath(oldpath), self._realpath(newpath))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        return self.rename(oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._realpath(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self._realpath(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            SFTPServer.set_file_attr(self._realpath(path), attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+
+class ShapingProxy:
+    """
+    A TCP proxy that adds a one-way delay and an optional bandwidth cap to
+    every byte passing through, in both directions.
+    """
+
+    def __init__(self, target_port, latency_ms=0, bandwidth_bps=0):
+        self.target_port = target_port
+        self.delay = latency_ms / 2000.0
+        self.bandwidth = bandwidth_bps
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(("127.0.0.1", self.target_port))
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._link(client, upstream)
+            self._link(upstream, client)
+
+    def _link(self, src, dst):
+        cond = threading.Condition()
+        queue = []
+        seq = [0]
+
+        def reader():
+            while True:
+                try:
+                    data = src.recv(65536)
+                except OSError:
+                    data = b""
+                with cond:
+                    seq[0] += 1
+                    heapq.heappush(queue, (time.monotonic() + self.delay, seq[0], data))
+                    cond.notify()
+                if not data:
+                    return
+
+        def writer():
+            while True:
+                with cond:
+                    while not queue:
+                        cond.wait()
+                    due, _, data = queue[0]
+                    now = time.monotonic()
+                    if due > now:
+                        cond.wait(due - now)
+                        continue
+                    heapq.heappop(queue)
+                if not data:
+                    try:
+                        dst.shutdown(socket.SHUT_WR)
+                    except OSError:
+                        pass
+                    return
+                if self.bandwidth:
+                    time.sleep(len(data) / float(self.bandwidth))
+                try:
+                    dst.sendall(data)
+                except OSError:
+                    return
+
+        threading.Thread(target=reader, daemon=True).start()
+        threading.Thread(target=writer, daemon=True).start()
+
+    def close(self):
+        self.sock.close()
+
+
+class StandinSSHServer:
+    """
+    Listen on localhost and serve every connection with a paramiko
+    Transport backed by StandinServer / StandinSFTPServer.
+
+    ``users`` maps usernames to passwords, by default just username and
+    password. ``virtual_dirs`` maps remote paths to a number of generated
+    entries served for them.
+    """
+
+    def __init__(self, root="/", latency_ms=0, bandwidth_bps=0,
+                 username=USERNAME, password=PASSWORD, users=None, virtual_dirs=None):
+        self.root = os.path.abspath(root).rstrip("/")
+        self.users = dict(users or {username: password})
+        self.virtual_dirs = dict(virtual_dirs or {})
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.transports = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(128)
+        self.ssh_port = self.sock.getsockname()[1]
+        self.proxy = None
+        if latency_ms or bandwidth_bps:
+            self.proxy = ShapingProxy(self.ssh_port, latency_ms, bandwidth_bps)
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.proxy.port if self.proxy else self.ssh_port
+
+    def _accept(self):
+        sftp_root = self.root
+        sftp_virtual_dirs = self.virtual_dirs
+
+        class _SFTP(StandinSFTPServer):
+            root = sftp_root
+            virtual_dirs = sftp_virtual_dirs
+
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            t = paramiko.Transport(conn)
+            # Like sshd, offer compression and let the client choose
+            t.use_compression(True)
+            t.add_server_key(self.host_key)
+            t.set_subsystem_handler("sftp", StandinSFTPSubsystem, _SFTP)
+            t.start_server(server=StandinServer(self.users))
+            self.transports.append(t)
+
+    def close(self):
+        self.sock.close()
+        if self.proxy:
+            self.proxy.close()
+        for t in self.transports:
+            t.close()
@@ -0,0 +1,277 @@
+# checksum.py
+"""
+Checksums of remote files, so transfers can be verified without
+downloading the file again.
+
+The remote host does the hashing when it can: md5sum, sha1sum, sha256sum
+or xxh64sum runs over an exec channel for a batch of paths at a time and
+only the digests come back. Files it couldn't hash (no exec channel, the
+tool isn't installed, or the file couldn't be read) are read over SFTP
+instead and hashed on the gateway. Each read is prefetched, with up to a
+window of requests in flight while the data already received is hashed,
+and several files are hashed side by side as jobs on the host's executor,
+each on its own SFTP channel.
+
+'xxhash' is XXH64. Hashing it on the gateway needs the optional xxhash
+package.
+
+Blocking; every function runs on the host's executor.
+"""
+
+import hashlib
+import shlex
+import stat
+from collections import deque
+
+import metrics
+import ssh_executor
+from archive_stream import WorkerChannels
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Algorithm -> command printing "<hex digest>  <path>" lines on the remote host
+REMOTE_COMMANDS = {
+    'md5': 'md5sum',
+    'sha1': 'sha1sum',
+    'sha256': 'sha256sum',
+    'xxhash': 'xxh64sum'
+}
+ALGORITHMS = tuple(REMOTE_COMMANDS)
+MODES = ('auto', 'remote', 'sftp')
+
+# Paths are passed to the remote command in batches of about this many bytes
+MAX_COMMAND_BYTES = 32 * 1024
+
+
+class ChecksumMismatch(IOError):
+    def __init__(self, message, result):
+        super().__init__(message)
+        self.result = result
+
+
+def check_options(algorithm, mode='auto'):
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"Unknown checksum algorithm: {algorithm}")
+    if mode not in MODES:
+        raise ValueError(f"Unknown checksum mode: {mode}")
+    if algorithm == 'xxhash' and mode == 'sftp' and xxhash is None:
+        raise ValueError("xxhash checksums over SFTP require the xxhash package")
+
+
+def new_hash(algorithm):
+    if algorithm == 'xxhash':
+        if xxhash is None:
+            raise ValueError("xxhash checksums on the gateway require the xxhash package")
+        return xxhash.xxh64()
+    return hashlib.new(algorithm)
+
+
+class HashingWriter:
+    """
+    Passes writes through to a target (a remote file or an upload) while
+    hashing them, so an upload can be compared with the remote file after
+    it is written. Everything else is delegated to the target.
+    """
+
+    def __init__(self, target, algorithm):
+        self.target = target
+        self.algorithm = algorithm
+        self.hash = new_hash(algorithm)
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.target.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+
+def _unescape(name):
+    # coreutils escapes names containing a backslash or a newline and marks
+    # the line with a leading backslash
+    out = []
+    chars = iter(name)
+    for c in chars:
+        if c == '\\':
+            c = next(chars, '')
+            c = {'n': '\n', 'r': '\r'}.get(c, c)
+        out.append(c)
+    return ''.join(out)
+
+
+def _parse_line(line):
+    escaped = line.startswith('\\')
+    if escaped:
+        line = line[1:]
+    digest, sep, rest = line.partition(' ')
+    if not sep or not rest:
+        return None, None
+    # "<digest>  <name>" in text mode, "<digest> *<name>" in binary mode
+    name = rest[1:] if rest[0] in ' *' else rest
+    return digest.lower(), _unescape(name) if escaped else name
+
+
+def _batches(paths):
+    batch, size = [], 0
+    for path in paths:
+        if batch and size + len(path) > MAX_COMMAND_BYTES:
+            yield batch
+            batch, size = [], 0
+        batch.append(path)
+        size += len(path) + 3
+    if batch:
+        yield batch
+
+
+def remote_checksums(ssh_client, paths, algorithm):
+    """
+    Hash paths on the remote host. Returns {path: hex digest} for the files
+    that could be hashed there, or None if the command can't run at all.
+    If it stops working after some batches, the digests of those batches
+    are still returned; the caller handles the missing paths.
+    """
+    tool = REMOTE_COMMANDS[algorithm]
+    digests = {}
+    for batch in _batches(paths):
+        try:
+            _, stdout, stderr = ssh_client.exec_command(
+                f"command -v {tool} >/dev/null || exit 127; "
+                f"exec {tool} -- {' '.join(shlex.quote(p) for p in batch)}")
+        except Exception as e:
+            # No exec on this server (e.g. SFTP only)
+            print(f"Checksums falling back to SFTP: {str(e)}")
+            return digests or None
+        output = stdout.read()
+        status = ssh_client.wait_exit_status(stdout.channel)
+        if status == 127:
+            return digests or None
+        wanted = set(batch)
+        for line in output.decode(errors='surrogateescape').split('\n'):
+            digest, name = _parse_line(line)
+            if name in wanted:
+                digests[name] = digest
+        if status != 0:
+            # Some files couldn't be read; they are left out
+            print(f"{tool} failed for some files: {stderr.read().decode(errors='replace').strip()}")
+    return digests
+
+
+def sftp_checksum(sftp, path, algorithm, chunk_size=32768, window=8 * 1024 * 1024):
+    """Hash a remote file read over SFTP with up to a window of reads in flight."""
+    h = new_hash(algorithm)
+    if not stat.S_ISREG(sftp.stat(path).st_mode or 0):
+        raise IOError("Not a regular file")
+    with sftp.open(path, 'rb') as f:
+        size = f.stat().st_size
+        if size:
+            f.prefetch(size, max_concurrent_requests=max(1, window // chunk_size))
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def checksums(ssh_client, paths, algorithm='sha256', mode='auto', workers=4,
+              chunk_size=32768, window=8 * 1024 * 1024):
+    """
+    Checksums of remote files, in the order of paths. Each result has the
+    path, the algorithm and either the checksum and how it was computed
+    ('remote' or 'sftp') or an error.
+    """
+    check_options(algorithm, mode)
+    results = {}
+    pending = list(dict.fromkeys(paths))
+
+    if mode in ('auto', 'remote'):
+        digests = remote_checksums(ssh_client, pending, algorithm)
+        if digests is None and mode == 'remote':
+            raise IOError(f"{REMOTE_COMMANDS[algorithm]} is not available on the remote host")
+        for path, digest in (digests or {}).items():
+            results[path] = {'path': path, 'algorithm': algorithm, 'checksum': digest, 'method': 'remote'}
+        pending = [p for p in pending if p not in results]
+        if mode == 'remote':
+            for path in pending:
+                results[path] = {'path': path, 'algorithm': algorithm,
+                                 'error': f"{REMOTE_COMMANDS[algorithm]} could not read the file"}
+            pending = []
+
+    if pending and algorithm == 'xxhash' and xxhash is None:
+        for path in pending:
+            results[path] = {'path': path, 'algorithm': algorithm,
+                             'error': "xxh64sum is not available on the remote host and "
+                                      "the xxhash package is not installed"}
+        pending = []
+
+    if pending:
+        channels = WorkerChannels(ssh_client)
+
+        def run(path):
+            try:
+                digest = sftp_checksum(channels.get(), path, algorithm, chunk_size, window)
+                return {'path': path, 'algorithm': algorithm, 'checksum': digest, 'method': 'sftp'}
+            except IOError as e:
+                return {'path': path, 'algorithm': algorithm, 'error': str(e) or 'Could not read the file'}
+
+        executor = ssh_executor.for_client(ssh_client)
+        tasks = deque()
+        try:
+            for path in pending:
+                tasks.append(executor.submit(run, path))
+                if len(tasks) >= max(1, workers):
+                    result = tasks.popleft().result()
+                    results[result['path']] = result
+            while tasks:
+                result = tasks.popleft().result()
+                results[result['path']] = result
+        finally:
+            for task in tasks:
+                task.cancel()
+            channels.close()
+
+    for result in results.values():
+        if 'method' in result:
+            checksum_files.labels(result['method']).inc()
+    return [results[p] for p in paths]
+
+
+def checksum_file(ssh_client, remote_path, algorithm='sha256', mode='auto', chunk_size=32768,
+                  window=8 * 1024 * 1024):
+    """Checksum result of a single remote file; raises IOError if it can't be computed."""
+    result = checksums(ssh_client, [remote_path], algorithm, mode, 1, chunk_size, window)[0]
+    if 'error' in result:
+        raise IOError(f"Could not checksum {remote_path}: {result['error']}")
+    return result
+
+
+def verify(ssh_client, remote_path, algorithm, expected, mode='auto', chunk_size=32768,
+           window=8 * 1024 * 1024):
+    """
+    Checksum a remote file after a transfer and compare it with the expected
+    digest. Returns the comparison; raises ChecksumMismatch if they differ.
+    """
+    result = checksum_file(ssh_client, remote_path, algorithm, mode, chunk_size, window)
+    result = {
+        'algorithm': algorithm,
+        'expected': expected.lower(),
+        'checksum': result['checksum'],
+        'method': result['method']
+    }
+    result['ok'] = result['checksum'] == result['expected']
+    verifications.labels('ok' if result['ok'] else 'mismatch').inc()
+    if not result['ok']:
+        raise ChecksumMismatch(f"Checksum mismatch for {remote_path}", result)
+    return result
+
+
+checksum_files = metrics.Counter(
+    "sftp_checksum_files_total", "Remote files checksummed, by where they were hashed.", ["method"])
+verifications = metrics.Counter(
+    "sftp_transfer_verifications_total", "Post-transfer checksum verifications by result.", ["result"])
@@ -0,0 +1,223 @@
+# connection_manager.py
+"""
+Bounded pool of live SSH sessions (the SFTP server's client_db).
+
+Sessions are kept in LRU order up to a maximum size. Idle sessions and
+sessions whose transport died are closed by a periodic sweep. When a
+session is requested but its transport is gone, it is transparently
+re-established from the credentials kept in shared_state.
+
+A session that is held (lent to a terminal or a running transfer) is not
+closed when it leaves the pool, because it died, was replaced by a new
+login or was removed: it is retired, and closed when its last hold is
+released.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+
+import shared_state
+
+
+class _Entry:
+    def __init__(self, client):
+        self.client = client
+        self.created = time.time()
+        self.last_used = self.created
+        # Borrowers using the transport outside of requests (terminals)
+        self.holds = 0
+
+
+class ConnectionManager:
+    def __init__(self, connect, close, max_size=256, idle_timeout=1800, keepalive_interval=30):
+        """
+        connect(credentials) and close(client) are coroutines that open and
+        close an SSHBoxClient; credentials is a shared_state entry.
+        """
+        self.connect = connect
+        self.close = close
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.connections = OrderedDict()
+        self.reconnect_locks = {}
+        # Client -> entry of sessions out of the pool that are still held
+        self.retired = {}
+        self.closing = set()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'reconnects': 0,
+            'evictions': 0,
+            'idle_closed': 0,
+            'dead_closed': 0
+        }
+
+    def __contains__(self, key):
+        return key in self.connections
+
+    def __len__(self):
+        return len(self.connections)
+
+    def keys(self):
+        return list(self.connections.keys())
+
+    def peek(self, key):
+        """Return the pooled client without touching LRU order or stats."""
+        entry = self.connections.get(key)
+        return entry.client if entry else None
+
+    def hold(self, key, client=None):
+        """
+        Lend the live client for key to a long-lived user such as a terminal
+        or a streamed transfer; it isn't reaped as idle or evicted until
+        every hold is released. Returns None if there is no live client, or
+        if client is given and is no longer the one pooled for key.
+        """
+        entry = self.connections.get(key)
+        if entry is None or not entry.client.is_active():
+            return None
+        if client is not None and entry.client is not client:
+            return None
+        entry.holds += 1
+        entry.last_used = time.time()
+        return entry.client
+
+    def release(self, key, client):
+        entry = self.connections.get(key)
+        if entry is not None and entry.client is client:
+            entry.holds -= 1
+            entry.last_used = time.time()
+            return
+        entry = self.retired.get(client)
+        if entry is None:
+            return
+        entry.holds -= 1
+        if entry.holds <= 0:
+            del self.retired[client]
+            # Holds may be released from another thread
+            entry.loop.call_soon_threadsafe(self._close_later, client)
+
+    def _close_later(self, client):
+        task = asyncio.ensure_future(self._close_quietly(client))
+        self.closing.add(task)
+        task.add_done_callback(self.closing.discard)
+
+    async def _close_quietly(self, client):
+        try:
+            await self.close(client)
+        except Exception as e:
+            print(f"Error closing released connection: {str(e)}")
+
+    async def _close_entry(self, entry):
+        """Close a session that left the pool, or retire it until its holds are released."""
+        if entry.holds > 0:
+            entry.loop = asyncio.get_running_loop()
+            self.retired[entry.client] = entry
+            return
+        await self.close(entry.client)
+
+    async def get(self, key):
+        """
+        Return a live client for key, reconnecting with the stored
+        credentials if the transport died or was reaped. Returns None if
+        the user isn't logged in.
+        """
+        entry = self.connections.get(key)
+        if entry is not None and entry.client.is_active():
+            self.stats['hits'] += 1
+            entry.last_used = time.time()
+            self.connections.move_to_end(key)
+            return entry.client
+
+        self.stats['misses'] += 1
+        if entry is not None:
+            await self._discard(key, entry, 'dead_closed')
+
+        credentials = shared_state.get_client(key)
+        if not credentials:
+            return None
+
+        # Coalesce concurrent reconnects for the same session. The lock lives
+        # as long as the session is known; one dropped while we waited for
+        # it no longer excludes anybody, so take the current one instead.
+        while True:
+            lock = self.reconnect_locks.setdefault(key, asyncio.Lock())
+            async with lock:
+                if self.reconnect_locks.get(key) is not lock:
+                    continue
+                entry = self.connections.get(key)
+                if entry is not None and entry.client.is_active():
+                    return entry.client
+                client = await self.connect(credentials)
+                self.stats['reconnects'] += 1
+                await self.put(key, client)
+                return client
+
+    def _forget(self, key):
+        """Drop the reconnect lock of a session that left the pool, unless a reconnect holds it."""
+        lock = self.reconnect_locks.get(key)
+        if lock is not None and not lock.locked():
+            del self.reconnect_locks[key]
+
+    async def put(self, key, client):
+        """Add or replace a session, evicting the least recently used ones if full."""
+        if self.keepalive_interval:
+            client.t.set_keepalive(self.keepalive_interval)
+        old = self.connections.pop(key, None)
+        self.connections[key] = _Entry(client)
+        if old is not None and old.client is not client:
+            await self._close_entry(old)
+        while len(self.connections) > self.max_size:
+            # Held sessions are in use however long ago they were fetched
+            old_key = next((k for k, e in self.connections.items() if not e.holds and k != key), None)
+            if old_key is None:
+                break
+            old = self.connections.pop(old_key)
+            self._forget(old_key)
+            self.stats['evictions'] += 1
+            await self.close(old.client)
+
+    async def remove(self, key):
+        entry = self.connections.pop(key, None)
+        self._forget(key)
+        if entry is not None:
+            await self._close_entry(entry)
+
+    async def _discard(self, key, entry, reason):
+        if self.connections.get(key) is entry:
+            del self.connections[key]
+        self.stats[reason] += 1
+        await self._close_entry(entry)
+
+    async def reap(self):
+        """Close sessions that are idle for too long or whose transport died."""
+        now = time.time()
+        for key, entry in list(self.connections.items()):
+            if not entry.client.is_active():
+                await self._discard(key, entry, 'dead_closed')
+            elif self.idle_timeout and not entry.holds and now - entry.last_used > self.idle_timeout:
+                await self._discard(key, entry, 'idle_closed')
+                self._forget(key)
+
+    async def reap_forever(self, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reap()
+            except Exception as e:
+                print(f"Error reaping connections: {str(e)}")
+
+    async def close_all(self):
+        while self.connections:
+            _, entry = self.connections.popitem()
+            await self.close(entry.client)
+        while self.retired:
+            client, _ = self.retired.popitem()
+            await self.close(client)
+
+    def snapshot(self):
+        held = sum(1 for entry in self.connections.values() if entry.holds)
+        return dict(self.stats, size=len(self.connections), max_size=self.max_size, held=held,
+                    retired=len(self.retired))
@@ -0,0 +1,265 @@
+# download_cache.py
+"""
+Content-addressed cache of downloaded remote files on local disk.
+
+A file is cached under the sha256 of (host, port, user, remote path, size,
+mtime), so a new version of a file gets a new entry and stale ones simply
+age out; the user is part of the key because being able to stat a file does
+not mean being allowed to read it. A hit is served from disk after nothing
+but the stat the download does anyway.
+
+Entries live under one directory with a byte budget and are evicted least
+recently used first. Concurrent downloads of the same file share a single
+fill from the remote host: every reader follows the fill as it is written,
+and the fill is abandoned if all of them go away. Entries being filled or
+read are pinned and never evicted.
+
+Like SFTP ETags this relies on (size, mtime), so a file rewritten with the
+same size within the same second of mtime resolution is not noticed.
+
+All methods except load() are called from the event loop. Files are
+touched on a single I/O thread, so removing a dropped entry and writing a
+new fill of the same file happen in the order they were asked for.
+"""
+
+import asyncio
+import hashlib
+import os
+import stat
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# Fills are written to disk in batches of this size
+WRITE_BATCH = 1024 * 1024
+
+
+def _touch(path):
+    """Mark a cached file as recently used; False if it is gone."""
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _remove_files(entry):
+    for path in (entry.path, entry.part_path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def cache_key(host, port, username, remote_path, size, mtime):
+    ident = '\0'.join((str(host), str(port), str(username), remote_path, str(size), str(int(mtime))))
+    return hashlib.sha256(ident.encode()).hexdigest()
+
+
+class CacheEntry:
+    def __init__(self, digest, path, size, complete=False):
+        self.digest = digest
+        self.path = path
+        self.part_path = path + '.part'
+        self.size = size
+        self.written = size if complete else 0
+        self.complete = complete
+        self.error = None
+        self.readers = 0
+        self.task = None
+        self._waiter = None
+
+    def _notify(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+        self._waiter = None
+
+    async def _changed(self):
+        if self._waiter is None:
+            self._waiter = asyncio.get_running_loop().create_future()
+        await self._waiter
+
+    async def wait_complete(self):
+        while not self.complete:
+            if self.error is not None:
+                raise self.error
+            await self._changed()
+
+    async def read(self, start, length, chunk_size=256 * 1024):
+        """
+        Async generator over [start, start + length) of the entry, following
+        the fill if it is still being written.
+        """
+        loop = asyncio.get_running_loop()
+        end = start + length
+        pos = start
+        fd = None
+        try:
+            while pos < end:
+                while pos >= self.written:
+                    if self.error is not None:
+                        raise self.error
+                    await self._changed()
+                if fd is None:
+                    # A finished fill has been renamed into place
+                    fd = await loop.run_in_executor(
+                        None, os.open, self.path if self.complete else self.part_path, os.O_RDONLY)
+                n = min(chunk_size, self.written - pos, end - pos)
+                data = await loop.run_in_executor(None, os.pread, fd, n, pos)
+                if not data:
+                    raise IOError(f"Cached file {self.path} is truncated")
+                pos += len(data)
+                yield data
+        finally:
+            if fd is not None:
+                await loop.run_in_executor(None, os.close, fd)
+
+
+class DownloadCache:
+    def __init__(self, max_bytes=4 * 1024 ** 3, max_file=1024 ** 3):
+        self.root = None
+        self.max_bytes = max_bytes
+        self.max_file = max_file
+        self.entries = OrderedDict()  # digest -> CacheEntry, least recently used first
+        self.used = 0  # bytes of complete entries and of fills in progress
+        self.io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="download-cache")
+
+    def _io(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.io, fn, *args)
+
+    def load(self, root):
+        """
+        Use root as the cache directory, indexing the entries left there by
+        earlier runs (oldest first) and removing unfinished fills. Anything
+        but regular files, such as the worker processes' own cache
+        directories, is left alone. Blocking; run it on a thread.
+        """
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        found = []
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            if name.endswith('.part'):
+                os.remove(path)
+                continue
+            found.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(found):
+            self.entries[name] = CacheEntry(name, os.path.join(root, name), size, complete=True)
+            self.used += size
+        self._evict(0)
+
+    async def acquire(self, digest, size, open_chunks=None):
+        """
+        Pin the entry for digest, starting a fill from open_chunks() (an
+        async iterator of the file's bytes) if there is none and
+        open_chunks is given. Returns None if the file is not cached and
+        will not be. Every entry returned must be given back to release().
+        """
+        if self.root is None:
+            return None
+        entry = self.entries.get(digest)
+        if entry is not None:
+            # Pinned before waiting for the disk, so it can't be evicted meanwhile
+            entry.readers += 1
+            self.entries.move_to_end(digest)
+            if not entry.complete or await self._io(_touch, entry.path):
+                cache_requests.labels('hit' if entry.complete else 'coalesced').inc()
+                return entry
+            # Removed behind our back
+            entry.readers -= 1
+            self._drop(entry)
+            entry = self.entries.get(digest)
+            if entry is not None:
+                # Another download started a new fill meanwhile
+                cache_requests.labels('coalesced').inc()
+                entry.readers += 1
+                return entry
+
+        if open_chunks is None or size == 0 or size > self.max_file or not self._evict(size):
+            cache_requests.labels('bypass').inc()
+            return None
+        cache_requests.labels('miss').inc()
+        entry = CacheEntry(digest, os.path.join(self.root, digest), size)
+        entry.readers = 1
+        self.entries[digest] = entry
+        self.used += size
+        entry.task = asyncio.ensure_future(self._fill(entry, open_chunks()))
+        return entry
+
+    def release(self, entry):
+        entry.readers -= 1
+        if entry.readers == 0 and not entry.complete and entry.task is not None:
+            # Nobody is waiting for the rest of it
+            entry.task.cancel()
+
+    def _evict(self, size):
+        """Make room for size more bytes; False if pinned entries are in the way."""
+        for entry in list(self.entries.values()):
+            if self.used + size <= self.max_bytes:
+                break
+            if entry.complete and entry.readers == 0:
+                self._drop(entry)
+        return self.used + size <= self.max_bytes
+
+    def _drop(self, entry):
+        if self.entries.get(entry.digest) is entry:
+            del self.entries[entry.digest]
+            self.used -= entry.size
+            # Queued behind any earlier file operation on the same paths
+            self.io.submit(_remove_files, entry)
+
+    async def _fill(self, entry, chunks):
+        started = time.perf_counter()
+        f = None
+        try:
+            f = await self._io(open, entry.part_path, 'wb')
+            batch = bytearray()
+            async for data in chunks:
+                batch += data
+                if len(batch) >= WRITE_BATCH:
+                    await self._io(f.write, bytes(batch))
+                    entry.written += len(batch)
+                    batch.clear()
+                    entry._notify()
+            if batch:
+                await self._io(f.write, bytes(batch))
+                entry.written += len(batch)
+            await self._io(f.close)
+            if entry.written != entry.size:
+                raise IOError(f"Remote file changed size while caching ({entry.written} of {entry.size} bytes)")
+            await self._io(os.replace, entry.part_path, entry.path)
+            entry.complete = True
+            fill_seconds.observe(time.perf_counter() - started)
+        except BaseException as e:
+            entry.error = e if isinstance(e, Exception) else IOError("Cache fill cancelled")
+            if f is not None:
+                self.io.submit(f.close)
+            self._drop(entry)
+            if not isinstance(e, (Exception, asyncio.CancelledError)):
+                raise
+        finally:
+            entry._notify()
+            aclose = getattr(chunks, 'aclose', None)
+            if aclose is not None:
+                await asyncio.shield(aclose())
+
+    def snapshot(self):
+        return {
+            'entries': sum(1 for e in self.entries.values() if e.complete),
+            'filling': sum(1 for e in self.entries.values() if not e.complete),
+            'bytes': self.used,
+            'maxBytes': self.max_bytes
+        }
+
+
+cache_requests = metrics.Counter(
+    "download_cache_requests_total",
+    "Downloads by cache outcome: hit, coalesced (joined a fill in progress), miss (started a fill) or bypass.",
+    ["result"])
+fill_seconds = metrics.Histogram(
+    "download_cache_fill_duration_seconds", "Time to fill a cache entry from the remote host.")
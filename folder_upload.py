@@ -0,0 +1,319 @@
+# folder_upload.py
+"""
+Bulk upload of whole directory trees.
+
+A tree arrives either as a multipart body whose file names carry relative
+paths (what browsers send for a folder picked with webkitdirectory), or as
+a tar stream. Directories are recreated on the remote and files are written
+with pipelined SFTP requests.
+
+Small files are the expensive case: over SFTP each one costs an open, a
+write and a close round trip. In 'auto' mode they are packed into a single
+tar stream instead, which is extracted on the remote host over an exec
+channel, and only large files go over SFTP. In 'sftp' mode, and in 'auto'
+mode on hosts that can't run tar (SFTP only servers), small files are
+written by several jobs side by side on the host's executor, each on its
+own channel.
+"""
+
+import shlex
+import tarfile
+import time
+
+import ssh_executor
+from archive_stream import WorkerChannels
+
+MODES = ('auto', 'sftp')
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+
+
+def clean_relative_path(name):
+    """Turn a client supplied path into a safe relative path, or raise ValueError."""
+    parts = []
+    for part in name.replace('\\', '/').split('/'):
+        if part in ('', '.'):
+            continue
+        if part == '..':
+            raise ValueError(f"Invalid path in upload: {name}")
+        parts.append(part)
+    if not parts:
+        raise ValueError(f"Invalid path in upload: {name}")
+    return '/'.join(parts)
+
+
+def remote_extract_command(location, compression=None):
+    """Shell command extracting a tar read from stdin into location."""
+    flags = {None: '-xf', 'gzip': '-xzf'}[compression]
+    location = shlex.quote(location)
+    return f"mkdir -p {location} && tar -C {location} {flags} -"
+
+
+def remote_tar_available(ssh_client):
+    """Whether tar can be run on the remote host over an exec channel."""
+    try:
+        _, stdout, _ = ssh_client.exec_command("command -v tar >/dev/null")
+    except Exception as e:
+        # No exec on this server (e.g. SFTP only)
+        print(f"Folder upload falling back to SFTP: {str(e)}")
+        return False
+    status = ssh_client.wait_exit_status(stdout.channel)
+    if status != 0:
+        print(f"Folder upload falling back to SFTP: no tar on the remote host (status {status})")
+    return status == 0
+
+
+class RemoteTar:
+    """
+    tar -x running on the remote host, fed over an exec channel. Writes are
+    buffered so that many small members go out in a few large packets.
+    """
+
+    def __init__(self, ssh_client, location, compression=None, buffer_size=256 * 1024):
+        self.ssh_client = ssh_client
+        # Keep stdin referenced: closing it (also on garbage collection)
+        # would send EOF to tar
+        self.stdin, stdout, self.stderr = ssh_client.exec_command(
+            remote_extract_command(location, compression))
+        self.channel = stdout.channel
+        self.buffer = bytearray()
+        self.buffer_size = buffer_size
+
+    def _error(self):
+        return self.stderr.read().decode(errors='replace').strip()
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        if self.channel.exit_status_ready():
+            raise IOError(f"Remote tar exited early: {self._error()}")
+        self.channel.sendall(bytes(self.buffer))
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            self._flush()
+
+    def add_file(self, rel, data, mode=0o644):
+        info = tarfile.TarInfo(rel)
+        info.size = len(data)
+        info.mode = mode
+        info.mtime = time.time()
+        self.write(info.tobuf(format=tarfile.PAX_FORMAT))
+        self.write(data)
+        remainder = len(data) % BLOCKSIZE
+        if remainder:
+            self.write(b'\0' * (BLOCKSIZE - remainder))
+
+    def add_dir(self, rel, mode=0o755):
+        info = tarfile.TarInfo(rel)
+        info.type = tarfile.DIRTYPE
+        info.mode = mode
+        info.mtime = time.time()
+        self.write(info.tobuf(format=tarfile.PAX_FORMAT))
+
+    def close(self, end_archive=True):
+        """Finish the archive and wait for tar; raises IOError if it failed."""
+        try:
+            if end_archive:
+                self.write(b'\0' * (2 * BLOCKSIZE))
+            self._flush()
+            self.channel.shutdown_write()
+            status = self.ssh_client.wait_exit_status(self.channel)
+            if status != 0:
+                raise IOError(f"Remote tar exited with status {status}: {self._error()}")
+        finally:
+            self.channel.close()
+
+    def abort(self):
+        self.channel.close()
+
+
+class FolderUpload:
+    """
+    Receives the files of a tree one part at a time and writes them below
+    location. Blocking; every method runs on the host's executor.
+    """
+
+    def __init__(self, ssh_client, location, mode='auto', small_file_limit=1024 * 1024, workers=8,
+                 compression=None):
+        if mode not in MODES:
+            raise ValueError(f"Unknown upload mode: {mode}")
+        self.ssh_client = ssh_client
+        self.location = location.rstrip('/') or '/'
+        self.base = '' if self.location == '/' else self.location
+        self.mode = mode
+        # Whether small files are packed into a remote tar; probed on first use
+        self.packing = None
+        self.small_file_limit = small_file_limit
+        self.workers = workers
+        self.compression = compression
+        self.started = time.time()
+
+        self.tar = None
+        self.executor = None
+        self.channels = None
+        self.pending = []
+        self.made_dirs = set()
+
+        # The file part being received
+        self.rel = None
+        self.buffer = None
+        self.remote_file = None
+        self.remote_path = None
+
+        self.stats = {'files': 0, 'directories': 0, 'bytes': 0, 'packed': 0}
+
+    def _remote(self, rel):
+        return self.base + '/' + rel
+
+    def _makedirs(self, rel_dir):
+        """
+        Create location/rel_dir and its parents over SFTP, skipping the ones
+        already created by this upload.
+        """
+        path = ''
+        for part in [p for p in (self.base + '/' + rel_dir).split('/') if p]:
+            path = path + '/' + part
+            if path in self.made_dirs:
+                continue
+            with self.ssh_client.sftp_pool.acquire() as sftp:
+                try:
+                    sftp.mkdir(path)
+                except IOError:
+                    # Most likely it exists already; a real problem shows up
+                    # when the first file is opened
+                    pass
+            self.made_dirs.add(path)
+
+    def _packing(self):
+        if self.mode != 'auto':
+            return False
+        if self.packing is None:
+            self.packing = remote_tar_available(self.ssh_client)
+        return self.packing
+
+    def _tar(self):
+        if self.tar is None:
+            self.tar = RemoteTar(self.ssh_client, self.location, self.compression)
+        return self.tar
+
+    def _write_small(self, rel, data):
+        sftp = self.channels.get()
+        with sftp.open(self._remote(rel), 'wb') as f:
+            f.set_pipelined(True)
+            f.write(data)
+
+    def _submit(self, rel, data):
+        if self.executor is None:
+            self.executor = ssh_executor.for_client(self.ssh_client)
+            self.channels = WorkerChannels(self.ssh_client)
+        # Bound the files held in memory and the jobs queued on the host
+        while len(self.pending) >= self.workers:
+            self.pending.pop(0).result()
+        self.pending.append(self.executor.submit(self._write_small, rel, data))
+
+    def feed(self, events):
+        """Handle a list of MultipartStream events."""
+        for event, value in events:
+            if event == 'begin':
+                self.begin(value)
+            elif event == 'data':
+                self.write(value)
+            elif event == 'end':
+                self.end()
+
+    def begin(self, name):
+        self.rel = None
+        if not name:
+            # A plain form field
+            return
+        if name.replace('\\', '/').endswith('/'):
+            self.add_dir(clean_relative_path(name))
+            return
+        self.rel = clean_relative_path(name)
+        self.buffer = bytearray()
+
+    def write(self, data):
+        if self.rel is None:
+            return
+        self.stats['bytes'] += len(data)
+        if self.remote_file is not None:
+            self.remote_file.write(data)
+            return
+        self.buffer += data
+        if len(self.buffer) > self.small_file_limit:
+            # Too large to pack: stream the rest of it over SFTP
+            self._makedirs(self.rel.rpartition('/')[0])
+            self.remote_path = self._remote(self.rel)
+            self.remote_file = self.ssh_client.open_write(self.remote_path)
+            self.remote_file.write(bytes(self.buffer))
+            self.buffer = None
+
+    def end(self):
+        if self.rel is None:
+            return
+        rel, self.rel = self.rel, None
+        self.stats['files'] += 1
+        if self.remote_file is not None:
+            f, self.remote_file = self.remote_file, None
+            f.close()
+            return
+        data, self.buffer = bytes(self.buffer), None
+        if self._packing():
+            self._tar().add_file(rel, data)
+            self.stats['packed'] += 1
+        else:
+            self._makedirs(rel.rpartition('/')[0])
+            self._submit(rel, data)
+
+    def add_dir(self, rel):
+        self.stats['directories'] += 1
+        if self._packing():
+            self._tar().add_dir(rel)
+        else:
+            self._makedirs(rel)
+
+    def write_raw(self, data):
+        """Forward a chunk of a client supplied tar stream."""
+        self.stats['bytes'] += len(data)
+        self._tar().write(data)
+
+    def finish(self, end_archive=True):
+        """Wait for outstanding writes and remote extraction; returns stats."""
+        try:
+            while self.pending:
+                self.pending.pop(0).result()
+            if self.tar is not None:
+                tar, self.tar = self.tar, None
+                tar.close(end_archive)
+        finally:
+            self._shutdown()
+        return dict(self.stats, seconds=round(time.time() - self.started, 3))
+
+    def abort(self):
+        """Stop after a failure; a partially written large file is removed."""
+        if self.remote_file is not None:
+            try:
+                self.remote_file.close()
+                self.ssh_client.remove_file(self.remote_path)
+            except Exception:
+                pass
+            self.remote_file = None
+        if self.tar is not None:
+            self.tar.abort()
+            self.tar = None
+        for task in self.pending:
+            task.cancel()
+        self.pending = []
+        self._shutdown()
+
+    def _shutdown(self):
+        # Writes still pending after a failure must not outlive their channels
+        for task in self.pending:
+            task.cancel()
+        self.pending = []
+        if self.executor is not None:
+            self.channels.close()
+            self.executor = None
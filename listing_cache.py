@@ -0,0 +1,87 @@
+# listing_cache.py
+"""
+Per-session cache of directory listings.
+
+Entries are keyed by (session key, directory) and expire after a TTL. Routes
+that change the remote tree invalidate the directories they touch. Each
+listing carries an ETag so unchanged listings can be answered with 304.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_dir(path):
+    """Canonical form of a directory path: no trailing slash, '/' for root."""
+    path = path.rstrip('/')
+    return path if path else '/'
+
+
+def parent_dir(path):
+    path = normalize_dir(path)
+    pos = path.rfind('/')
+    return path[:pos] if pos > 0 else '/'
+
+
+def listing_etag(files):
+    body = json.dumps(files, sort_keys=True, separators=(',', ':')).encode()
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+class DirectoryCache:
+    def __init__(self, ttl=30, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (key, path) -> (expires, etag, files)
+        self.lock = threading.Lock()
+
+    def get(self, key, path):
+        """Return (etag, files) for a fresh entry, or None."""
+        cache_key = (key, normalize_dir(path))
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[cache_key]
+                return None
+            self.entries.move_to_end(cache_key)
+            return entry[1], entry[2]
+
+    def put(self, key, path, files):
+        """Store a listing and return its ETag."""
+        etag = listing_etag(files)
+        with self.lock:
+            self.entries[(key, normalize_dir(path))] = (time.monotonic() + self.ttl, etag, files)
+            self.entries.move_to_end((key, normalize_dir(path)))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return etag
+
+    def invalidate(self, key, path, subtree=False):
+        """
+        Drop the listing of a directory, and with subtree=True also every
+        listing below it (used when a directory is removed or renamed).
+        """
+        path = normalize_dir(path)
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            for cache_key in list(self.entries):
+                if cache_key[0] != key:
+                    continue
+                if cache_key[1] == path or (subtree and cache_key[1].startswith(prefix)):
+                    del self.entries[cache_key]
+
+    def invalidate_entry(self, key, path):
+        """A file or directory at path changed: drop its parent and its subtree."""
+        self.invalidate(key, parent_dir(path))
+        self.invalidate(key, path, subtree=True)
+
+    def clear(self, key):
+        with self.lock:
+            for cache_key in list(self.entries):
+                if cache_key[0] == key:
+                    del self.entries[cache_key]
@@ -0,0 +1,223 @@
+# listing_stream.py
+"""
+Streaming and paginated listings for very large remote directories.
+
+Directories are read incrementally with SFTP listdir_iter, in batches, and
+filtered on the gateway as they arrive. Entries are kept as compact tuples
+(name, size, mtime, is_dir) and only turned into the JSON file items the UI
+expects when they are sent.
+
+Two modes are offered:
+- NDJSON: one file item per line, streamed as the directory is read
+  (or once, sorted, when a sort order is requested).
+- Cursor pages: a listing snapshot is read in the background and pages
+  are served from it; unsorted pages are answered as soon as enough
+  entries have arrived.
+"""
+
+import asyncio
+import functools
+import json
+import secrets
+import stat
+import time
+from collections import OrderedDict
+
+SORT_KEYS = {
+    'name': lambda e: e[0],
+    'size': lambda e: e[1],
+    'mTime': lambda e: e[2],
+    # Directories first, then by name
+    'type': lambda e: (not e[3], e[0])
+}
+
+
+@functools.lru_cache(maxsize=65536)
+def format_mtime(mtime):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mtime))
+
+
+def entry_tuple(attr):
+    return (attr.filename, attr.st_size, attr.st_mtime or 0, stat.S_ISDIR(attr.st_mode or 0))
+
+
+def file_item(remote_dir, entry):
+    """Build the file item dict used by /listFiles from an entry tuple."""
+    name, size, mtime, is_dir = entry
+    base = '' if remote_dir == '/' else remote_dir
+    return {
+        'name': name,
+        'path': base + '/' + name,
+        'size': size,
+        'mTime': format_mtime(int(mtime)),
+        'type': 'dir' if is_dir else 'file'
+    }
+
+
+def make_filter(prefix=None, file_type=None, min_size=None, max_size=None,
+                mtime_after=None, mtime_before=None):
+    """Return a predicate over entry tuples for the given server-side filters."""
+    def predicate(entry):
+        name, size, mtime, is_dir = entry
+        if prefix and not name.startswith(prefix):
+            return False
+        if file_type == 'dir' and not is_dir:
+            return False
+        if file_type == 'file' and is_dir:
+            return False
+        if min_size is not None and size < min_size:
+            return False
+        if max_size is not None and size > max_size:
+            return False
+        if mtime_after is not None and mtime < mtime_after:
+            return False
+        if mtime_before is not None and mtime > mtime_before:
+            return False
+        return True
+    return predicate
+
+
+def ndjson_lines(batches, remote_dir, predicate, sort_by=None, descending=False, chunk_entries=1000):
+    """
+    Blocking generator turning batches of SFTPAttributes into NDJSON chunks.
+    Unsorted listings are emitted batch by batch as they are read; sorted
+    ones once the whole directory has been read.
+    """
+    try:
+        if sort_by is None:
+            for batch in batches:
+                lines = [json.dumps(file_item(remote_dir, e)) for e in map(entry_tuple, batch) if predicate(e)]
+                if lines:
+                    yield ('\n'.join(lines) + '\n').encode()
+            return
+
+        entries = []
+        for batch in batches:
+            entries.extend(e for e in map(entry_tuple, batch) if predicate(e))
+        entries.sort(key=SORT_KEYS[sort_by], reverse=descending)
+        for pos in range(0, len(entries), chunk_entries):
+            lines = [json.dumps(file_item(remote_dir, e)) for e in entries[pos:pos + chunk_entries]]
+            yield ('\n'.join(lines) + '\n').encode()
+    finally:
+        batches.close()
+
+
+class ListingSnapshot:
+    """
+    A directory listing being read in the background, from which cursor
+    pages are served.
+    """
+
+    def __init__(self, key, remote_dir, predicate, sort_by=None, descending=False):
+        self.id = secrets.token_urlsafe(12)
+        self.key = key
+        self.remote_dir = remote_dir
+        self.predicate = predicate
+        self.sort_by = sort_by
+        self.descending = descending
+        self.entries = []
+        self.done = False
+        self.error = None
+        self.stopped = False
+        self.is_sorted = False
+        self.last_access = time.monotonic()
+        self.loop = asyncio.get_running_loop()
+        self.updated = asyncio.Event()
+
+    def read(self, batches):
+        """Blocking reader, run on the host's executor."""
+        try:
+            for batch in batches:
+                if self.stopped:
+                    break
+                self.entries.extend(e for e in map(entry_tuple, batch) if self.predicate(e))
+                self.loop.call_soon_threadsafe(self.updated.set)
+        except Exception as e:
+            self.error = e
+        finally:
+            batches.close()
+            self.done = True
+            self.loop.call_soon_threadsafe(self.updated.set)
+
+    def reader_finished(self, task):
+        """
+        Done-callback of the task running read(). If the reader never got to
+        run (e.g. the host's executor was busy), the snapshot fails with the
+        task's error instead of leaving pages waiting for it.
+        """
+        if self.done:
+            return
+        if task.cancelled():
+            self.error = IOError("Directory listing was cancelled")
+        else:
+            self.error = task.exception() or IOError("Directory listing stopped")
+        self.done = True
+        self.updated.set()
+
+    async def _wait_for(self, count):
+        while not self.done and len(self.entries) < count:
+            self.updated.clear()
+            if self.done or len(self.entries) >= count:
+                break
+            await self.updated.wait()
+
+    async def page(self, offset, limit):
+        """
+        Return (file items, next offset or None, total or None). The total
+        is only known once the whole directory has been read.
+        """
+        self.last_access = time.monotonic()
+        if self.sort_by is not None:
+            await self._wait_for(float('inf'))
+            if not self.is_sorted and self.error is None:
+                self.entries.sort(key=SORT_KEYS[self.sort_by], reverse=self.descending)
+                self.is_sorted = True
+        else:
+            await self._wait_for(offset + limit + 1)
+        if self.error is not None:
+            raise self.error
+
+        items = [file_item(self.remote_dir, e) for e in self.entries[offset:offset + limit]]
+        next_offset = offset + limit
+        if self.done and next_offset >= len(self.entries):
+            next_offset = None
+        total = len(self.entries) if self.done else None
+        return items, next_offset, total
+
+
+class SnapshotRegistry:
+    def __init__(self, ttl=120, max_snapshots=64):
+        self.ttl = ttl
+        self.max_snapshots = max_snapshots
+        self.snapshots = OrderedDict()
+
+    def add(self, snapshot):
+        self.expire()
+        self.snapshots[snapshot.id] = snapshot
+        while len(self.snapshots) > self.max_snapshots:
+            _, old = self.snapshots.popitem(last=False)
+            old.stopped = True
+        return snapshot
+
+    def get(self, snapshot_id):
+        self.expire()
+        snapshot = self.snapshots.get(snapshot_id)
+        if snapshot is not None:
+            self.snapshots.move_to_end(snapshot_id)
+        return snapshot
+
+    def expire(self):
+        now = time.monotonic()
+        for snapshot_id, snapshot in list(self.snapshots.items()):
+            if now - snapshot.last_access > self.ttl:
+                snapshot.stopped = True
+                del self.snapshots[snapshot_id]
+
+
+def encode_cursor(snapshot_id, offset):
+    return f"{snapshot_id}:{offset}"
+
+
+def decode_cursor(cursor):
+    snapshot_id, _, offset = cursor.rpartition(':')
+    return snapshot_id, int(offset)
@@ -1,18 +1,38 @@
 # local_sftp.py - A simple SFTP server using FastAPI and Paramiko
 
-from fastapi import FastAPI, File, Form, UploadFile, Request
-from fastapi.responses import HTMLResponse, FileResponse, RedirectResponse
+from fastapi import FastAPI, Request, Query
+from fastapi.responses import FileResponse, RedirectResponse, StreamingResponse, Response, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from typing import List
+from starlette.background import BackgroundTask
+from multipart.multipart import MultipartParser, parse_options_header
+from typing import List, Optional
 import uvicorn
+import asyncio
 import os
 import json
 import time
 import paramiko
 import stat
+import threading
+import contextlib
+import email.utils
+from urllib.parse import quote
 from pydantic import BaseModel
 import shared_state
+import upload_sessions
+import ssh_executor
+import metrics
+from connection_manager import ConnectionManager
+from listing_cache import DirectoryCache, parent_dir, normalize_dir
+from download_cache import DownloadCache, cache_key
+import listing_stream
+import archive_stream
+import folder_upload
+import delta_sync
+import checksum
+import transport_tuning
+from parallel_transfer import parallel_iter_file, ParallelWriter
 
 # Models
 class Client(BaseModel):
@@ -24,11 +44,42 @@ class ArgListFiles(BaseModel):
     hostIp: str
     username: str
     location: str
+    refresh: bool = False
+
+class ArgListQuery(BaseModel):
+    hostIp: str
+    username: str
+    location: str = '/'
+    # Server-side filters
+    prefix: Optional[str] = None
+    type: Optional[str] = None
+    minSize: Optional[int] = None
+    maxSize: Optional[int] = None
+    mtimeAfter: Optional[float] = None
+    mtimeBefore: Optional[float] = None
+    # Sorting: name, size, mTime or type
+    sortBy: Optional[str] = None
+    order: str = 'asc'
+    # Pagination
+    limit: int = 500
+    cursor: Optional[str] = None
 
 class ArgGetFile(BaseModel):
     hostIp: str
     username: str
     remotePath: str
+    concurrency: Optional[int] = None
+    # Checksum algorithm of the remote file to send in an X-Checksum-* header
+    verify: Optional[str] = None
+
+class ArgGetDirectory(BaseModel):
+    hostIp: str
+    username: str
+    path: str
+    format: str = 'tar'
+    compression: Optional[str] = None
+    # 'sftp' walks the tree over SFTP, 'remote' runs tar on the remote host
+    mode: str = 'sftp'
 
 class ArgPath(BaseModel):
     hostIp: str
@@ -41,6 +92,23 @@ class ArgOpNp(BaseModel):
     oldPath: str
     newPath: str
 
+class ArgChecksum(BaseModel):
+    hostIp: str
+    username: str
+    paths: List[str] = []
+    path: Optional[str] = None
+    algorithm: Optional[str] = None
+    # 'auto' (remote command if available, else SFTP), 'remote' or 'sftp'
+    mode: Optional[str] = None
+
+class ArgUploadSession(BaseModel):
+    hostIp: str
+    username: str
+    location: str
+    filename: str
+    size: Optional[int] = None
+    chunkSize: int = 8 * 1024 * 1024
+
 class RetCls:
     @classmethod
     def ret(cls, status=False, msg='', data={}):
@@ -50,29 +118,249 @@ class RetCls:
             'data': data
         }
 
+class MultipartStream:
+    """
+    Incremental multipart/form-data parser. Raw body chunks are fed in and
+    the part events found in them are returned, so file contents can be
+    forwarded as they arrive instead of being spooled to memory or disk.
+    
+    Events are ('begin', filename), ('data', bytes) and ('end', None);
+    filename is None for plain form fields. File names are reduced to their
+    last component unless keep_paths is set (folder uploads).
+    """
+    def __init__(self, content_type, keep_paths=False):
+        _, params = parse_options_header(content_type)
+        boundary = params.get(b'boundary')
+        if not boundary:
+            raise ValueError("Missing multipart boundary")
+        
+        self.keep_paths = keep_paths
+        self.events = []
+        self._field = b''
+        self._value = b''
+        self._headers = {}
+        self.parser = MultipartParser(boundary, callbacks={
+            'on_part_begin': self._on_part_begin,
+            'on_header_field': self._on_header_field,
+            'on_header_value': self._on_header_value,
+            'on_header_end': self._on_header_end,
+            'on_headers_finished': self._on_headers_finished,
+            'on_part_data': self._on_part_data,
+            'on_part_end': self._on_part_end,
+        })
+    
+    def _on_part_begin(self):
+        self._headers = {}
+    
+    def _on_header_field(self, data, start, end):
+        self._field += data[start:end]
+    
+    def _on_header_value(self, data, start, end):
+        self._value += data[start:end]
+    
+    def _on_header_end(self):
+        self._headers[self._field.lower()] = self._value
+        self._field = b''
+        self._value = b''
+    
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b'content-disposition', b''))
+        filename = options.get(b'filename')
+        if filename is not None:
+            filename = filename.decode('utf-8', 'replace').replace('\\', '/')
+            if not self.keep_paths:
+                # Never let the client pick a path outside the target directory
+                filename = filename.split('/')[-1]
+        self.events.append(('begin', filename or None))
+    
+    def _on_part_data(self, data, start, end):
+        if self.events and self.events[-1][0] == 'data':
+            self.events[-1] = ('data', self.events[-1][1] + data[start:end])
+        else:
+            self.events.append(('data', data[start:end]))
+    
+    def _on_part_end(self):
+        self.events.append(('end', None))
+    
+    def feed(self, chunk):
+        self.parser.write(chunk)
+        events, self.events = self.events, []
+        return events
+    
+    def finalize(self):
+        self.parser.finalize()
+
+class LockedSFTPFile:
+    """
+    Wraps an SFTPFile so that every call holds the owning client's SFTP lock.
+    paramiko's SFTPClient can't be driven from several threads at once.
+    """
+    def __init__(self, f, lock):
+        self.f = f
+        self.lock = lock
+    
+    def write(self, data):
+        with self.lock:
+            return self.f.write(data)
+    
+    def readv(self, chunks):
+        with self.lock:
+            return list(self.f.readv(chunks))
+    
+    def read_ahead(self, offset, length, chunk_size, depth):
+        """
+        Yield `length` bytes from offset in chunks, with reads kept in flight
+        ahead of the data consumed. The range is read in batches of half of
+        `depth`, each a readv() of chunk_size blocks, and a batch is only
+        consumed once the next one has been requested, so the pipeline never
+        drains between batches. The lock isn't held while a chunk is being
+        consumed.
+        """
+        end = offset + length
+        batch_size = max(chunk_size, depth // 2)
+        
+        def request(start):
+            """readv() a batch; returns its blocks with the first one read, which sends every request."""
+            stop = min(start + batch_size, end)
+            blocks = self.f.readv([(pos, min(chunk_size, stop - pos)) for pos in range(start, stop, chunk_size)])
+            return blocks, next(blocks, b'')
+        
+        with self.lock:
+            current = request(offset)
+        pos = offset
+        start = offset + batch_size
+        while current is not None:
+            blocks, data = current
+            with self.lock:
+                current = request(start) if start < end else None
+            while data:
+                pos += len(data)
+                yield data
+                with self.lock:
+                    data = next(blocks, b'')
+            if pos < min(start, end):
+                # The file ended early
+                return
+            start += batch_size
+    
+    def seek(self, offset):
+        with self.lock:
+            self.f.seek(offset)
+    
+    def truncate(self, size):
+        with self.lock:
+            self.f.truncate(size)
+    
+    def stat(self):
+        with self.lock:
+            return self.f.stat()
+    
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+class SFTPChannelPool:
+    """
+    A small pool of SFTP channels multiplexed over one transport. Each
+    channel has its own lock, so concurrent requests for the same session
+    run on different channels instead of queueing on a single SFTPClient.
+    """
+    def __init__(self, transport, max_channels=4):
+        self.transport = transport
+        self.max_channels = max(1, max_channels)
+        self.lock = threading.Lock()
+        self.channels = []
+        self.next_index = 0
+        self._open_channel()
+    
+    def _open_channel(self):
+        channel = (paramiko.SFTPClient.from_transport(self.transport), threading.RLock())
+        self.channels.append(channel)
+        return channel
+    
+    @contextlib.contextmanager
+    def acquire(self):
+        """
+        Check out an idle channel for a short operation, opening a new one
+        if all are busy and the pool isn't full yet.
+        """
+        channel = None
+        with self.lock:
+            for candidate in self.channels:
+                if candidate[1].acquire(blocking=False):
+                    channel = candidate
+                    break
+            else:
+                if len(self.channels) < self.max_channels:
+                    channel = self._open_channel()
+                    channel[1].acquire()
+        if channel is None:
+            # Every channel is busy: queue on the next one in turn
+            with self.lock:
+                channel = self.channels[self.next_index % len(self.channels)]
+                self.next_index += 1
+            channel[1].acquire()
+        try:
+            yield channel[0]
+        finally:
+            channel[1].release()
+    
+    def for_handle(self):
+        """
+        Pick a channel for a long-lived file handle. The handle's calls take
+        the channel's lock one at a time (see LockedSFTPFile).
+        """
+        with self.lock:
+            if len(self.channels) < self.max_channels:
+                return self._open_channel()
+            channel = self.channels[self.next_index % len(self.channels)]
+            self.next_index += 1
+            return channel
+    
+    def open_dedicated(self):
+        """
+        Open an SFTP channel outside the pool for an operation that needs
+        exclusive use of its channel for a long time. The caller closes it.
+        """
+        return paramiko.SFTPClient.from_transport(self.transport)
+    
+    def close(self):
+        with self.lock:
+            for sftp, _ in self.channels:
+                try:
+                    sftp.close()
+                except Exception:
+                    pass
+            self.channels = []
+
 # SSH Client
 class SSHBoxClient:
-    def __init__(self, ip='', port=22, username='root', password=''):
+    def __init__(self, ip='', port=22, username='root', password='', max_sftp_channels=4):
         self.ip = ip
         self.port = port
         self.username = username
         self.password = password
         
-        # Create transport with faster window size
-        self.t = paramiko.Transport((self.ip, self.port))
-        self.t.window_size = 3 * 1024 * 1024
+        # Window, packet size and compression start from what was learned
+        # about this host; compression is only negotiated at key exchange
+        self.tuner = transport_tuning.Tuner(f"{self.ip}:{self.port}")
+        window, packet_size, compress = self.tuner.connect_settings()
+        self.t = paramiko.Transport((self.ip, self.port), default_window_size=window,
+                                    default_max_packet_size=packet_size)
         self.t.packetizer.REKEY_BYTES = pow(2, 40)
         self.t.packetizer.REKEY_PACKETS = pow(2, 40)
+        self.t.use_compression(compress)
         
         self.t.connect(username=self.username, password=self.password)
-        self.t.use_compression()
-        self.sftp = paramiko.SFTPClient.from_transport(self.t)
+        self.tuner.attach(self.t)
         
-        # Set up SSH client for command execution
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self.ssh.connect(self.ip, self.port, self.username, self.password)
+        # SFTP, exec and shell channels are all multiplexed over this one
+        # authenticated transport. Each SFTP channel has its own lock since
+        # paramiko's SFTPClient can't be driven from several threads at once.
+        self.sftp_pool = SFTPChannelPool(self.t, max_sftp_channels)
+        self.sftp, self.sftp_lock = self.sftp_pool.channels[0]
     
+    @metrics.timed("listdir")
     def get_all_files_in_remote_dir(self, remote_dir):
         all_files = []
 
@@ -82,34 +370,68 @@ class SSHBoxClient:
         if remote_dir == '':
             remote_dir = '/'
 
-        files = self.sftp.listdir_attr(remote_dir)
+        with self.sftp_pool.acquire() as sftp:
+            files = sftp.listdir_attr(remote_dir)
 
         for x in files:
-            if remote_dir == '/':
-                remote_dir = ''
-
-            filename = remote_dir + '/' + x.filename
-            file_item = {}
-            file_item['name'] = x.filename
-            file_item['path'] = filename
-            file_item['size'] = x.st_size
-            file_item['mTime'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(x.st_mtime))
-
-            if stat.S_ISDIR(x.st_mode):
-                file_item['type'] = 'dir'
-            else:
-                file_item['type'] = 'file'
-            all_files.append(file_item)
+            all_files.append(listing_stream.file_item(remote_dir, listing_stream.entry_tuple(x)))
         return all_files
     
+    def iter_remote_dir(self, remote_dir, batch_size=1000, read_aheads=50):
+        """
+        Yield batches of SFTPAttributes for a directory as they are read.
+        listdir_iter reads raw packets off its channel, so it gets a
+        dedicated SFTP channel instead of one from the pool.
+        """
+        sftp = self.sftp_pool.open_dedicated()
+        try:
+            batch = []
+            for attr in sftp.listdir_iter(remote_dir, read_aheads=read_aheads):
+                batch.append(attr)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        finally:
+            sftp.close()
+    
+    @metrics.timed("put")
     def put(self, local_path='', remote_path=''):
         try:
-            self.sftp.put(localpath=local_path, remotepath=remote_path)
+            with self.sftp_pool.acquire() as sftp:
+                sftp.put(localpath=local_path, remotepath=remote_path)
             return True
         except Exception as e:
             print(f"Error uploading file: {str(e)}")
             return False
     
+    @metrics.timed("open")
+    def open_write(self, remote_path):
+        """
+        Open a remote file for writing with pipelined requests, so writes are
+        sent without waiting for each acknowledgement.
+        """
+        sftp, lock = self.sftp_pool.for_handle()
+        with lock, self.tuner.round_trip():
+            f = sftp.open(remote_path, 'wb')
+        f.set_pipelined(True)
+        return LockedSFTPFile(f, lock)
+    
+    @metrics.timed("open")
+    def open_at(self, remote_path, offset):
+        """
+        Open an existing remote file for pipelined writes starting at offset,
+        without truncating it.
+        """
+        sftp, lock = self.sftp_pool.for_handle()
+        with lock:
+            f = sftp.open(remote_path, 'r+b')
+            f.seek(offset)
+            f.set_pipelined(True)
+        return LockedSFTPFile(f, lock)
+    
+    @metrics.timed("get")
     def get_file(self, remote_path='', local_path=''):
         try:
             pos = remote_path.rfind('/')
@@ -119,20 +441,108 @@ class SSHBoxClient:
                 local_path = local_path[:-1]
                 
             save_path = local_path + local_filename
-            self.sftp.get(remote_path, save_path)
+            with self.sftp_pool.acquire() as sftp:
+                sftp.get(remote_path, save_path)
             return True
         except Exception as e:
             print(f"Error downloading file: {str(e)}")
             return False
     
+    @metrics.timed("stat")
+    def stat(self, remote_path):
+        with self.sftp_pool.acquire() as sftp, self.tuner.round_trip():
+            return sftp.stat(remote_path)
+    
+    def iter_file(self, remote_path, offset=0, length=None, chunk_size=32768, window=8 * 1024 * 1024):
+        """
+        Yield the contents of a remote file straight from SFTP, starting at
+        offset. Up to a window of reads is kept in flight ahead of the data
+        consumed, so memory use stays bounded by the window size no matter
+        how large the file is.
+        """
+        sftp, lock = self.sftp_pool.for_handle()
+        with lock:
+            f = LockedSFTPFile(sftp.open(remote_path, 'rb'), lock)
+        try:
+            if length is None:
+                length = f.stat().st_size - offset
+            yield from f.read_ahead(offset, length, chunk_size, window)
+        finally:
+            f.close()
+    
+    def start_transfer(self, filename=None, sample=None):
+        """
+        Tune the connection for a file transfer (see transport_tuning) and
+        return the decisions made. Pair with end_transfer().
+        """
+        return self.tuner.start(filename, sample)
+    
+    def end_transfer(self, size, seconds):
+        self.tuner.finish(size, seconds)
+    
+    def tuned_transfer(self, chunks, filename=None):
+        """Pass a blocking iterator of transfer chunks through, tuning the connection for it."""
+        self.start_transfer(filename)
+        started = time.perf_counter()
+        size = 0
+        try:
+            for data in chunks:
+                size += len(data)
+                yield data
+        finally:
+            self.end_transfer(size, time.perf_counter() - started)
+    
+    @metrics.timed("rename")
     def rename(self, old_path, new_path):
         try:
-            self.sftp.rename(old_path, new_path)
+            with self.sftp_pool.acquire() as sftp:
+                sftp.rename(old_path, new_path)
             return True
         except Exception as e:
             print(f"Error renaming: {str(e)}")
             return False
     
+    @metrics.timed("rename")
+    def replace(self, old_path, new_path):
+        """
+        Move old_path over new_path. Uses the atomic posix-rename extension
+        when the server supports it.
+        """
+        with self.sftp_pool.acquire() as sftp:
+            try:
+                sftp.posix_rename(old_path, new_path)
+                return True
+            except IOError:
+                pass
+            try:
+                try:
+                    sftp.remove(new_path)
+                except IOError:
+                    pass
+                sftp.rename(old_path, new_path)
+                return True
+            except Exception as e:
+                print(f"Error replacing file: {str(e)}")
+                return False
+    
+    @metrics.timed("remove")
+    def remove_file(self, file_path):
+        """Remove a single remote file over SFTP."""
+        with self.sftp_pool.acquire() as sftp:
+            sftp.remove(file_path)
+    
+    def wait_exit_status(self, channel):
+        """
+        Wait for a remote command to finish. If the request that started it
+        is cancelled, stop waiting and close the channel.
+        """
+        while not channel.status_event.wait(0.2):
+            if ssh_executor.cancelled():
+                channel.close()
+                raise ssh_executor.ClientDisconnected("Command cancelled")
+        return channel.recv_exit_status()
+    
+    @metrics.timed("remove_tree")
     def remove(self, file_path):
         if file_path == '/':
             print(f"Cannot delete root directory")
@@ -151,9 +561,9 @@ class SSHBoxClient:
                 
         try:
             print(f"Attempting to delete: {file_path}")
-            stdin, stdout, stderr = self.ssh.exec_command(f'rm -rf "{file_path}"')
+            stdin, stdout, stderr = self.exec_command(f'rm -rf "{file_path}"')
             # Wait for the command to complete
-            exit_status = stdout.channel.recv_exit_status()
+            exit_status = self.wait_exit_status(stdout.channel)
             error = stderr.read().decode().strip()
             
             if exit_status != 0 or error:
@@ -163,8 +573,8 @@ class SSHBoxClient:
             # Verify the file was actually deleted
             try:
                 # Try to stat the file - if this succeeds, it wasn't deleted
-                _, _, stderr = self.ssh.exec_command(f'stat "{file_path}"')
-                exit_status = stderr.channel.recv_exit_status()
+                _, _, stderr = self.exec_command(f'stat "{file_path}"')
+                exit_status = self.wait_exit_status(stderr.channel)
                 
                 if exit_status == 0:  # File still exists
                     print(f"File still exists after deletion attempt")
@@ -177,18 +587,21 @@ class SSHBoxClient:
             print(f"Error removing: {str(e)}")
             return False
     
+    @metrics.timed("mkdir")
     def mkdir(self, dir_path):
         try:
-            self.sftp.mkdir(dir_path)
+            with self.sftp_pool.acquire() as sftp:
+                sftp.mkdir(dir_path)
             return True
         except Exception as e:
             print(f"Error creating directory: {str(e)}")
             return False
     
+    @metrics.timed("history")
     def get_history(self):
         try:
             rets = []
-            _, stdout, _ = self.ssh.exec_command("cat ~/.bash_history")
+            _, stdout, _ = self.exec_command("cat ~/.bash_history")
             for item in stdout.readlines():
                 if item[0] == '#':
                     continue
@@ -198,10 +611,11 @@ class SSHBoxClient:
             print(f"Error getting history: {str(e)}")
             return []
     
+    @metrics.timed("df")
     def get_df(self):
         try:
             rets = []
-            _, stdout, _ = self.ssh.exec_command("df -lh")
+            _, stdout, _ = self.exec_command("df -lh")
             for item in stdout.readlines():
                 rets.append(item.strip())
             return rets
@@ -209,10 +623,27 @@ class SSHBoxClient:
             print(f"Error getting disk usage: {str(e)}")
             return []
     
+    @metrics.timed("exec")
+    def exec_command(self, command, timeout=None):
+        """
+        Run a command on a new session channel of the shared transport.
+        Returns (stdin, stdout, stderr) like SSHClient.exec_command.
+        """
+        chan = self.t.open_session(timeout=timeout)
+        chan.settimeout(timeout)
+        chan.exec_command(command)
+        stdin = chan.makefile_stdin('wb', -1)
+        stdout = chan.makefile('r', -1)
+        stderr = chan.makefile_stderr('r', -1)
+        return stdin, stdout, stderr
+    
+    def is_active(self):
+        return self.t.is_active()
+    
     def close(self):
         try:
+            self.sftp_pool.close()
             self.t.close()
-            self.ssh.close()
         except:
             pass
     
@@ -234,17 +665,148 @@ config = {
     "tmp_path": "./dtmp/",
     "upload_tmp_path": "./utmp/",
     "share_path": "./share/",
-    "port": 8000
+    "port": 8000,
+    # Terminal WebSocket port when running the unified server
+    "terminal_port": 8888,
+    "stream_downloads": True,
+    # Local cache of downloaded files, by host, user, path, size and mtime
+    "download_cache": True,
+    "download_cache_path": "./dtmp/cache/",
+    "download_cache_bytes": 4 * 1024 ** 3,
+    "download_cache_max_file": 1024 ** 3,
+    "download_chunk_size": 32768,
+    "download_window": 8 * 1024 * 1024,
+    "upload_session_ttl": 24 * 3600,
+    # Parallel multi-channel transfers for large files
+    "transfer_concurrency": 4,
+    "max_transfer_concurrency": 16,
+    "host_transfer_concurrency": {},
+    "parallel_threshold": 16 * 1024 * 1024,
+    "parallel_segment_size": 4 * 1024 * 1024,
+    # SFTP channels multiplexed over each session's transport
+    "sftp_channels": 4,
+    # Per-host worker pools for blocking SSH/SFTP calls
+    "executor_workers": 8,
+    "executor_max_queue": 32,
+    "executor_max_wait": 30,
+    # SSH connection pool
+    "max_connections": 256,
+    "connection_idle_timeout": 1800,
+    "keepalive_interval": 30,
+    "reap_interval": 60,
+    # Directory listing cache
+    "listing_cache_ttl": 30,
+    "listing_cache_entries": 10000,
+    # Streaming / paginated listings
+    "listing_batch_size": 1000,
+    "listing_read_aheads": 50,
+    "listing_snapshot_ttl": 120,
+    "listing_max_page": 5000,
+    # Directory archive downloads
+    "archive_workers": 8,
+    "archive_small_file_limit": 1024 * 1024,
+    "archive_lookahead": 16 * 1024 * 1024,
+    # Folder uploads: 'auto' packs small files into a tar extracted remotely,
+    # 'sftp' writes every file over SFTP
+    "folder_upload_mode": "auto",
+    "folder_small_file_limit": 1024 * 1024,
+    "folder_upload_workers": 8,
+    # Delta uploads: block size of the signatures of the remote file, and
+    # 'auto' (remote python3 if available, else SFTP), 'remote' or 'sftp'
+    "delta_block_size": 64 * 1024,
+    "delta_mode": "auto",
+    # Remote checksums: md5, sha1, sha256 or xxhash, computed by 'auto'
+    # (remote command if available, else SFTP), 'remote' or 'sftp'
+    "checksum_algorithm": "sha256",
+    "checksum_mode": "auto",
+    "checksum_workers": 4,
+    "checksum_max_paths": 1000,
+    # Compare every upload with a checksum of the remote file afterwards
+    "verify_transfers": False,
+    # Per-host window, packet size, compression and download prefetch,
+    # learned from the round trip time and throughput of each host
+    "transport_tuning": True,
+    "transport_min_window": 8 * 1024 * 1024,
+    "transport_max_window": 32 * 1024 * 1024,
+    # Links slower than this (bytes/s) compress data that compresses
+    "transport_compress_below": 4 * 1024 * 1024
 }
 
-# Client database to store connections
-client_db = {}
+ssh_executor.configure(
+    workers=config["executor_workers"],
+    max_queue=config["executor_max_queue"],
+    max_wait=config["executor_max_wait"]
+)
+
+transport_tuning.configure(
+    enabled=config["transport_tuning"],
+    default_window=config["download_window"],
+    min_window=config["transport_min_window"],
+    max_window=config["transport_max_window"],
+    compress_below=config["transport_compress_below"]
+)
+
+async def connect_client(credentials):
+    ssh_client = await ssh_executor.for_host(credentials["host_ip"], credentials["port"]).run(
+        SSHBoxClient, ip=credentials["host_ip"], port=credentials["port"],
+        username=credentials["username"], password=credentials["password"],
+        max_sftp_channels=config["sftp_channels"])
+    return ssh_client
+
+async def close_client(ssh_client):
+    await ssh_executor.run(ssh_client, ssh_client.close)
+
+# Client database to store connections: a bounded LRU pool that reaps idle
+# sessions and reconnects dead ones from the credentials in shared_state
+client_db = ConnectionManager(
+    connect_client, close_client,
+    max_size=config["max_connections"],
+    idle_timeout=config["connection_idle_timeout"],
+    keepalive_interval=config["keepalive_interval"]
+)
+
+@contextlib.contextmanager
+def holding(key, ssh_client):
+    """Keep a session from being reaped as idle or evicted while a transfer runs on it."""
+    held = client_db.hold(key, ssh_client)
+    try:
+        yield
+    finally:
+        if held is not None:
+            client_db.release(key, held)
+
+async def held_chunks(key, ssh_client, chunks):
+    """Async iterator over chunks that holds the session until it is exhausted or closed."""
+    with holding(key, ssh_client):
+        async for data in chunks:
+            yield data
+
+# Per-session directory listing cache
+dir_cache = DirectoryCache(config["listing_cache_ttl"], config["listing_cache_entries"])
+
+# Downloaded files kept on local disk; loaded at startup
+download_cache = DownloadCache(config["download_cache_bytes"], config["download_cache_max_file"])
+
+# Listing snapshots backing cursor-based pages
+listing_snapshots = listing_stream.SnapshotRegistry(config["listing_snapshot_ttl"])
 
 # Ensure directories exist
 for directory in [config["tmp_path"], config["upload_tmp_path"], config["share_path"]]:
     if not os.path.exists(directory):
         os.makedirs(directory)
 
+# Scrape-time gauges for the session pool
+metrics.CallbackGauge("sftp_sessions", "SSH sessions in client_db.", lambda: len(client_db))
+metrics.CallbackGauge("sftp_sessions_held", "SSH sessions held by terminals and transfers.",
+                      lambda: client_db.snapshot()["held"])
+metrics.CallbackGauge("sftp_upload_sessions", "Resumable upload sessions in progress.",
+                      lambda: len(upload_sessions.upload_sessions))
+metrics.CallbackGauge("download_cache_bytes", "Bytes in the download cache, including fills in progress.",
+                      lambda: download_cache.used)
+
+# Request timing for /metrics
+app.add_middleware(metrics.MetricsMiddleware)
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -266,9 +828,17 @@ async def login(client: Client):
             ip = client.hostIp
             port = 22
             
-        ssh_client = SSHBoxClient(ip=ip, port=port, username=client.username, password=client.password)
         key = client.hostIp + client.username
-        client_db[key] = ssh_client
+        existing = client_db.peek(key)
+        if existing is not None and existing.password == client.password and existing.is_active():
+            # Reuse the already authenticated transport for this (host, user)
+            ssh_client = existing
+        else:
+            ssh_client = await connect_client({
+                "host_ip": ip, "port": port,
+                "username": client.username, "password": client.password
+            })
+            await client_db.put(key, ssh_client)
         
         # Save to shared state
         shared_state.save_client(key, ip, port, client.username, client.password)
@@ -283,20 +853,222 @@ async def login(client: Client):
         return RetCls.ret(False, str(e), {})
 
 @app.post("/listFiles")
-async def list_files(arg_list_files: ArgListFiles):
+async def list_files(arg_list_files: ArgListFiles, request: Request):
     try:
         key = arg_list_files.hostIp + arg_list_files.username
-        if key not in client_db:
+        ssh_client = await client_db.get(key)
+        if ssh_client is None:
             return RetCls.ret(False, "Not logged in", {})
-            
-        ssh_client = client_db[key]
-        all_files = ssh_client.get_all_files_in_remote_dir(arg_list_files.location)
-        return RetCls.ret(True, '', all_files)
+        
+        cached = None if arg_list_files.refresh else dir_cache.get(key, arg_list_files.location)
+        if cached is not None:
+            etag, all_files = cached
+        else:
+            all_files = await ssh_executor.run(ssh_client, ssh_client.get_all_files_in_remote_dir,
+                                               arg_list_files.location, request=request)
+            etag = dir_cache.put(key, arg_list_files.location, all_files)
+        
+        # The client already has this listing
+        if request.headers.get('if-none-match') == etag:
+            return Response(status_code=304, headers={'ETag': etag})
+        return JSONResponse(RetCls.ret(True, '', all_files), headers={'ETag': etag})
     except Exception as e:
         return RetCls.ret(False, str(e), [{}])
 
+def listing_filter(arg):
+    if arg.sortBy is not None and arg.sortBy not in listing_stream.SORT_KEYS:
+        raise ValueError(f"Unknown sort field: {arg.sortBy}")
+    if arg.type not in (None, 'file', 'dir'):
+        raise ValueError(f"Unknown type filter: {arg.type}")
+    return listing_stream.make_filter(arg.prefix, arg.type, arg.minSize, arg.maxSize,
+                                      arg.mtimeAfter, arg.mtimeBefore)
+
+@app.post("/listFilesStream")
+async def list_files_stream(arg: ArgListQuery):
+    """
+    Stream a directory listing as NDJSON, one file item per line, while the
+    directory is still being read.
+    """
+    try:
+        key = arg.hostIp + arg.username
+        ssh_client = await client_db.get(key)
+        if ssh_client is None:
+            return RetCls.ret(False, "Not logged in", {})
+        
+        predicate = listing_filter(arg)
+        remote_dir = normalize_dir(arg.location)
+        batches = ssh_client.iter_remote_dir(remote_dir, config["listing_batch_size"],
+                                             config["listing_read_aheads"])
+        lines = listing_stream.ndjson_lines(batches, remote_dir, predicate,
+                                            arg.sortBy, arg.order == 'desc')
+        body = ssh_executor.for_client(ssh_client).iterate(lines)
+        return StreamingResponse(body, media_type='application/x-ndjson')
+    except Exception as e:
+        return RetCls.ret(False, str(e), {})
+
+@app.post("/listFilesPage")
+async def list_files_page(arg: ArgListQuery):
+    """
+    Cursor-based pages of a directory listing. The first request starts
+    reading the directory in the background and returns as soon as the
+    first page is available; follow-up requests pass the returned cursor.
+    """
+    try:
+        key = arg.hostIp + arg.username
+        limit = max(1, min(arg.limit, config["listing_max_page"]))
+        
+        if arg.cursor:
+            snapshot_id, offset = listing_stream.decode_cursor(arg.cursor)
+            snapshot = listing_snapshots.get(snapshot_id)
+            if snapshot is None or snapshot.key != key:
+                return RetCls.ret(False, "Listing cursor expired", {})
+        else:
+            ssh_client = await client_db.get(key)
+            if ssh_client is None:
+                return RetCls.ret(False, "Not logged in", {})
+            
+            remote_dir = normalize_dir(arg.location)
+            snapshot = listing_stream.ListingSnapshot(key, remote_dir, listing_filter(arg),
+                                                      arg.sortBy, arg.order == 'desc')
+            batches = ssh_client.iter_remote_dir(remote_dir, config["listing_batch_size"],
+                                                 config["listing_read_aheads"])
+            snapshot.task = asyncio.ensure_future(ssh_executor.run(ssh_client, snapshot.read, batches))
+            snapshot.task.add_done_callback(snapshot.reader_finished)
+            listing_snapshots.add(snapshot)
+            offset = 0
+        
+        files, next_offset, total = await snapshot.page(offset, limit)
+        next_cursor = None
+        if next_offset is not None:
+            next_cursor = listing_stream.encode_cursor(snapshot.id, next_offset)
+        return RetCls.ret(True, '', {
+            'files': files,
+            'nextCursor': next_cursor,
+            'total': total,
+            'complete': snapshot.done
+        })
+    except Exception as e:
+        return RetCls.ret(False, str(e), {})
+
+def transfer_concurrency(ssh_client, requested=None):
+    """
+    Number of SFTP channels to use for a transfer: the per-request value if
+    given, otherwise the per-host setting, otherwise the default. Raises
+    ValueError if it is outside 1..max_transfer_concurrency.
+    """
+    if requested is None:
+        hosts = config["host_transfer_concurrency"]
+        requested = hosts.get(f"{ssh_client.ip}:{ssh_client.port}",
+                              hosts.get(ssh_client.ip, config["transfer_concurrency"]))
+    concurrency = int(requested)
+    if not 1 <= concurrency <= config["max_transfer_concurrency"]:
+        raise ValueError(f"Concurrency must be between 1 and {config['max_transfer_concurrency']}")
+    return concurrency
+
+def download_concurrency(ssh_client, requested, length):
+    """Channels a download of length bytes actually uses; only large ones are split."""
+    concurrency = transfer_concurrency(ssh_client, requested)
+    return concurrency if length >= config["parallel_threshold"] else 1
+
+def open_upload_target(ssh_client, remote_path, concurrency):
+    if concurrency > 1:
+        return ParallelWriter(ssh_client, remote_path, concurrency, config["parallel_segment_size"])
+    return ssh_client.open_write(remote_path)
+
+def verify_algorithm(requested=None):
+    """
+    Checksum algorithm to verify a transfer with: the per-request value (an
+    algorithm name, or true for the default one), otherwise the
+    verify_transfers setting. None if the transfer isn't verified.
+    """
+    if requested is None:
+        requested = config["verify_transfers"]
+    if not requested:
+        return None
+    algorithm = config["checksum_algorithm"] if requested is True else requested
+    checksum.check_options(algorithm)
+    return algorithm
+
+async def verify_upload(ssh_client, remote_path, writer):
+    """Compare an uploaded file with the digest of the data a HashingWriter passed on."""
+    return await ssh_executor.run(ssh_client, checksum.verify, ssh_client, remote_path,
+                                  writer.algorithm, writer.hexdigest(), config["checksum_mode"],
+                                  config["download_chunk_size"], config["download_window"])
+
+async def stream_upload(request, ssh_client, location, concurrency=1, verify=None):
+    """
+    Stream every file part of a multipart request straight into a remote
+    file, chunk by chunk, without staging it locally. With concurrency > 1
+    the data is written over several SFTP channels in parallel. With verify
+    (a checksum algorithm) the data is hashed on the way through and each
+    file is compared with a checksum of the remote file once written. The
+    connection is tuned for each file from its first chunk of data.
+    Returns one dict per uploaded file with its name and size, and its
+    verification result and tuning decisions if there were any.
+    """
+    stream = MultipartStream(request.headers.get('content-type', ''))
+    uploaded = []
+    item = None
+    remote_file = None
+    remote_path = None
+    filename = None
+    started = time.perf_counter()
+    size = 0
+    # Start time and size of the file the connection is tuned for
+    file_started = None
+    file_size = 0
+    try:
+        async for chunk in request.stream():
+            for event, value in stream.feed(chunk):
+                if event == 'begin' and value:
+                    filename = value
+                    remote_path = location.rstrip('/') + '/' + filename
+                    remote_file = await ssh_executor.run(ssh_client, open_upload_target,
+                                                         ssh_client, remote_path, concurrency)
+                    if verify:
+                        remote_file = checksum.HashingWriter(remote_file, verify)
+                    item = {'filename': filename}
+                    file_size = 0
+                elif event == 'data' and remote_file is not None:
+                    if file_started is None:
+                        item['transport'] = await ssh_executor.run(ssh_client, ssh_client.start_transfer,
+                                                                   filename, value)
+                        file_started = time.perf_counter()
+                    await ssh_executor.run(ssh_client, remote_file.write, value)
+                    size += len(value)
+                    file_size += len(value)
+                elif event == 'end' and remote_file is not None:
+                    f, remote_file = remote_file, None
+                    await ssh_executor.run(ssh_client, f.close)
+                    if file_started is not None:
+                        await ssh_executor.run(ssh_client, ssh_client.end_transfer,
+                                               file_size, time.perf_counter() - file_started)
+                        file_started = None
+                    item['size'] = file_size
+                    if verify:
+                        item['verify'] = await verify_upload(ssh_client, remote_path, f)
+                    uploaded.append(item)
+        stream.finalize()
+        return uploaded
+    except Exception:
+        if file_started is not None:
+            # finish() saves the host's profile; keep that write off the loop
+            await asyncio.shield(ssh_executor.run(ssh_client, ssh_client.end_transfer, 0, 0))
+        # Don't leave a truncated file behind on the remote
+        if remote_file is not None:
+            def discard():
+                try:
+                    remote_file.close()
+                    ssh_client.remove_file(remote_path)
+                except Exception:
+                    pass
+            await asyncio.shield(ssh_executor.run(ssh_client, discard))
+        raise
+    finally:
+        metrics.record_transfer('upload', size, time.perf_counter() - started)
+
 @app.post("/uploadfile")
-async def upload_file(request: Request, file: UploadFile = File(...)):
+async def upload_file(request: Request):
     try:
         # Get upload parameters from headers
         upload_params = json.loads(request.headers.get('upload-params', '{}'))
@@ -306,64 +1078,638 @@ async def upload_file(request: Request, file: UploadFile = File(...)):
         
         if not all([host_ip, username, location]):
             return RetCls.ret(False, "Missing upload parameters", {})
+        verify = verify_algorithm(upload_params.get('verify'))
         
         key = host_ip + username
-        if key not in client_db:
+        ssh_client = await client_db.get(key)
+        if ssh_client is None:
             return RetCls.ret(False, "Not logged in", {})
         
-        ssh_client = client_db[key]
-        
-        # Save uploaded file temporarily
-        local_path = os.path.join(config["upload_tmp_path"], file.filename)
-        with open(local_path, 'wb') as f:
-            content = await file.read()
-            f.write(content)
         
-        # Upload to remote server
-        remote_path = location + '/' + file.filename
-        success = ssh_client.put(local_path, remote_path)
+        # Only large files are worth spreading over several channels
+        concurrency = transfer_concurrency(ssh_client, upload_params.get('concurrency'))
+        if int(request.headers.get('file-size') or 0) < config["parallel_threshold"]:
+            concurrency = 1
         
-        # Clean up temporary file
-        os.remove(local_path)
+        # Stream the multipart body directly to the remote server
+        try:
+            with holding(key, ssh_client):
+                uploaded = await stream_upload(request, ssh_client, location, concurrency, verify)
+        finally:
+            dir_cache.invalidate(key, location)
         
-        if success:
-            return RetCls.ret(True, "File uploaded successfully", {"filename": file.filename})
+        if uploaded:
+            # The first file's fields stay at the top level for existing clients
+            data = dict(uploaded[0], files=uploaded, concurrency=concurrency)
+            del data["size"]
+            return RetCls.ret(True, "File uploaded successfully", data)
         else:
             return RetCls.ret(False, "Failed to upload file", {})
+    except checksum.ChecksumMismatch as e:
+        print(f"Error uploading file: {str(e)}")
+        return RetCls.ret(False, str(e), {"verify": e.result})
     except Exception as e:
+        print(f"Error uploading file: {str(e)}")
         return RetCls.ret(False, str(e), {})
 
-@app.post("/getFile")
-async def get_file(arg_get_file: ArgGetFile):
+async def stream_folder_upload(request, ssh_client, location, mode):
+    """
+    Write every file part of a multipart request below location, keeping
+    the relative paths given as file names. Returns upload statistics.
+    """
+    upload = folder_upload.FolderUpload(ssh_client, location, mode,
+                                        small_file_limit=config["folder_small_file_limit"],
+                                        workers=config["folder_upload_workers"])
+    stream = MultipartStream(request.headers.get('content-type', ''), keep_paths=True)
     try:
-        key = arg_get_file.hostIp + arg_get_file.username
-        if key not in client_db:
+        async for chunk in request.stream():
+            events = stream.feed(chunk)
+            if events:
+                await ssh_executor.run(ssh_client, upload.feed, events)
+        stream.finalize()
+        return await ssh_executor.run(ssh_client, upload.finish)
+    except Exception:
+        await asyncio.shield(ssh_executor.run(ssh_client, upload.abort))
+        raise
+
+async def stream_tar_upload(request, ssh_client, location, compression=None):
+    """Extract a tar request body below location on the remote host."""
+    upload = folder_upload.FolderUpload(ssh_client, location, compression=compression)
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                await ssh_executor.run(ssh_client, upload.write_raw, chunk)
+        return await ssh_executor.run(ssh_client, upload.finish, False)
+    except Exception:
+        await asyncio.shield(ssh_executor.run(ssh_client, upload.abort))
+        raise
+
+@app.post("/uploadFolder")
+async def upload_folder(request: Request):
+    """
+    Upload a directory tree in one request: either multipart/form-data
+    with relative paths as file names, or an application/x-tar (or
+    application/gzip) body.
+    """
+    try:
+        upload_params = json.loads(request.headers.get('upload-params', '{}'))
+        host_ip = upload_params.get('hostIp', '')
+        username = upload_params.get('username', '')
+        location = upload_params.get('location', '')
+        mode = upload_params.get('mode') or config["folder_upload_mode"]
+        
+        if not all([host_ip, username, location]):
+            return RetCls.ret(False, "Missing upload parameters", {})
+        
+        key = host_ip + username
+        ssh_client = await client_db.get(key)
+        if ssh_client is None:
             return RetCls.ret(False, "Not logged in", {})
-            
-        ssh_client = client_db[key]
-        pos = arg_get_file.remotePath.rfind('/')
-        file_name = arg_get_file.remotePath[pos:]
         
-        success = ssh_client.get_file(arg_get_file.remotePath, config["tmp_path"])
+        content_type = request.headers.get('content-type', '')
+        try:
+            with holding(key, ssh_client):
+                if content_type.startswith('multipart/'):
+                    result = await stream_folder_upload(request, ssh_client, location, mode)
+                elif content_type.startswith('application/x-tar'):
+                    result = await stream_tar_upload(request, ssh_client, location)
+                elif content_type.startswith(('application/gzip', 'application/x-gzip')):
+                    result = await stream_tar_upload(request, ssh_client, location, 'gzip')
+                else:
+                    return RetCls.ret(False, f"Unsupported content type: {content_type}", {})
+        finally:
+            dir_cache.invalidate_entry(key, location)
+        
+        metrics.record_transfer('upload', result['bytes'], result['seconds'])
+        return RetCls.ret(True, "Folder uploaded successfully", result)
+    except Exception as e:
+        print(f"Error uploading folder: {str(e)}")
+        return RetCls.ret(False, str(e), {})
+
+async def stream_delta_upload(request, ssh_client, location, mode, verify=None):
+    """
+    Upload the file part of a multipart request as a delta against the
+    existing remote file of the same name, verifying the result with a
+    checksum if verify is given. Returns the upload statistics.
+    """
+    stream = MultipartStream(request.headers.get('content-type', ''))
+    delta = None
+    result = None
+    try:
+        async for chunk in request.stream():
+            for event, value in stream.feed(chunk):
+                if event == 'begin' and value:
+                    if delta is not None or result is not None:
+                        raise ValueError("Delta uploads take one file per request")
+                    remote_path = location.rstrip('/') + '/' + value
+                    delta = await ssh_executor.run(ssh_client, delta_sync.DeltaUpload, ssh_client, remote_path,
+                                                   config["delta_block_size"], mode)
+                    if verify:
+                        delta = checksum.HashingWriter(delta, verify)
+                elif event == 'data' and delta is not None:
+                    await ssh_executor.run(ssh_client, delta.write, value)
+                elif event == 'end' and delta is not None:
+                    d, delta = delta, None
+                    result = await ssh_executor.run(ssh_client, d.finish)
+                    result['filename'] = value or remote_path[remote_path.rfind('/') + 1:]
+                    if verify:
+                        result['verify'] = await verify_upload(ssh_client, remote_path, d)
+        stream.finalize()
+        return result
+    except Exception:
+        if delta is not None:
+            await asyncio.shield(ssh_executor.run(ssh_client, delta.abort))
+        raise
+
+@app.post("/uploadDelta")
+async def upload_delta(request: Request):
+    """
+    Upload a file like /uploadfile, but only send the blocks that differ
+    from the remote file it replaces. The response reports the bytes saved.
+    """
+    try:
+        upload_params = json.loads(request.headers.get('upload-params', '{}'))
+        host_ip = upload_params.get('hostIp', '')
+        username = upload_params.get('username', '')
+        location = upload_params.get('location', '')
+        mode = upload_params.get('mode') or config["delta_mode"]
+        
+        if not all([host_ip, username, location]):
+            return RetCls.ret(False, "Missing upload parameters", {})
+        if mode not in ('auto', 'remote', 'sftp'):
+            return RetCls.ret(False, f"Unknown delta mode: {mode}", {})
+        verify = verify_algorithm(upload_params.get('verify'))
+        
+        key = host_ip + username
+        ssh_client = await client_db.get(key)
+        if ssh_client is None:
+            return RetCls.ret(False, "Not logged in", {})
+        
+        try:
+            with holding(key, ssh_client):
+                result = await stream_delta_upload(request, ssh_client, location, mode, verify)
+        finally:
+            dir_cache.invalidate(key, location)
+        
+        if result is None:
+            return RetCls.ret(False, "No file in request", {})
+        metrics.record_transfer('upload', result['size'], result['seconds'])
+        return RetCls.ret(True, "File uploaded successfully", result)
+    except checksum.ChecksumMismatch as e:
+        print(f"Error uploading delta: {str(e)}")
+        return RetCls.ret(False, str(e), {"verify": e.result})
+    except Exception as e:
+        print(f"Error uploading delta: {str(e)}")
+        return RetCls.ret(False, str(e), {})
+
+async def purge_expired_upload_sessions():
+    for session in upload_sessions.expired_sessions(config["upload_session_ttl"]):
+        ssh_client = client_db.peek(session.key)
+        if ssh_client is None:
+            continue
+        try:
+            await ssh_executor.run(ssh_client, ssh_client.remove_file, session.temp_path)
+        except Exception:
+            pass
+
+async def get_upload_session(upload_id):
+    """
+    Look up an upload session and the SSH client it belongs to.
+    Returns (session, ssh_client, error_response).
+    """
+    session = upload_sessions.get_session(upload_id)
+    if session is None:
+        return None, None, RetCls.ret(False, "Unknown upload session", {})
+    ssh_client = await client_db.get(session.key)
+    if ssh_client is None:
+        return session, None, RetCls.ret(False, "Not logged in", {})
+    return session, ssh_client, None
+
+@app.post("/uploadSession")
+async def create_upload_session(arg: ArgUploadSession):
+    try:
+        key = arg.hostIp + arg.username
+        ssh_client = await client_db.get(key)
+        if ssh_client is None:
+            return RetCls.ret(False, "Not logged in", {})
+        
+        filename = arg.filename.replace('\\', '/').split('/')[-1]
+        if filename in ('', '.', '..'):
+            return RetCls.ret(False, "Invalid file name", {})
+        if arg.chunkSize <= 0 or (arg.size is not None and arg.size < 0):
+            return RetCls.ret(False, "Invalid size or chunk size", {})
+        
+        await purge_expired_upload_sessions()
+        
+        session = upload_sessions.create_session(key, arg.location, filename, arg.size, arg.chunkSize)
+        try:
+            # Create the (empty) temporary file that chunks are written into
+            f = await ssh_executor.run(ssh_client, ssh_client.open_write, session.temp_path)
+            await ssh_executor.run(ssh_client, f.close)
+        except Exception:
+            upload_sessions.remove_session(session.id)
+            raise
+        
+        return RetCls.ret(True, "Upload session created", session.info())
+    except Exception as e:
+        return RetCls.ret(False, str(e), {})
+
+@app.put("/uploadSession/{upload_id}/chunk/{index}")
+async def upload_chunk(upload_id: str, index: int, request: Request, offset: Optional[int] = None):
+    try:
+        session, ssh_client, error = await get_upload_session(upload_id)
+        if error:
+            return error
+        
+        if offset is None:
+            offset = index * session.chunk_size
+        if index < 0 or offset < 0:
+            return RetCls.ret(False, "Invalid chunk offset", {})
+        
+        # Write the chunk body directly at its offset in the remote file
+        remote_file = await ssh_executor.run(ssh_client, ssh_client.open_at, session.temp_path, offset)
+        written = 0
+        started = time.perf_counter()
+        try:
+            with holding(session.key, ssh_client):
+                async for chunk in request.stream():
+                    if session.size is not None and offset + written + len(chunk) > session.size:
+                        raise ValueError("Chunk extends past the declared file size")
+                    await ssh_executor.run(ssh_client, remote_file.write, chunk)
+                    written += len(chunk)
+        finally:
+            # close() waits for the pipelined writes to be acknowledged
+            await asyncio.shield(ssh_executor.run(ssh_client, remote_file.close))
+            metrics.record_transfer('upload', written, time.perf_counter() - started)
+        
+        session.add_range(offset, offset + written)
+        return RetCls.ret(True, "Chunk stored", {
+            'index': index,
+            'offset': offset,
+            'length': written,
+            'received': session.received()
+        })
+    except Exception as e:
+        return RetCls.ret(False, str(e), {})
+
+@app.get("/uploadSession/{upload_id}")
+async def get_upload_session_status(upload_id: str):
+    session = upload_sessions.get_session(upload_id)
+    if session is None:
+        return RetCls.ret(False, "Unknown upload session", {})
+    return RetCls.ret(True, '', session.info())
+
+@app.post("/uploadSession/{upload_id}/finalize")
+async def finalize_upload_session(upload_id: str, expected: Optional[str] = Query(None, alias="checksum"),
+                                  algorithm: Optional[str] = None):
+    """
+    Move a complete upload into place. With ?checksum= (and optionally
+    &algorithm=) the assembled file is checked against the client's digest
+    first, and kept in the session if it doesn't match.
+    """
+    try:
+        session, ssh_client, error = await get_upload_session(upload_id)
+        if error:
+            return error
+        
+        if not session.is_complete():
+            return RetCls.ret(False, "Upload is incomplete", session.info())
+        
+        verified = None
+        if expected:
+            try:
+                verified = await ssh_executor.run(
+                    ssh_client, checksum.verify, ssh_client, session.temp_path,
+                    verify_algorithm(algorithm or True), expected, config["checksum_mode"],
+                    config["download_chunk_size"], config["download_window"])
+            except checksum.ChecksumMismatch as e:
+                return RetCls.ret(False, f"Checksum mismatch for {session.remote_path}",
+                                  dict(session.info(), verify=e.result))
+        
+        success = await ssh_executor.run(ssh_client, ssh_client.replace, session.temp_path, session.remote_path)
+        dir_cache.invalidate(session.key, session.location)
         if not success:
-            return RetCls.ret(False, "Failed to download file", {})
+            return RetCls.ret(False, "Failed to move file into place", session.info())
         
-        path = config["tmp_path"] + file_name
-        path = path.replace('//', '/')
+        upload_sessions.remove_session(session.id)
+        info = session.info()
+        if verified:
+            info['verify'] = verified
+        return RetCls.ret(True, "File uploaded successfully", info)
+    except Exception as e:
+        return RetCls.ret(False, str(e), {})
+
+@app.delete("/uploadSession/{upload_id}")
+async def abort_upload_session(upload_id: str):
+    try:
+        session, ssh_client, error = await get_upload_session(upload_id)
+        if session is not None:
+            upload_sessions.remove_session(session.id)
+        if error:
+            return error
+        
+        try:
+            await ssh_executor.run(ssh_client, ssh_client.remove_file, session.temp_path)
+        except IOError:
+            pass
+        return RetCls.ret(True, "Upload session aborted", {})
+    except Exception as e:
+        return RetCls.ret(False, str(e), {})
+
+def parse_range_header(range_header, file_size):
+    """
+    Parse a single "bytes=" Range header against the file size.
+    Returns an inclusive (start, end) tuple, None if the header should be
+    ignored (the whole file is served), or False if it is unsatisfiable.
+    """
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if first == '':
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length <= 0:
+                return False
+            return max(file_size - length, 0), file_size - 1
+        start = int(first)
+        end = int(last) if last != '' else file_size - 1
+    except ValueError:
+        return None
+    if start >= file_size:
+        return False
+    if start > end:
+        return None
+    return start, min(end, file_size - 1)
+
+async def checksum_headers(ssh_client, remote_path, algorithm, request=None):
+    """An X-Checksum-<Algorithm> header with the remote file's checksum to verify a download against."""
+    checksum.check_options(algorithm)
+    result = await ssh_executor.run(ssh_client, checksum.checksum_file, ssh_client, remote_path, algorithm,
+                                    config["checksum_mode"], config["download_chunk_size"],
+                                    config["download_window"], request=request)
+    return {'X-Checksum-' + algorithm.capitalize(): result['checksum']}
+
+async def stream_remote_file(key, ssh_client, remote_path, request, concurrency=None, extra_headers=None):
+    """
+    Build a StreamingResponse that reads remote_path directly from SFTP,
+    honoring Range / If-Range so interrupted downloads can be resumed.
+    """
+    attr = await ssh_executor.run(ssh_client, ssh_client.stat, remote_path, request=request)
+    if stat.S_ISDIR(attr.st_mode):
+        return RetCls.ret(False, "Cannot download a directory", {})
+    
+    file_size = attr.st_size
+    etag = '"%x-%x"' % (int(attr.st_mtime), file_size)
+    last_modified = email.utils.formatdate(attr.st_mtime, usegmt=True)
+    file_name = remote_path[remote_path.rfind('/') + 1:]
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Last-Modified': last_modified,
+        'Content-Disposition': "attachment; filename*=UTF-8''" + quote(file_name)
+    }
+    headers.update(extra_headers or {})
+    
+    byte_range = None
+    range_header = request.headers.get('range')
+    if range_header:
+        # Only honor the range if the client's copy is still current
+        if_range = request.headers.get('if-range')
+        if not if_range or if_range in (etag, last_modified):
+            byte_range = parse_range_header(range_header, file_size)
+    
+    if byte_range is False:
+        headers['Content-Range'] = f'bytes */{file_size}'
+        return Response(status_code=416, headers=headers)
+    
+    status_code = 200
+    start, length = 0, file_size
+    if byte_range:
+        start, end = byte_range
+        length = end - start + 1
+        status_code = 206
+        headers['Content-Range'] = f'bytes {start}-{end}/{file_size}'
+    headers['Content-Length'] = str(length)
+    parallel = download_concurrency(ssh_client, concurrency, length)
+    
+    # Cached copies are served without reading the remote file; a new fill
+    # is only started for downloads from the beginning of the file
+    entry = None
+    if config["download_cache"]:
+        digest = cache_key(ssh_client.ip, ssh_client.port, ssh_client.username,
+                           remote_path, file_size, attr.st_mtime)
+        open_chunks = None
+        if start == 0:
+            open_chunks = lambda: remote_file_chunks(key, ssh_client, remote_path, 0, file_size, concurrency)
+        entry = await download_cache.acquire(digest, file_size, open_chunks)
+    
+    if entry is not None:
+        body = cached_file_chunks(entry, start, length)
+    else:
+        body = remote_file_chunks(key, ssh_client, remote_path, start, length, concurrency)
+        headers['X-Transfer-Concurrency'] = str(parallel)
+    body = metrics.count_transfer(body, 'download')
+    return StreamingResponse(body, status_code=status_code, headers=headers,
+                             media_type='application/octet-stream')
+
+def remote_file_chunks(key, ssh_client, remote_path, start, length, concurrency=None):
+    """Async iterator over a byte range of a remote file, read on the host's pool."""
+    concurrency = download_concurrency(ssh_client, concurrency, length)
+    if concurrency > 1:
+        body = parallel_iter_file(
+            ssh_client, remote_path, start, length, concurrency,
+            segment_size=config["parallel_segment_size"],
+            chunk_size=config["download_chunk_size"]
+        )
+    else:
+        body = ssh_client.iter_file(
+            remote_path, start, length,
+            chunk_size=config["download_chunk_size"],
+            window=ssh_client.tuner.prefetch()
+        )
+    body = ssh_client.tuned_transfer(body, remote_path)
+    # Drive the blocking reads on the host's pool; starlette cancels the
+    # iteration when the client goes away.
+    return held_chunks(key, ssh_client, ssh_executor.for_client(ssh_client).iterate(body))
+
+async def cached_file_chunks(entry, start, length):
+    try:
+        async for data in entry.read(start, length):
+            yield data
+    finally:
+        download_cache.release(entry)
+
+async def download_file(key, remote_path, request, concurrency=None, verify=None):
+    ssh_client = await client_db.get(key)
+    if ssh_client is None:
+        return RetCls.ret(False, "Not logged in", {})
+    
+    # The client checks what it received against the remote file's checksum
+    headers = {}
+    if verify:
+        headers = await checksum_headers(ssh_client, remote_path, verify, request)
         
-        return FileResponse(path)
+    if config["stream_downloads"]:
+        return await stream_remote_file(key, ssh_client, remote_path, request, concurrency, headers)
+    
+    if config["download_cache"]:
+        # Fetch into the cache (or wait for a fetch already running) and
+        # send the cached copy
+        attr = await ssh_executor.run(ssh_client, ssh_client.stat, remote_path, request=request)
+        if stat.S_ISDIR(attr.st_mode):
+            return RetCls.ret(False, "Cannot download a directory", {})
+        digest = cache_key(ssh_client.ip, ssh_client.port, ssh_client.username,
+                           remote_path, attr.st_size, attr.st_mtime)
+        entry = await download_cache.acquire(
+            digest, attr.st_size,
+            lambda: remote_file_chunks(key, ssh_client, remote_path, 0, attr.st_size, concurrency))
+        if entry is not None:
+            try:
+                await entry.wait_complete()
+            except BaseException:
+                download_cache.release(entry)
+                raise
+            
+            async def release():
+                download_cache.release(entry)
+            return FileResponse(entry.path, filename=remote_path[remote_path.rfind('/') + 1:],
+                                headers=headers, background=BackgroundTask(release))
+    
+    pos = remote_path.rfind('/')
+    file_name = remote_path[pos:]
+    
+    with holding(key, ssh_client):
+        success = await ssh_executor.run(ssh_client, ssh_client.get_file, remote_path, config["tmp_path"],
+                                         request=request)
+    if not success:
+        return RetCls.ret(False, "Failed to download file", {})
+    
+    path = config["tmp_path"] + file_name
+    path = path.replace('//', '/')
+    
+    return FileResponse(path, headers=headers)
+
+@app.post("/getFile")
+async def get_file(arg_get_file: ArgGetFile, request: Request):
+    try:
+        key = arg_get_file.hostIp + arg_get_file.username
+        return await download_file(key, arg_get_file.remotePath, request, arg_get_file.concurrency,
+                                   arg_get_file.verify)
+    except Exception as e:
+        return RetCls.ret(False, str(e), {})
+
+@app.get("/getFile")
+async def get_file_by_query(hostIp: str, username: str, remotePath: str, request: Request,
+                            concurrency: Optional[int] = None, verify: Optional[str] = None):
+    # GET variant so browsers and curl -C - can resume downloads with Range
+    try:
+        return await download_file(hostIp + username, remotePath, request, concurrency, verify)
+    except Exception as e:
+        return RetCls.ret(False, str(e), {})
+
+async def download_directory(arg):
+    key = arg.hostIp + arg.username
+    ssh_client = await client_db.get(key)
+    if ssh_client is None:
+        return RetCls.ret(False, "Not logged in", {})
+    
+    compression = arg.compression or None
+    archive_stream.check_options(arg.format, compression, arg.mode)
+    remote_dir = normalize_dir(arg.path)
+    attr = await ssh_executor.run(ssh_client, ssh_client.stat, remote_dir)
+    if not stat.S_ISDIR(attr.st_mode):
+        return RetCls.ret(False, "Not a directory", {})
+    
+    if arg.mode == 'remote':
+        if arg.format != 'tar':
+            return RetCls.ret(False, "Remote mode only produces tar archives", {})
+        chunks = archive_stream.remote_tar_stream(ssh_client, remote_dir, compression)
+    elif arg.mode == 'sftp':
+        entries = archive_stream.iter_entries(
+            ssh_client, remote_dir,
+            workers=config["archive_workers"],
+            small_file_limit=config["archive_small_file_limit"],
+            lookahead_bytes=config["archive_lookahead"],
+            chunk_size=config["download_chunk_size"],
+            window=config["download_window"]
+        )
+        root_name = remote_dir.rstrip('/').split('/')[-1] or 'root'
+        if arg.format == 'zip':
+            chunks = archive_stream.zip_stream(entries, root_name, compression)
+        else:
+            chunks = archive_stream.tar_stream(entries, root_name, compression)
+    else:
+        return RetCls.ret(False, f"Unknown mode: {arg.mode}", {})
+    
+    file_name = archive_stream.archive_filename(remote_dir, arg.format, compression)
+    headers = {'Content-Disposition': "attachment; filename*=UTF-8''" + quote(file_name)}
+    body = held_chunks(key, ssh_client, ssh_executor.for_client(ssh_client).iterate(chunks))
+    body = metrics.count_transfer(body, 'download')
+    return StreamingResponse(body, headers=headers, media_type='application/octet-stream')
+
+@app.post("/getDirectory")
+async def get_directory(arg: ArgGetDirectory):
+    try:
+        return await download_directory(arg)
     except Exception as e:
         return RetCls.ret(False, str(e), {})
 
+@app.get("/getDirectory")
+async def get_directory_by_query(hostIp: str, username: str, path: str, format: str = 'tar',
+                                 compression: Optional[str] = None, mode: str = 'sftp'):
+    try:
+        arg = ArgGetDirectory(hostIp=hostIp, username=username, path=path,
+                              format=format, compression=compression, mode=mode)
+        return await download_directory(arg)
+    except Exception as e:
+        return RetCls.ret(False, str(e), {})
+
+@app.post("/checksum")
+async def get_checksums(arg: ArgChecksum, request: Request):
+    """
+    Checksums of one or many remote files, computed on the remote host if
+    possible and otherwise from SFTP reads. Files that can't be read get
+    an error instead of a checksum.
+    """
+    try:
+        key = arg.hostIp + arg.username
+        ssh_client = await client_db.get(key)
+        if ssh_client is None:
+            return RetCls.ret(False, "Not logged in", {})
+        
+        paths = list(arg.paths) + ([arg.path] if arg.path else [])
+        if not paths:
+            return RetCls.ret(False, "No paths given", [])
+        if len(paths) > config["checksum_max_paths"]:
+            return RetCls.ret(False, f"At most {config['checksum_max_paths']} paths per request", [])
+        algorithm = arg.algorithm or config["checksum_algorithm"]
+        mode = arg.mode or config["checksum_mode"]
+        checksum.check_options(algorithm, mode)
+        
+        results = await ssh_executor.run(ssh_client, checksum.checksums, ssh_client, paths, algorithm, mode,
+                                         config["checksum_workers"], config["download_chunk_size"],
+                                         config["download_window"], request=request)
+        failed = sum(1 for r in results if 'error' in r)
+        if failed:
+            return RetCls.ret(False, f"{failed} of {len(results)} checksums failed", results)
+        return RetCls.ret(True, '', results)
+    except Exception as e:
+        return RetCls.ret(False, str(e), [])
+
 @app.post("/mkdir")
-async def mkdir(arg_mkdir: ArgPath):
+async def mkdir(arg_mkdir: ArgPath, request: Request):
     try:
         key = arg_mkdir.hostIp + arg_mkdir.username
-        if key not in client_db:
+        ssh_client = await client_db.get(key)
+        if ssh_client is None:
             return RetCls.ret(False, "Not logged in", {})
             
-        ssh_client = client_db[key]
-        success = ssh_client.mkdir(arg_mkdir.path)
+        success = await ssh_executor.run(ssh_client, ssh_client.mkdir, arg_mkdir.path, request=request)
+        dir_cache.invalidate(key, parent_dir(arg_mkdir.path))
         
         if success:
             return RetCls.ret(True, "Directory created", {})
@@ -373,14 +1719,15 @@ async def mkdir(arg_mkdir: ArgPath):
         return RetCls.ret(False, str(e), {})
 
 @app.post("/remove")
-async def remove(arg_remove: ArgPath):
+async def remove(arg_remove: ArgPath, request: Request):
     try:
         key = arg_remove.hostIp + arg_remove.username
-        if key not in client_db:
+        ssh_client = await client_db.get(key)
+        if ssh_client is None:
             return RetCls.ret(False, "Not logged in", {})
             
-        ssh_client = client_db[key]
-        success = ssh_client.remove(arg_remove.path)
+        success = await ssh_executor.run(ssh_client, ssh_client.remove, arg_remove.path, request=request)
+        dir_cache.invalidate_entry(key, arg_remove.path)
         
         if success:
             return RetCls.ret(True, "File/directory removed", {})
@@ -390,14 +1737,16 @@ async def remove(arg_remove: ArgPath):
         return RetCls.ret(False, str(e), {})
 
 @app.post("/rename")
-async def rename(arg_rename: ArgOpNp):
+async def rename(arg_rename: ArgOpNp, request: Request):
     try:
         key = arg_rename.hostIp + arg_rename.username
-        if key not in client_db:
+        ssh_client = await client_db.get(key)
+        if ssh_client is None:
             return RetCls.ret(False, "Not logged in", {})
             
-        ssh_client = client_db[key]
-        success = ssh_client.rename(arg_rename.oldPath, arg_rename.newPath)
+        success = await ssh_executor.run(ssh_client, ssh_client.rename, arg_rename.oldPath, arg_rename.newPath, request=request)
+        dir_cache.invalidate_entry(key, arg_rename.oldPath)
+        dir_cache.invalidate_entry(key, arg_rename.newPath)
         
         if success:
             return RetCls.ret(True, "File/directory renamed", {})
@@ -407,31 +1756,58 @@ async def rename(arg_rename: ArgOpNp):
         return RetCls.ret(False, str(e), {})
 
 @app.post("/getHistory")
-async def get_history(arg: ArgPath):
+async def get_history(arg: ArgPath, request: Request):
     try:
         key = arg.hostIp + arg.username
-        if key not in client_db:
+        ssh_client = await client_db.get(key)
+        if ssh_client is None:
             return RetCls.ret(False, "Not logged in", {})
             
-        ssh_client = client_db[key]
-        history = ssh_client.get_history()
+        history = await ssh_executor.run(ssh_client, ssh_client.get_history, request=request)
         return RetCls.ret(True, '', history)
     except Exception as e:
         return RetCls.ret(False, str(e), [])
 
 @app.post("/getDf")
-async def get_df(arg: ArgPath):
+async def get_df(arg: ArgPath, request: Request):
     try:
         key = arg.hostIp + arg.username
-        if key not in client_db:
+        ssh_client = await client_db.get(key)
+        if ssh_client is None:
             return RetCls.ret(False, "Not logged in", {})
             
-        ssh_client = client_db[key]
-        df_info = ssh_client.get_df()
+        df_info = await ssh_executor.run(ssh_client, ssh_client.get_df, request=request)
         return RetCls.ret(True, '', df_info)
     except Exception as e:
         return RetCls.ret(False, str(e), [])
 
+@app.get("/connectionStats")
+async def connection_stats():
+    return RetCls.ret(True, '', client_db.snapshot())
+
+@app.get("/transportProfiles")
+async def transport_profiles():
+    """What was learned about each host and the transport settings it gets."""
+    profiles = await asyncio.to_thread(transport_tuning.profiles)
+    return RetCls.ret(True, '', profiles)
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.on_event("startup")
+async def start_connection_reaper():
+    app.state.reaper = asyncio.create_task(client_db.reap_forever(config["reap_interval"]))
+    app.state.lag_watcher = asyncio.create_task(metrics.watch_event_loop_lag())
+    if config["download_cache"]:
+        await asyncio.to_thread(download_cache.load, config["download_cache_path"])
+
+@app.on_event("shutdown")
+async def close_connections():
+    app.state.reaper.cancel()
+    app.state.lag_watcher.cancel()
+    await client_db.close_all()
+
 @app.get("/")
 async def main():
     return RedirectResponse("/static/index.html")
@@ -22,6 +22,24 @@ def is_port_in_use(port):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         return s.connect_ex(('localhost', port)) == 0
 
+# Wait until nothing listens on a port any more
+def wait_for_port_free(port, timeout=5):
+    deadline = time.monotonic() + timeout
+    while is_port_in_use(port) and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+# Readiness check: wait until the process accepts connections on all of its
+# ports. Returns False if it exits first or isn't ready within the timeout.
+def wait_until_ready(proc, ports, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            return False
+        if all(is_port_in_use(port) for port in ports):
+            return True
+        time.sleep(0.05)
+    return False
+
 # Kill a process listening on a specific port (Unix/Linux/macOS)
 def kill_process_on_port(port):
     if sys.platform.startswith('win'):
@@ -30,7 +48,7 @@ def kill_process_on_port(port):
             cmd = f"FOR /F \"tokens=5\" %P IN ('netstat -ano ^| findstr :{port}') DO TaskKill /PID %P /F"
             subprocess.run(cmd, shell=True)
             print(f"Attempted to kill process on port {port}")
-            time.sleep(1)  # Give it time to die
+            wait_for_port_free(port)
         except Exception as e:
             print(f"Failed to kill process on port {port}: {e}")
     else:
@@ -42,7 +60,7 @@ def kill_process_on_port(port):
                 kill_cmd = f"kill -9 {pid}"
                 subprocess.run(kill_cmd, shell=True)
                 print(f"Killed process {pid} on port {port}")
-                time.sleep(1)  # Give it time to die
+                wait_for_port_free(port)
         except Exception as e:
             print(f"Failed to kill process on port {port}: {e}")
 
@@ -81,40 +99,56 @@ if is_port_in_use(SFTP_PORT):
         print(f"Please free up port {SFTP_PORT} and try again.")
         sys.exit(1)
 
-# Launch the servers as separate processes
-terminal_server_cmd = ["python", "simple_terminal_server.py"]
-sftp_server_cmd = ["python", "-m", "uvicorn", "local_sftp:app", "--host", "0.0.0.0", "--port", str(SFTP_PORT)]
+# By default the SFTP API and the terminal server run in one process on one
+# event loop (unified_server.py), so terminals reuse the logged in SFTP
+# sessions. --workers N runs N such processes behind a session router
+# (worker_pool.py); --separate runs the two servers as two processes instead.
+if "--workers" in sys.argv:
+    workers = sys.argv[sys.argv.index("--workers") + 1]
+    servers = [
+        ("SFTP and terminal workers", ["python", "worker_pool.py", "--workers", workers, "--port", str(SFTP_PORT), "--terminal-port", str(TERMINAL_PORT)], [SFTP_PORT, TERMINAL_PORT])
+    ]
+elif "--separate" in sys.argv:
+    servers = [
+        ("Terminal server", ["python", "simple_terminal_server.py"], [TERMINAL_PORT]),
+        ("SFTP server", ["python", "-m", "uvicorn", "local_sftp:app", "--host", "0.0.0.0", "--port", str(SFTP_PORT)], [SFTP_PORT])
+    ]
+else:
+    servers = [
+        ("SFTP and terminal server", ["python", "-m", "uvicorn", "unified_server:app", "--host", "0.0.0.0", "--port", str(SFTP_PORT)], [SFTP_PORT, TERMINAL_PORT])
+    ]
+
+procs = []
+
+# Start a server and wait until it accepts connections
+def start_server(name, cmd, ports):
+    print(f"Starting {name} on port {', '.join(map(str, ports))}...")
+    proc = subprocess.Popen(cmd)
+    if not wait_until_ready(proc, ports):
+        print(f"ERROR: {name} failed to start!")
+        proc.terminate()
+        return None
+    return proc
+
+def stop_servers():
+    for proc in procs:
+        if proc is not None and proc.poll() is None:
+            proc.terminate()
+    for proc in procs:
+        if proc is not None:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
 
 try:
-    # Start the terminal server
-    print(f"Starting terminal server on port {TERMINAL_PORT}...")
-    terminal_proc = subprocess.Popen(terminal_server_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    
-    # Wait a moment to see if it starts
-    time.sleep(1)
-    if terminal_proc.poll() is not None:
-        # Process has terminated
-        stdout, stderr = terminal_proc.communicate()
-        print("ERROR: Terminal server failed to start!")
-        print("Stdout:", stdout.decode())
-        print("Stderr:", stderr.decode())
-        sys.exit(1)
-    
-    # Start the SFTP server
-    print(f"Starting SFTP server on port {SFTP_PORT}...")
-    sftp_proc = subprocess.Popen(sftp_server_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    
-    # Wait a moment to see if it starts
-    time.sleep(1)
-    if sftp_proc.poll() is not None:
-        # Process has terminated
-        stdout, stderr = sftp_proc.communicate()
-        print("ERROR: SFTP server failed to start!")
-        print("Stdout:", stdout.decode())
-        print("Stderr:", stderr.decode())
-        # Kill terminal server if SFTP server fails
-        terminal_proc.terminate()
-        sys.exit(1)
+    for name, cmd, ports in servers:
+        proc = start_server(name, cmd, ports)
+        if proc is None:
+            # Stop the servers already started
+            stop_servers()
+            sys.exit(1)
+        procs.append(proc)
     
     print("\n=== Servers Started Successfully ===")
     print(f"SFTP server is running at http://localhost:{SFTP_PORT}")
@@ -124,8 +158,7 @@ try:
     # Function to kill processes on exit
     def cleanup():
         print("\nShutting down servers...")
-        terminal_proc.terminate()
-        sftp_proc.terminate()
+        stop_servers()
         print("Servers stopped.")
     
     # Register cleanup function
@@ -134,22 +167,19 @@ try:
     # Keep the script running
     while True:
         # Check if processes are still running
-        if terminal_proc.poll() is not None:
-            print("WARNING: Terminal server has stopped unexpectedly. Restarting...")
-            terminal_proc = subprocess.Popen(terminal_server_cmd)
-        
-        if sftp_proc.poll() is not None:
-            print("WARNING: SFTP server has stopped unexpectedly. Restarting...")
-            sftp_proc = subprocess.Popen(sftp_server_cmd)
+        for i, (name, cmd, ports) in enumerate(servers):
+            if procs[i] is not None and procs[i].poll() is None:
+                continue
+            print(f"WARNING: {name} has stopped unexpectedly. Restarting...")
+            procs[i] = start_server(name, cmd, ports)
         
         time.sleep(2)  # Check every 2 seconds
         
 except KeyboardInterrupt:
     print("\nShutting down servers...")
     try:
-        terminal_proc.terminate()
-        sftp_proc.terminate()
+        stop_servers()
     except:
         pass
     print("Servers stopped.")
-    sys.exit(0)
\ No newline at end of file
+    sys.exit(0)
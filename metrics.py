@@ -0,0 +1,276 @@
+# metrics.py
+"""
+Prometheus-style metrics for the SFTP API and the terminal server.
+
+Metrics are plain counters, gauges and fixed-bucket histograms kept in this
+process and rendered in the Prometheus text format by the /metrics
+endpoints. Updating one takes a dict lookup and a short lock, cheap enough
+to leave on in production; label values are bounded (route templates, op
+names, hosts), never paths or user input.
+
+Values that already exist elsewhere (pool sizes, queue depths, terminal
+counts) are registered as callback gauges and read at scrape time.
+"""
+
+import asyncio
+import bisect
+import functools
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+THROUGHPUT_BUCKETS = tuple(2 ** n * 1024 for n in range(6, 21, 2))  # 64 KB/s .. 1 GB/s
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{n}="{v}"' for (n, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self.children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _render_child(self, values, child):
+        yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"
+
+
+class _Buckets:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _render_child(self, values, child):
+        with child.lock:
+            counts = list(child.counts)
+            total = child.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, [('le', _format_value(float(bound)))])
+            yield f"{self.name}_bucket{labels} {cumulative}"
+        labels = _format_labels(self.labelnames, values)
+        yield f"{self.name}_sum{labels} {_format_value(total)}"
+        yield f"{self.name}_count{labels} {cumulative}"
+
+
+class CallbackGauge(_Metric):
+    """
+    A gauge read at scrape time: fn() returns a number, or a dict mapping
+    label value tuples to numbers.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, fn, labelnames=()):
+        self.fn = fn
+        super().__init__(name, documentation, labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            result = self.fn()
+        except Exception as e:
+            print(f"Error collecting metric {self.name}: {str(e)}")
+            return lines
+        if not isinstance(result, dict):
+            result = {(): result}
+        for values, value in result.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}")
+        return lines
+
+
+def render():
+    """All metrics of this process in the Prometheus text format."""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# HTTP API
+http_request_seconds = Histogram(
+    "sftp_http_request_duration_seconds",
+    "Time to serve an API request, including streamed bodies, by route template.",
+    ["route", "method", "status"])
+
+# SFTP operations
+sftp_op_seconds = Histogram(
+    "sftp_operation_duration_seconds", "Duration of blocking SFTP/SSH operations by type.", ["op"])
+sftp_op_errors = Counter(
+    "sftp_operation_errors_total", "SFTP/SSH operations that raised, by type.", ["op"])
+
+# Transfers
+transfers = Counter("sftp_transfers_total", "Completed or aborted transfers.", ["direction"])
+transfer_bytes = Counter("sftp_transfer_bytes_total", "Bytes moved by transfers.", ["direction"])
+transfer_seconds = Histogram(
+    "sftp_transfer_duration_seconds", "Duration of transfers.", ["direction"])
+transfer_throughput = Histogram(
+    "sftp_transfer_throughput_bytes_per_second", "Throughput of transfers of at least 64 KB.",
+    ["direction"], buckets=THROUGHPUT_BUCKETS)
+
+# Event loop
+event_loop_lag = Histogram(
+    "event_loop_lag_seconds", "How late a periodic timer on the event loop fired.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+
+# Terminals
+terminal_bytes = Counter(
+    "terminal_bytes_total", "Terminal bytes: 'in' is typed input, 'out' is shell output.", ["direction"])
+
+
+def timed(op):
+    """Decorator recording the duration (and failures) of a blocking operation."""
+    def decorator(fn):
+        histogram = sftp_op_seconds.labels(op)
+        errors = sftp_op_errors.labels(op)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def record_transfer(direction, size, seconds):
+    transfers.labels(direction).inc()
+    transfer_bytes.labels(direction).inc(size)
+    transfer_seconds.labels(direction).observe(seconds)
+    if size >= 64 * 1024 and seconds > 0:
+        transfer_throughput.labels(direction).observe(size / seconds)
+
+
+async def count_transfer(chunks, direction):
+    """Pass an async iterator of chunks through, recording the transfer when it ends."""
+    started = time.perf_counter()
+    size = 0
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        record_transfer(direction, size, time.perf_counter() - started)
+
+
+async def watch_event_loop_lag(interval=0.5):
+    """Run forever on the loop, measuring how late a sleep wakes up."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(loop.time() - started - interval, 0.0))
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request by its route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router stores the matched route in the scope; mounts and
+            # unknown paths are grouped together
+            route = getattr(scope.get("route"), "path", "other")
+            http_request_seconds.labels(route, scope["method"], status).observe(time.perf_counter() - started)
@@ -0,0 +1,178 @@
+# parallel_transfer.py
+"""
+Parallel multi-channel transfers.
+
+A single SFTP channel is limited by its flow-control window and the round
+trip time, so on high-latency links one channel can't fill the pipe. These
+helpers split a file into byte-range segments and move them concurrently
+over several SFTP channels opened on the session's transport, while still
+producing (or consuming) the data in order. Segments are moved by the
+host's executor (see ssh_executor). The channels are dedicated to the
+transfer and closed when it ends, so the session's pooled channels stay
+free for listings and small requests.
+"""
+
+import queue
+from collections import deque
+
+import ssh_executor
+
+
+class ChannelHandles:
+    """
+    `count` dedicated SFTP channels with one open handle each on the same
+    remote file. Workers check a slot out, use it and put it back, so each
+    channel only ever serves one request at a time. Channels are opened by
+    the first worker that needs them, side by side.
+    """
+
+    def __init__(self, ssh_client, remote_path, mode, count):
+        self.ssh_client = ssh_client
+        self.remote_path = remote_path
+        self.mode = mode
+        self.count = count
+        self.channels = [None] * count
+        self.files = [None] * count
+        self.free = queue.Queue()
+        for i in range(count):
+            self.free.put(i)
+
+    def _file(self, i):
+        if self.files[i] is None:
+            if self.channels[i] is None:
+                self.channels[i] = self.ssh_client.sftp_pool.open_dedicated()
+            f = self.channels[i].open(self.remote_path, self.mode)
+            if 'r' not in self.mode or '+' in self.mode:
+                f.set_pipelined(True)
+            self.files[i] = f
+        return self.files[i]
+
+    def read(self, offset, size, chunk_size):
+        i = self.free.get()
+        try:
+            f = self._file(i)
+            chunks = list(_segments(offset, size, chunk_size))
+            return list(f.readv(chunks))
+        finally:
+            self.free.put(i)
+
+    def write(self, offset, data):
+        i = self.free.get()
+        try:
+            f = self._file(i)
+            f.seek(offset)
+            f.write(data)
+            # Make sure the whole segment has been sent before the
+            # channel is handed to the next worker
+            f.flush()
+        finally:
+            self.free.put(i)
+
+    def close(self):
+        """Close every handle and channel, raising the first deferred write error."""
+        error = None
+        for f in self.files:
+            if f is None:
+                continue
+            try:
+                f.close()
+            except Exception as e:
+                error = error or e
+        for sftp in self.channels:
+            if sftp is None:
+                continue
+            try:
+                sftp.close()
+            except Exception:
+                pass
+        self.files = [None] * self.count
+        self.channels = [None] * self.count
+        if error:
+            raise error
+
+
+def _segments(offset, length, segment_size):
+    end = offset + length
+    pos = offset
+    while pos < end:
+        size = min(segment_size, end - pos)
+        yield pos, size
+        pos += size
+
+
+def parallel_iter_file(ssh_client, remote_path, offset, length, concurrency=4,
+                       segment_size=4 * 1024 * 1024, chunk_size=32768):
+    """
+    Yield `length` bytes of a remote file starting at `offset`, fetching
+    segments concurrently over `concurrency` SFTP channels. Segments are
+    yielded in file order; at most 2 * concurrency segments are buffered.
+    """
+    handles = ChannelHandles(ssh_client, remote_path, 'rb', concurrency)
+    executor = ssh_executor.for_client(ssh_client)
+    pending = deque()
+    try:
+        segments = _segments(offset, length, segment_size)
+        for segment in segments:
+            pending.append(executor.submit(handles.read, segment[0], segment[1], chunk_size))
+            if len(pending) >= concurrency * 2:
+                break
+        while pending:
+            blocks = pending.popleft().result()
+            segment = next(segments, None)
+            if segment is not None:
+                pending.append(executor.submit(handles.read, segment[0], segment[1], chunk_size))
+            for data in blocks:
+                yield data
+    finally:
+        for task in pending:
+            task.cancel()
+        handles.close()
+
+
+class ParallelWriter:
+    """
+    File-like writer that buffers sequential writes into segments and
+    writes them at their offsets concurrently over several SFTP channels.
+    close() waits for every segment to be acknowledged and raises the first
+    error encountered.
+    """
+
+    def __init__(self, ssh_client, remote_path, concurrency=4,
+                 segment_size=4 * 1024 * 1024):
+        self.segment_size = segment_size
+        # Create/truncate the file once; the channels then write into it
+        f = ssh_client.open_write(remote_path)
+        f.close()
+        self.concurrency = concurrency
+        self.handles = ChannelHandles(ssh_client, remote_path, 'r+b', concurrency)
+        self.executor = ssh_executor.for_client(ssh_client)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def _submit(self, data):
+        self.pending.append(self.executor.submit(self.handles.write, self.offset, data))
+        self.offset += len(data)
+        # Bound memory: wait for the oldest segment once too many are in flight
+        while len(self.pending) >= self.concurrency * 2:
+            self.pending.popleft().result()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.segment_size:
+            segment = bytes(self.buffer[:self.segment_size])
+            del self.buffer[:self.segment_size]
+            self._submit(segment)
+
+    def close(self):
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.pending.popleft().result()
+        finally:
+            for task in self.pending:
+                task.cancel()
+            self.pending.clear()
+            self.handles.close()
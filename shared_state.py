@@ -1,30 +1,145 @@
 # shared_state.py
 """
 This module provides a shared state mechanism for the SFTP and terminal servers.
-It uses a simple file-based approach to share authentication data between processes.
+Authentication data is kept in a SQLite database in WAL mode, which several
+processes can read and write safely; SQLite's file locking serializes writers
+across processes, and every commit is atomic.
+
+Lookups are served from an in-memory cache keyed by session. The cache is
+dropped whenever another process commits a change (detected with
+PRAGMA data_version), so reads never return stale entries and never have to
+scan the whole store.
 """
 
 import json
 import os
+import sqlite3
 import time
 import threading
 from pathlib import Path
 
-# Define the path for the shared state file
+# Define the path for the shared state database
 STATE_DIR = Path("./state")
-STATE_FILE = STATE_DIR / "client_db.json"
+STATE_DB = STATE_DIR / "client_db.sqlite3"
+# Previous JSON state file, imported once if present
+LEGACY_STATE_FILE = STATE_DIR / "client_db.json"
+
+FIELDS = ("host_ip", "port", "username", "password", "timestamp")
+
+# Lock for thread safety: the connection and the cache are shared by all
+# threads of this process
+state_lock = threading.Lock()
+
+_conn = None
+_data_version = None
+# key -> client info dict, or None for a key known to be absent
+_cache = {}
 
-# Create state directory if it doesn't exist
-if not STATE_DIR.exists():
+def _connect():
     STATE_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(STATE_DB, timeout=10, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.execute("PRAGMA busy_timeout=10000")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS clients ("
+        " key TEXT PRIMARY KEY,"
+        " host_ip TEXT NOT NULL,"
+        " port INTEGER NOT NULL,"
+        " username TEXT NOT NULL,"
+        " password TEXT NOT NULL,"
+        " timestamp REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS clients_timestamp ON clients (timestamp)")
+    # Link measurements per "ip:port", see transport_tuning
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS transport_profiles ("
+        " host TEXT PRIMARY KEY,"
+        " profile TEXT NOT NULL,"
+        " timestamp REAL NOT NULL)"
+    )
+    return conn
 
-# Initialize the state file if it doesn't exist
-if not STATE_FILE.exists():
-    with open(STATE_FILE, "w") as f:
-        f.write("{}")
+def use_state_dir(path):
+    """
+    Keep the state in another directory from now on, e.g. a temporary one
+    for a benchmark run.
+    """
+    global STATE_DIR, STATE_DB, LEGACY_STATE_FILE, _conn, _data_version
+    with state_lock:
+        STATE_DIR = Path(path)
+        STATE_DB = STATE_DIR / "client_db.sqlite3"
+        LEGACY_STATE_FILE = STATE_DIR / "client_db.json"
+        if _conn is not None:
+            _conn.close()
+        _conn = None
+        _data_version = None
+        _cache.clear()
 
-# Lock for thread safety when accessing the state file
-state_lock = threading.Lock()
+def _import_legacy_state(conn):
+    """
+    Move sessions from the old JSON file into the database, then rename
+    the file so it is only imported once.
+    """
+    if not LEGACY_STATE_FILE.exists():
+        return
+    try:
+        with open(LEGACY_STATE_FILE, "r") as f:
+            state = json.load(f)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for key, info in state.items():
+                conn.execute(
+                    "INSERT OR IGNORE INTO clients (key, host_ip, port, username, password, timestamp)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, info["host_ip"], info["port"], info["username"], info["password"],
+                     info.get("timestamp", time.time()))
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        os.replace(LEGACY_STATE_FILE, LEGACY_STATE_FILE.with_suffix(".json.imported"))
+    except FileNotFoundError:
+        # Another process imported it first
+        pass
+    except Exception as e:
+        print(f"Error importing legacy client state: {str(e)}")
+
+def _db():
+    """
+    Return the connection, dropping the cache if another process changed
+    the database since the last call. Must be called with state_lock held.
+    """
+    global _conn, _data_version
+    if _conn is None:
+        _conn = _connect()
+        _import_legacy_state(_conn)
+    version = _conn.execute("PRAGMA data_version").fetchone()[0]
+    if version != _data_version:
+        _cache.clear()
+        _data_version = version
+    return _conn
+
+def _write(sql, params=()):
+    conn = _db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cursor = conn.execute(sql, params)
+        conn.execute("COMMIT")
+        return cursor.rowcount
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def _lookup(key):
+    conn = _db()
+    if key not in _cache:
+        row = conn.execute(
+            "SELECT host_ip, port, username, password, timestamp FROM clients WHERE key = ?", (key,)
+        ).fetchone()
+        _cache[key] = dict(zip(FIELDS, row)) if row else None
+    return _cache[key]
 
 def save_client(key, host_ip, port, username, password):
     """
@@ -32,23 +147,19 @@ def save_client(key, host_ip, port, username, password):
     """
     with state_lock:
         try:
-            # Read existing state
-            with open(STATE_FILE, "r") as f:
-                state = json.load(f)
-            
-            # Add/update client entry
-            state[key] = {
+            info = {
                 "host_ip": host_ip,
                 "port": port,
                 "username": username,
                 "password": password,
                 "timestamp": time.time()
             }
-            
-            # Write updated state
-            with open(STATE_FILE, "w") as f:
-                json.dump(state, f)
-                
+            _write(
+                "INSERT OR REPLACE INTO clients (key, host_ip, port, username, password, timestamp)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key,) + tuple(info[field] for field in FIELDS)
+            )
+            _cache[key] = info
             return True
         except Exception as e:
             print(f"Error saving client state: {str(e)}")
@@ -60,14 +171,8 @@ def get_client(key):
     """
     with state_lock:
         try:
-            # Read state
-            with open(STATE_FILE, "r") as f:
-                state = json.load(f)
-            
-            # Return client info if it exists
-            if key in state:
-                return state[key]
-            return None
+            info = _lookup(key)
+            return dict(info) if info else None
         except Exception as e:
             print(f"Error getting client state: {str(e)}")
             return None
@@ -78,19 +183,9 @@ def remove_client(key):
     """
     with state_lock:
         try:
-            # Read state
-            with open(STATE_FILE, "r") as f:
-                state = json.load(f)
-            
-            # Remove client if it exists
-            if key in state:
-                del state[key]
-                
-                # Write updated state
-                with open(STATE_FILE, "w") as f:
-                    json.dump(state, f)
-                return True
-            return False
+            removed = _write("DELETE FROM clients WHERE key = ?", (key,))
+            _cache[key] = None
+            return removed > 0
         except Exception as e:
             print(f"Error removing client state: {str(e)}")
             return False
@@ -98,29 +193,14 @@ def remove_client(key):
 def clear_expired_clients(max_age_seconds=3600):
     """
     Clear clients that haven't been active for a while.
+    The sweep only touches expired rows, through the timestamp index.
     """
     with state_lock:
         try:
-            current_time = time.time()
-            # Read state
-            with open(STATE_FILE, "r") as f:
-                state = json.load(f)
-            
-            # Identify expired clients
-            expired_keys = []
-            for key, client_info in state.items():
-                if current_time - client_info.get("timestamp", 0) > max_age_seconds:
-                    expired_keys.append(key)
-            
-            # Remove expired clients
-            for key in expired_keys:
-                del state[key]
-            
-            # Write updated state
-            with open(STATE_FILE, "w") as f:
-                json.dump(state, f)
-                
-            return len(expired_keys)
+            removed = _write("DELETE FROM clients WHERE timestamp < ?", (time.time() - max_age_seconds,))
+            if removed:
+                _cache.clear()
+            return removed
         except Exception as e:
             print(f"Error clearing expired clients: {str(e)}")
             return 0
@@ -131,15 +211,52 @@ def has_client(key):
     """
     with state_lock:
         try:
-            # Read state
-            with open(STATE_FILE, "r") as f:
-                state = json.load(f)
-            
-            return key in state
+            return _lookup(key) is not None
         except Exception as e:
             print(f"Error checking client existence: {str(e)}")
             return False
 
+def save_transport_profile(host, profile):
+    """
+    Save the learned transport profile (a JSON-serializable dict) of a host.
+    """
+    with state_lock:
+        try:
+            _write(
+                "INSERT OR REPLACE INTO transport_profiles (host, profile, timestamp) VALUES (?, ?, ?)",
+                (host, json.dumps(profile), time.time())
+            )
+            return True
+        except Exception as e:
+            print(f"Error saving transport profile: {str(e)}")
+            return False
+
+def get_transport_profile(host):
+    """
+    Get the transport profile of a host, or None if nothing was learned yet.
+    Profiles are read from the database every time, so a connection starts
+    from what any worker process has learned.
+    """
+    with state_lock:
+        try:
+            row = _db().execute("SELECT profile FROM transport_profiles WHERE host = ?", (host,)).fetchone()
+            return json.loads(row[0]) if row else None
+        except Exception as e:
+            print(f"Error getting transport profile: {str(e)}")
+            return None
+
+def get_transport_profiles():
+    """
+    Get every saved transport profile, by host.
+    """
+    with state_lock:
+        try:
+            rows = _db().execute("SELECT host, profile FROM transport_profiles ORDER BY host").fetchall()
+            return {host: json.loads(profile) for host, profile in rows}
+        except Exception as e:
+            print(f"Error getting transport profiles: {str(e)}")
+            return {}
+
 # Run a background thread to periodically clean up expired clients
 def cleanup_thread():
     while True:
@@ -148,4 +265,4 @@ def cleanup_thread():
 
 # Start the cleanup thread
 cleanup_thread = threading.Thread(target=cleanup_thread, daemon=True)
-cleanup_thread.start()
\ No newline at end of file
+cleanup_thread.start()
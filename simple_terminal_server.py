@@ -2,14 +2,23 @@
 # A standalone terminal server that will run on port 8888
 
 import tornado.ioloop
+import tornado.locks
+import tornado.util
 import tornado.web
 import tornado.websocket
-import tornado.gen
 import paramiko
 import os
 import sys
 import logging
 import json
+import socket
+import struct
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import terminal_sessions
+from terminal_sessions import SharedConnection, TerminalSession
 
 # Configure logging
 logging.basicConfig(
@@ -22,6 +31,105 @@ logger = logging.getLogger('terminal_server')
 # Define port - hardcoded to 8888 for compatibility
 SERVER_PORT = 8888
 
+# SSH channel window for shells: a small window bounds how much output is
+# in flight, so backpressure on the WebSocket reaches the remote side quickly
+CHANNEL_WINDOW = 256 * 1024
+
+# SSH handshakes and authentication run on a thread pool so a slow or
+# unreachable host never blocks the IOLoop. CONNECT_TIMEOUT applies to the
+# TCP connect, the SSH banner and authentication each.
+CONNECT_TIMEOUT = 15
+MAX_CONCURRENT_CONNECTS = 16
+
+connect_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CONNECTS, thread_name_prefix="ssh-connect")
+connect_slots = tornado.locks.Semaphore(MAX_CONCURRENT_CONNECTS)
+# One handshake at a time per (host, port, username), so terminals opened
+# together end up on the connection the first one makes. A lock goes away
+# once no connect is using it.
+connect_locks = weakref.WeakValueDictionary()
+
+# Terminals one multiplexed WebSocket may have open at once
+MAX_TERMINALS_PER_SOCKET = 32
+
+def _connect_ssh(host, port, username, password):
+    """Blocking SSH handshake and authentication; runs on connect_executor."""
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        # Connect the socket here: passing timeout to SSHClient.connect would
+        # also cut the handshake short and surface as a confusing auth error
+        sock = socket.create_connection((host, port), timeout=CONNECT_TIMEOUT)
+        ssh.connect(
+            hostname=host,
+            port=port,
+            username=username,
+            password=password,
+            sock=sock,
+            banner_timeout=CONNECT_TIMEOUT,
+            auth_timeout=CONNECT_TIMEOUT
+        )
+        return ssh
+    except Exception:
+        ssh.close()
+        raise
+
+def _open_shell(transport, cols, rows):
+    """Blocking shell setup on an open connection; runs on connect_executor."""
+    # Open a channel for shell with proper terminal type and size
+    channel = transport.open_session(window_size=CHANNEL_WINDOW, timeout=CONNECT_TIMEOUT)
+    try:
+        channel.get_pty(
+            term="xterm-256color",
+            width=cols,
+            height=rows
+        )
+        channel.invoke_shell()
+    except Exception:
+        channel.close()
+        raise
+    channel.settimeout(0.0)
+    return channel
+
+async def open_terminal(host, port, username, password, cols, rows, progress):
+    """
+    Start a shell as a new TerminalSession. The shell is opened on the
+    shared connection for these credentials, connecting first if there is
+    none; progress(message) tells the user what is being waited for.
+    """
+    loop = tornado.ioloop.IOLoop.current()
+    key = (host, port, username)
+    lock = connect_locks.get(key)
+    if lock is None:
+        lock = connect_locks[key] = tornado.locks.Lock()
+    async with lock:
+        connection = terminal_sessions.find_connection(host, port, username, password)
+        if connection is None and terminal_sessions.transport_source is not None:
+            # Reuse a transport that is already logged in, e.g. the SFTP session's
+            borrowed = terminal_sessions.transport_source(host, port, username, password)
+            if borrowed is not None:
+                transport, release = borrowed
+                connection = SharedConnection(transport, key, password, release)
+        if connection is None:
+            try:
+                # With a deadline of now this only succeeds if a slot is free
+                await connect_slots.acquire(timeout=loop.time())
+            except tornado.util.TimeoutError:
+                progress("Waiting for a free connection slot...")
+                await connect_slots.acquire()
+            try:
+                progress(f"Connecting to {host}:{port}...")
+                ssh = await loop.run_in_executor(connect_executor, _connect_ssh, host, port, username, password)
+            finally:
+                connect_slots.release()
+            connection = SharedConnection(ssh.get_transport(), key, password, ssh.close)
+        connection.acquire()
+    try:
+        channel = await loop.run_in_executor(connect_executor, _open_shell, connection.transport, cols, rows)
+    except Exception:
+        connection.release()
+        raise
+    return TerminalSession(connection, channel, host, port, username, password, cols, rows)
+
 # Define static directory
 current_dir = os.path.dirname(os.path.abspath(__file__))
 static_dir = os.path.join(current_dir, "static")
@@ -30,13 +138,21 @@ class TerminalWebSocketHandler(tornado.websocket.WebSocketHandler):
     def check_origin(self, origin):
         # Allow all origins for testing
         return True
+
+    def get_compression_options(self):
+        # Negotiate permessage-deflate; terminal output compresses well
+        return {"compression_level": 6, "mem_level": 8}
         
-    def open(self):
+    async def open(self):
         logger.info("New WebSocket connection opened")
+        self.alive = False
+        self.closed = False
+        self.session = None
         self.host = self.get_query_argument("host", None)
         self.port = int(self.get_query_argument("port", "22"))
         self.username = self.get_query_argument("username", None)
         self.password = self.get_query_argument("password", None)
+        session_id = self.get_query_argument("session", None)
         
         # Terminal dimensions - default to a wider terminal
         self.term_cols = 100
@@ -49,57 +165,59 @@ class TerminalWebSocketHandler(tornado.websocket.WebSocketHandler):
             self.write_message(f"ERROR: {error_msg}")
             self.close()
             return
+        
+        # Reattach to a detached shell instead of opening a new one
+        if session_id:
+            session = terminal_sessions.get(session_id)
+            if session is not None and session.matches(self.host, self.port, self.username, self.password):
+                logger.info(f"Reattaching to terminal session {session.id}")
+                self._attach(session, resumed=True)
+                return
+            self._progress("Previous session has ended, starting a new one.")
             
         logger.info(f"Attempting SSH connection to {self.host}:{self.port} as {self.username}")
         
         try:
-            # Create SSH client
-            self.ssh = paramiko.SSHClient()
-            self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.ssh.connect(
-                hostname=self.host,
-                port=self.port,
-                username=self.username,
-                password=self.password
-            )
+            session = await open_terminal(self.host, self.port, self.username, self.password,
+                                          self.term_cols, self.term_rows, self._progress)
+            if self.closed:
+                # The browser went away while we were connecting
+                session.close()
+                return
             
-            # Open a channel for shell with proper terminal type and size
-            self.channel = self.ssh.invoke_shell(
-                term="xterm-256color",
-                width=self.term_cols,
-                height=self.term_rows
-            )
-            self.channel.settimeout(0.0)
-            self.alive = True
-            
-            logger.info(f"SSH connection established successfully with terminal size {self.term_cols}x{self.term_rows}")
+            logger.info(f"SSH shell opened with terminal size {self.term_cols}x{self.term_rows}")
             self.write_message("Connected to SSH server")
-            
-            # Start reading from SSH
-            tornado.ioloop.IOLoop.current().spawn_callback(self._read_from_ssh)
+            self._attach(session, resumed=False)
         except Exception as e:
-            error_msg = f"Failed to connect: {str(e)}"
+            error_msg = f"Failed to connect: {str(e) or type(e).__name__}"
             logger.error(error_msg)
-            self.write_message(f"ERROR: {error_msg}")
-            self.close()
+            if not self.closed:
+                self.write_message(f"ERROR: {error_msg}")
+                self.close()
 
-    async def _read_from_ssh(self):
-        while self.alive:
-            try:
-                if self.channel.recv_ready():
-                    data = self.channel.recv(4096)  # Larger buffer for better performance
-                    if not data:
-                        logger.info("SSH channel closed")
-                        break
-                    self.write_message(data, binary=True)
-                await tornado.gen.sleep(0.01)
-            except Exception as e:
-                logger.error(f"Error reading from SSH: {str(e)}")
-                break
+    def _attach(self, session, resumed):
+        self.session = session
+        self.alive = True
+        # Tell the page which session it shows so it can reattach after a
+        # reload; on a resumed session the scrollback replay follows
+        self.write_message(json.dumps({"type": "session", "id": session.id, "resumed": resumed}))
+        session.attach(self)
+
+    def session_taken(self):
+        """Another WebSocket attached to our session."""
+        self.session = None
+        self.alive = False
+        self._progress("\r\nSession was opened in another window.")
         self.close()
 
+    def _progress(self, message):
+        try:
+            self.write_message(message + "\r\n")
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
     def on_message(self, message):
-        if not hasattr(self, "channel") or not self.alive:
+        if self.session is None or not self.alive:
             return
             
         try:
@@ -116,9 +234,7 @@ class TerminalWebSocketHandler(tornado.websocket.WebSocketHandler):
                         # Validate dimensions
                         if 10 <= cols <= 500 and 5 <= rows <= 200:
                             logger.info(f"Resizing terminal to {cols}x{rows}")
-                            self.term_cols = cols
-                            self.term_rows = rows
-                            self.channel.resize_pty(width=cols, height=rows)
+                            self.session.resize(cols, rows)
                         return
                 except Exception as e:
                     logger.error(f"Error processing resize: {str(e)}")
@@ -136,9 +252,7 @@ class TerminalWebSocketHandler(tornado.websocket.WebSocketHandler):
                         # Validate dimensions
                         if 10 <= cols <= 500 and 5 <= rows <= 200:
                             logger.info(f"Resizing terminal via VT100 sequence to {cols}x{rows}")
-                            self.term_cols = cols
-                            self.term_rows = rows
-                            self.channel.resize_pty(width=cols, height=rows)
+                            self.session.resize(cols, rows)
                         return
                 except Exception as e:
                     logger.error(f"Error processing resize sequence: {str(e)}")
@@ -147,7 +261,7 @@ class TerminalWebSocketHandler(tornado.websocket.WebSocketHandler):
             # Normal message - forward to SSH
             if isinstance(message, str):
                 message = message.encode("utf-8")
-            self.channel.send(message)
+            self.session.write(message)
             
         except Exception as e:
             logger.error(f"Error sending message: {str(e)}")
@@ -156,14 +270,161 @@ class TerminalWebSocketHandler(tornado.websocket.WebSocketHandler):
 
     def on_close(self):
         logger.info("WebSocket connection closed")
+        self.closed = True
         self.alive = False
+        # The shell stays alive for a while so the page can reattach
+        if self.session is not None:
+            session, self.session = self.session, None
+            session.detach(self)
+
+class MuxChannel:
+    """One terminal of a multiplexed WebSocket, as the client of its TerminalSession."""
+
+    def __init__(self, handler, terminal_id):
+        self.handler = handler
+        self.id = terminal_id
+        self.header = struct.pack(">I", terminal_id)
+        self.session = None
+
+    def write_message(self, data, binary=True):
+        return self.handler.write_message(self.header + data, binary=True)
+
+    def session_taken(self):
+        self.session = None
+        self.handler.channel_closed(self, "Session was opened in another window.")
+
+    def close(self):
+        # The shell has ended
+        self.session = None
+        self.handler.channel_closed(self, "Session ended")
+
+class MuxTerminalWebSocketHandler(TerminalWebSocketHandler):
+    """
+    Several terminals over one WebSocket, each a shell channel on the shared
+    SSH connection. Control messages are JSON text frames:
+
+    client: {"type": "open", "id": n, "cols": c, "rows": r, "session": optional id to reattach}
+            {"type": "resize", "id": n, "cols": c, "rows": r}
+            {"type": "close", "id": n}
+    server: {"type": "opened", "id": n, "session": id, "resumed": bool}
+            {"type": "progress", "id": n, "message": text}
+            {"type": "closed", "id": n, "reason": text}
+
+    Terminal input and output travel in binary frames starting with the
+    terminal id as a 4-byte big-endian integer.
+    """
+
+    def open(self):
+        logger.info("New multiplexed terminal connection opened")
+        self.closed = False
+        self.channels = {}
+        self.host = self.get_query_argument("host", None)
+        self.port = int(self.get_query_argument("port", "22"))
+        self.username = self.get_query_argument("username", None)
+        self.password = self.get_query_argument("password", None)
+        
+        if not all([self.host, self.username, self.password]):
+            error_msg = "Missing connection parameters. Need host, username, and password."
+            logger.error(error_msg)
+            self.write_message(f"ERROR: {error_msg}")
+            self.close()
+
+    def _send_control(self, message):
+        try:
+            self.write_message(json.dumps(message))
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    def channel_closed(self, channel, reason):
+        if self.channels.get(channel.id) is channel:
+            del self.channels[channel.id]
+        self._send_control({"type": "closed", "id": channel.id, "reason": reason})
+
+    async def _open_channel(self, channel, cols, rows, session_id):
+        session = terminal_sessions.get(session_id) if session_id else None
+        resumed = session is not None and session.matches(self.host, self.port, self.username, self.password)
+        if not resumed:
+            def progress(message):
+                self._send_control({"type": "progress", "id": channel.id, "message": message})
+            try:
+                session = await open_terminal(self.host, self.port, self.username, self.password,
+                                              cols, rows, progress)
+            except Exception as e:
+                error_msg = f"Failed to connect: {str(e) or type(e).__name__}"
+                logger.error(error_msg)
+                self.channel_closed(channel, error_msg)
+                return
+            if self.closed or self.channels.get(channel.id) is not channel:
+                # Closed while the shell was being opened
+                session.close()
+                return
+        channel.session = session
+        self._send_control({"type": "opened", "id": channel.id, "session": session.id, "resumed": resumed})
+        session.attach(channel)
+
+    def on_message(self, message):
+        if isinstance(message, bytes):
+            if len(message) < 4:
+                return
+            terminal_id = struct.unpack(">I", message[:4])[0]
+            channel = self.channels.get(terminal_id)
+            if channel is None or channel.session is None:
+                return
+            try:
+                channel.session.write(message[4:])
+            except Exception as e:
+                logger.error(f"Error sending message: {str(e)}")
+                session, channel.session = channel.session, None
+                session.close()
+            return
+
         try:
-            if hasattr(self, "channel"):
-                self.channel.close()
-            if hasattr(self, "ssh"):
-                self.ssh.close()
+            msg_obj = json.loads(message)
+            self._handle_control(msg_obj.get('type'), int(msg_obj.get('id')), msg_obj)
         except Exception as e:
-            logger.error(f"Error during cleanup: {str(e)}")
+            logger.error(f"Error processing control message: {str(e)}")
+
+    def _handle_control(self, msg_type, terminal_id, msg_obj):
+        channel = self.channels.get(terminal_id)
+        
+        if msg_type == 'open':
+            if channel is not None:
+                return
+            channel = MuxChannel(self, terminal_id)
+            if len(self.channels) >= MAX_TERMINALS_PER_SOCKET:
+                self.channel_closed(channel, f"Too many terminals (at most {MAX_TERMINALS_PER_SOCKET})")
+                return
+            self.channels[terminal_id] = channel
+            cols = min(max(int(msg_obj.get('cols', 100)), 10), 500)
+            rows = min(max(int(msg_obj.get('rows', 24)), 5), 200)
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                self._open_channel, channel, cols, rows, msg_obj.get('session'))
+        elif msg_type == 'resize':
+            if channel is None or channel.session is None:
+                return
+            cols = int(msg_obj.get('cols', 100))
+            rows = int(msg_obj.get('rows', 24))
+            if 10 <= cols <= 500 and 5 <= rows <= 200:
+                channel.session.resize(cols, rows)
+        elif msg_type == 'close':
+            if channel is None:
+                return
+            if channel.session is not None:
+                # Closing a tab ends its shell; session.close reports it
+                session, channel.session = channel.session, None
+                session.close()
+            else:
+                self.channel_closed(channel, "Closed")
+
+    def on_close(self):
+        logger.info("Multiplexed terminal connection closed")
+        self.closed = True
+        # The shells stay alive for a while so the page can reattach
+        channels, self.channels = self.channels, {}
+        for channel in channels.values():
+            if channel.session is not None:
+                session, channel.session = channel.session, None
+                session.detach(channel)
 
 class MainHandler(tornado.web.RequestHandler):
     def get(self):
@@ -190,10 +451,17 @@ class MainHandler(tornado.web.RequestHandler):
         </html>
         """)
 
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", metrics.CONTENT_TYPE)
+        self.write(metrics.render())
+
 def make_app():
     return tornado.web.Application([
         (r"/", MainHandler),
         (r"/terminal", TerminalWebSocketHandler),
+        (r"/terminals", MuxTerminalWebSocketHandler),
+        (r"/metrics", MetricsHandler),
         (r"/(.*)", tornado.web.StaticFileHandler, {
             "path": static_dir,
             "default_filename": "index.html"
@@ -202,7 +470,6 @@ def make_app():
 
 def check_port_available(port):
     """Check if the port is available for use"""
-    import socket
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     result = True
     try:
@@ -227,6 +494,7 @@ if __name__ == "__main__":
         app.listen(SERVER_PORT)
         print(f"Terminal Server is running at http://localhost:{SERVER_PORT}")
         print("Press Ctrl+C to stop the server")
+        tornado.ioloop.IOLoop.current().spawn_callback(metrics.watch_event_loop_lag)
         
         # Start the Tornado IO loop
         tornado.ioloop.IOLoop.current().start()
@@ -0,0 +1,257 @@
+# ssh_executor.py
+"""
+Managed executor layer for blocking SSH/SFTP work.
+
+paramiko is synchronous, so every call that touches the network is run on
+a bounded thread pool owned by the remote host instead of on the event loop.
+Each pool limits how many operations may be queued and how long one may
+wait to start; callers get ExecutorBusy instead of piling up work. If the
+HTTP client disconnects, queued work is dropped and running work is asked
+to stop (see cancelled()).
+
+Work that fans out (segments of a parallel transfer, small files of an
+archive) is submitted to the same pool with submit(), so a transfer's
+helpers count against the host's limits like everything else.
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import metrics
+
+# Defaults, overridable through configure()
+settings = {
+    "workers": 8,
+    "max_queue": 32,
+    "max_wait": 30.0,
+    "disconnect_poll": 0.5
+}
+
+_local = threading.local()
+
+
+class ExecutorBusy(Exception):
+    """Raised when a host's pool is saturated or a job waited too long to start."""
+
+
+class ClientDisconnected(Exception):
+    """Raised when the HTTP client went away while its job was pending."""
+
+
+def cancelled():
+    """
+    True if the job running on the current worker thread has been cancelled
+    because its client disconnected. Long running jobs should poll this.
+    """
+    event = getattr(_local, "cancel_event", None)
+    return event is not None and event.is_set()
+
+
+class _Job:
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.cancel_event = threading.Event()
+        self.started = threading.Event()
+
+    def __call__(self):
+        if self.cancel_event.is_set():
+            raise ClientDisconnected("Client disconnected")
+        self.started.set()
+        _local.cancel_event = self.cancel_event
+        try:
+            return self.fn(*self.args, **self.kwargs)
+        finally:
+            _local.cancel_event = None
+
+
+class Task:
+    """
+    A job submitted from blocking code, usually a job already running on
+    the pool that fans out. If no worker has started it by the time its
+    result is needed, or the pool was full when it was submitted, the
+    caller runs it itself: a job waiting for its own helpers never waits
+    for a free worker, so the pool can't deadlock on them.
+    """
+
+    def __init__(self, executor, fn, args, kwargs):
+        self.executor = executor
+        self.job = _Job(fn, args, kwargs)
+        # Helpers stop along with the job that submitted them
+        parent = getattr(_local, "cancel_event", None)
+        if parent is not None:
+            self.job.cancel_event = parent
+        try:
+            self.future = executor._submit(self.job)
+        except ExecutorBusy:
+            self.future = None
+
+    def result(self):
+        if self.future is None or self.executor._drop(self.future):
+            self.future = None
+            return self.job.fn(*self.job.args, **self.job.kwargs)
+        return self.future.result()
+
+    def cancel(self):
+        """Drop the job if it hasn't started, otherwise wait for it to finish."""
+        if self.future is not None and not self.executor._drop(self.future):
+            wait([self.future])
+        self.future = None
+
+
+class HostExecutor:
+    def __init__(self, host, workers, max_queue, max_wait):
+        self.host = host
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"ssh-{host}")
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+
+    def queue_depth(self):
+        """Number of jobs submitted but not yet started."""
+        return max(self.pending - self.running, 0)
+
+    def _submit(self, job):
+        with self.lock:
+            if self.pending >= self.workers + self.max_queue:
+                raise ExecutorBusy(f"Too many pending operations for {self.host}")
+            self.pending += 1
+
+        def run():
+            with self.lock:
+                self.running += 1
+            try:
+                return job()
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.pending -= 1
+
+        try:
+            return self.pool.submit(run)
+        except Exception:
+            with self.lock:
+                self.pending -= 1
+            raise
+
+    def _drop(self, future):
+        # A job cancelled before it starts never runs its own bookkeeping
+        if future.cancel():
+            with self.lock:
+                self.pending -= 1
+            return True
+        return False
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) from blocking code; returns a Task."""
+        return Task(self, fn, args, kwargs)
+
+    async def run(self, fn, *args, request=None, **kwargs):
+        """
+        Run fn(*args, **kwargs) on this host's pool and await the result.
+        If request is given, its connection is watched and the job is
+        cancelled when the client disconnects.
+        """
+        job = _Job(fn, args, kwargs)
+        future = self._submit(job)
+        wrapped = asyncio.wrap_future(future)
+        deadline = time.monotonic() + self.max_wait
+        try:
+            while True:
+                done, _ = await asyncio.wait({wrapped}, timeout=settings["disconnect_poll"])
+                if done:
+                    return wrapped.result()
+                if request is not None and await request.is_disconnected():
+                    job.cancel_event.set()
+                    self._drop(future)
+                    raise ClientDisconnected("Client disconnected")
+                if not job.started.is_set() and time.monotonic() > deadline:
+                    if self._drop(future):
+                        raise ExecutorBusy(f"Timed out waiting for a worker for {self.host}")
+        except asyncio.CancelledError:
+            job.cancel_event.set()
+            self._drop(future)
+            raise
+
+    async def iterate(self, iterator, request=None):
+        """
+        Async generator driving a blocking iterator on this host's pool,
+        one item at a time. The iterator is closed on the pool when the
+        consumer stops early, e.g. because the client disconnected.
+        """
+        # A step may still be running when the consumer is cancelled, so
+        # closing has to wait for it
+        step_lock = threading.Lock()
+
+        def step():
+            with step_lock:
+                return next(iterator, _StopMarker)
+
+        def close():
+            with step_lock:
+                getattr(iterator, "close", lambda: None)()
+
+        try:
+            while True:
+                item = await self.run(step, request=request)
+                if item is _StopMarker:
+                    return
+                yield item
+        finally:
+            await asyncio.shield(asyncio.wrap_future(self.pool.submit(close)))
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+_StopMarker = object()
+
+executors = {}
+_executors_lock = threading.Lock()
+
+
+def configure(**kwargs):
+    settings.update(kwargs)
+
+
+def for_host(ip, port=22):
+    """Return the executor for a host, creating it on first use."""
+    host = f"{ip}:{port}"
+    with _executors_lock:
+        executor = executors.get(host)
+        if executor is None:
+            executor = HostExecutor(host, settings["workers"], settings["max_queue"], settings["max_wait"])
+            executors[host] = executor
+        return executor
+
+
+def for_client(ssh_client):
+    return for_host(ssh_client.ip, ssh_client.port)
+
+
+async def run(ssh_client, fn, *args, request=None, **kwargs):
+    """Shortcut for for_client(ssh_client).run(fn, *args, ...)."""
+    return await for_client(ssh_client).run(fn, *args, request=request, **kwargs)
+
+
+def stats():
+    return {
+        host: {
+            "workers": e.workers,
+            "running": e.running,
+            "queued": e.queue_depth()
+        }
+        for host, e in executors.items()
+    }
+
+
+metrics.CallbackGauge("ssh_executor_queued", "Jobs waiting for a worker thread, per host.",
+                      lambda: {(host,): e.queue_depth() for host, e in list(executors.items())}, ["host"])
+metrics.CallbackGauge("ssh_executor_running", "Jobs running on worker threads, per host.",
+                      lambda: {(host,): e.running for host, e in list(executors.items())}, ["host"])
@@ -0,0 +1,342 @@
+# terminal_sessions.py
+"""
+SSH shell sessions that outlive the WebSocket showing them.
+
+A TerminalSession owns the SSH client and its shell channel. Output is read
+as soon as it arrives (the channel's fileno is registered with the IOLoop),
+recorded into a bounded scrollback buffer and, while a client is attached,
+coalesced into frames and sent to it with backpressure.
+
+When the client goes away the shell keeps running, detached, for a grace
+period. A reconnecting client can attach again and gets the recent
+scrollback replayed in one frame, without a new SSH handshake.
+
+Shells to the same (host, port, username) share one SharedConnection: each
+terminal is its own channel on a single authenticated transport, which is
+released when its last shell goes away.
+"""
+
+import hashlib
+import hmac
+import logging
+import secrets
+import time
+
+import tornado.ioloop
+import tornado.websocket
+
+import metrics
+
+logger = logging.getLogger('terminal_server')
+
+# Output pipeline: channel reads are coalesced into frames of up to
+# FRAME_SIZE bytes, sent at most COALESCE_DELAY apart while output is
+# streaming; the first output after a quiet period is sent immediately.
+FRAME_SIZE = 64 * 1024
+COALESCE_DELAY = 0.005
+# Stop reading the SSH channel while more than HIGH_WATER bytes are queued
+# on the WebSocket and resume below LOW_WATER; the channel's SSH window then
+# makes the remote side wait, so Ctrl-C isn't stuck behind megabytes of output
+HIGH_WATER = 1024 * 1024
+LOW_WATER = 256 * 1024
+
+# Output kept per session for replay on reattach
+SCROLLBACK_SIZE = 256 * 1024
+# How long a detached session is kept before its shell is closed
+DETACH_GRACE = 300
+
+# session id -> TerminalSession
+sessions = {}
+# (host, port, username) -> SharedConnection
+connections = {}
+
+terminal_bytes_in = metrics.terminal_bytes.labels('in')
+terminal_bytes_out = metrics.terminal_bytes.labels('out')
+
+
+def _count_sessions():
+    attached = sum(1 for session in list(sessions.values()) if session.client is not None)
+    return {('attached',): attached, ('detached',): len(sessions) - attached}
+
+
+metrics.CallbackGauge("terminal_sessions", "Terminal shells, attached to a WebSocket or detached.",
+                      _count_sessions, ["state"])
+metrics.CallbackGauge("terminal_connections", "SSH transports shared by terminal shells.",
+                      lambda: len(connections))
+
+# Optional callable(host, port, username, password) returning a
+# (transport, release) pair for an already authenticated transport owned
+# elsewhere, or None. The unified server lends the SFTP sessions' transports.
+transport_source = None
+
+
+class ScrollbackBuffer:
+    """The last `capacity` bytes of a session's output."""
+
+    def __init__(self, capacity=SCROLLBACK_SIZE):
+        self.capacity = capacity
+        self.data = bytearray()
+        self.trimmed = False
+
+    def __len__(self):
+        return len(self.data)
+
+    def append(self, chunk):
+        self.data += chunk
+        excess = len(self.data) - self.capacity
+        if excess > 0:
+            # Deleting from the front of a bytearray doesn't move the rest
+            del self.data[:excess]
+            self.trimmed = True
+
+    def snapshot(self):
+        data = bytes(self.data)
+        if self.trimmed:
+            # Start at a line boundary, not inside a line or escape sequence
+            pos = data.find(b'\n')
+            if pos != -1:
+                data = data[pos + 1:]
+        return data
+
+
+def _digest(password):
+    return hashlib.sha256(password.encode('utf-8')).digest()
+
+
+class SharedConnection:
+    """
+    An authenticated transport shared by the shells of one (host, port,
+    username). close() is called when the last shell has gone away: it
+    closes a connection made for the terminals, or hands a borrowed one back.
+    """
+
+    def __init__(self, transport, key, password, close):
+        self.transport = transport
+        self.key = key
+        self.secret = _digest(password)
+        self.close = close
+        self.users = 0
+        connections[key] = self
+
+    def is_active(self):
+        return self.transport.is_active()
+
+    def acquire(self):
+        self.users += 1
+
+    def release(self):
+        self.users -= 1
+        if self.users > 0:
+            return
+        if connections.get(self.key) is self:
+            del connections[self.key]
+        try:
+            self.close()
+        except Exception as e:
+            logger.error(f"Error closing SSH connection: {str(e)}")
+
+
+def find_connection(host, port, username, password):
+    """A live shared connection opened with these credentials, or None."""
+    connection = connections.get((host, port, username))
+    if connection is None:
+        return None
+    if not connection.is_active():
+        del connections[connection.key]
+        return None
+    if not hmac.compare_digest(connection.secret, _digest(password)):
+        return None
+    return connection
+
+
+class TerminalSession:
+    """
+    A shell channel plus its scrollback. At most one client is attached at
+    a time; the client must provide write_message(data, binary), close()
+    and session_taken(). The session takes over a reference to connection
+    that the caller has already acquired.
+    """
+
+    def __init__(self, connection, channel, host, port, username, password, cols=100, rows=24):
+        self.id = secrets.token_urlsafe(16)
+        self.connection = connection
+        self.channel = channel
+        self.owner = (host, port, username)
+        self.secret = _digest(password)
+        self.cols = cols
+        self.rows = rows
+        self.scrollback = ScrollbackBuffer()
+        self.closed = False
+
+        self.client = None
+        # Bumped on every attach, so callbacks for an old client are ignored
+        self.generation = 0
+        self.grace_timer = None
+
+        self.out_buffer = bytearray()
+        self.flush_timer = None
+        self.last_flush = 0.0
+        self.unsent = 0
+        self.channel_fd = None
+
+        sessions[self.id] = self
+        self._start_reading()
+
+    def matches(self, host, port, username, password):
+        """True if the credentials are the ones the session was opened with."""
+        return self.owner == (host, port, username) and hmac.compare_digest(self.secret, _digest(password))
+
+    def attach(self, client):
+        """Make client the session's output target and replay the scrollback to it."""
+        if self.client is not None and self.client is not client:
+            old, self.client = self.client, None
+            old.session_taken()
+        if self.grace_timer is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.grace_timer)
+            self.grace_timer = None
+
+        self.client = client
+        self.generation += 1
+        self.unsent = 0
+        # Pending output is already in the scrollback
+        self._cancel_flush()
+        self.out_buffer = bytearray()
+        replay = self.scrollback.snapshot()
+        if replay:
+            self._send(replay)
+        self._start_reading()
+
+    def detach(self, client):
+        """The client went away: keep the shell running for DETACH_GRACE seconds."""
+        if self.client is not client or self.closed:
+            return
+        self.client = None
+        self._cancel_flush()
+        self.out_buffer = bytearray()
+        # Keep recording output while nobody is watching
+        self._start_reading()
+        logger.info(f"Terminal session {self.id} detached, keeping it for {DETACH_GRACE}s")
+        self.grace_timer = tornado.ioloop.IOLoop.current().call_later(DETACH_GRACE, self._expire)
+
+    def _expire(self):
+        self.grace_timer = None
+        logger.info(f"Terminal session {self.id} expired")
+        self.close()
+
+    def write(self, data):
+        terminal_bytes_in.inc(len(data))
+        self.channel.send(data)
+
+    def resize(self, cols, rows):
+        self.cols = cols
+        self.rows = rows
+        self.channel.resize_pty(width=cols, height=rows)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        sessions.pop(self.id, None)
+        self._stop_reading()
+        self._cancel_flush()
+        if self.grace_timer is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.grace_timer)
+            self.grace_timer = None
+        try:
+            self.channel.close()
+        except Exception as e:
+            logger.error(f"Error during cleanup: {str(e)}")
+        self.connection.release()
+        client, self.client = self.client, None
+        if client is not None:
+            client.close()
+
+    def _start_reading(self):
+        # Push output as soon as it arrives: the channel's fileno becomes
+        # readable whenever paramiko has buffered data or the channel closed
+        if self.channel_fd is None and not self.closed:
+            self.channel_fd = self.channel.fileno()
+            tornado.ioloop.IOLoop.current().add_handler(
+                self.channel_fd, self._on_ssh_readable, tornado.ioloop.IOLoop.READ)
+
+    def _stop_reading(self):
+        if self.channel_fd is not None:
+            fd, self.channel_fd = self.channel_fd, None
+            tornado.ioloop.IOLoop.current().remove_handler(fd)
+
+    def _on_ssh_readable(self, fd, events):
+        try:
+            read = 0
+            while self.channel.recv_ready() and read < FRAME_SIZE:
+                data = self.channel.recv(FRAME_SIZE - read)
+                if not data:
+                    break
+                read += len(data)
+                terminal_bytes_out.inc(len(data))
+                self.scrollback.append(data)
+                if self.client is not None:
+                    self.out_buffer += data
+            if self.out_buffer:
+                self._schedule_flush()
+            if self.channel.recv_ready() or not (self.channel.closed or self.channel.eof_received):
+                return
+            logger.info("SSH channel closed")
+            self._flush()
+        except Exception as e:
+            logger.error(f"Error reading from SSH: {str(e)}")
+        self.close()
+
+    def _schedule_flush(self):
+        if len(self.out_buffer) >= FRAME_SIZE:
+            self._flush()
+            return
+        wait = self.last_flush + COALESCE_DELAY - time.monotonic()
+        if wait <= 0:
+            self._flush()
+        elif self.flush_timer is None:
+            self.flush_timer = tornado.ioloop.IOLoop.current().call_later(wait, self._flush)
+
+    def _cancel_flush(self):
+        if self.flush_timer is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.flush_timer)
+            self.flush_timer = None
+
+    def _flush(self):
+        self._cancel_flush()
+        if not self.out_buffer or self.client is None:
+            return
+        data = bytes(self.out_buffer)
+        self.out_buffer = bytearray()
+        self.last_flush = time.monotonic()
+        self._send(data)
+
+    def _send(self, data):
+        try:
+            future = self.client.write_message(data, binary=True)
+        except tornado.websocket.WebSocketClosedError:
+            return
+        # The future resolves once the frame has been handed to the socket
+        self.unsent += len(data)
+        generation = self.generation
+        future.add_done_callback(lambda f: self._on_frame_sent(f, len(data), generation))
+        if self.unsent > HIGH_WATER:
+            self._stop_reading()
+
+    def _on_frame_sent(self, future, size, generation):
+        # Retrieve the exception, if any, so it isn't logged as unhandled;
+        # a closed socket is handled by the client's on_close
+        future.exception()
+        if generation != self.generation:
+            return
+        self.unsent -= size
+        if self.unsent <= LOW_WATER:
+            self._start_reading()
+
+
+def get(session_id):
+    return sessions.get(session_id)
+
+
+def close_all():
+    for session in list(sessions.values()):
+        session.close()
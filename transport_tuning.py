@@ -0,0 +1,289 @@
+# transport_tuning.py
+"""
+Per-host SSH transport settings, learned from the traffic to each host.
+
+A fixed window and compression setting suits no link in particular: a
+window below the bandwidth-delay product caps what one channel can move
+on a long link, and compression costs CPU for nothing on a LAN or for
+data that is already compressed.
+
+Each host ("ip:port") has a profile with a smoothed round-trip time,
+timed on single-request SFTP operations the server does anyway (stat,
+open) while no transfer is running, and a smoothed throughput, measured
+end to end by the uncompressed transfers themselves.
+From these it picks:
+
+- the channel window: four times the bandwidth-delay product, as a power
+  of two between min_window and max_window. The throughput is measured
+  through the window in use, so a window that is the bottleneck must still
+  come out larger than itself. It is set as the transport's default, so
+  channels opened from then on get it; channels already open keep theirs;
+- the read-ahead (prefetch) depth of downloads: the same window, so every
+  request in flight fits in it;
+- the maximum packet size: 32 KB on slow links, where small packets keep
+  terminal keystrokes from queueing behind bulk data, 64 KB otherwise, so
+  a 32 KB SFTP read reply fits in one SSH packet instead of two;
+- compression: only on links slower than compress_below, and then only
+  for transfers whose data compresses, judged by the file extension and,
+  for uploads, by compressing a sample of the first chunk.
+
+SSH compression is negotiated for the whole connection, so switching it
+for a transfer renegotiates the keys. That is only done when no other
+transfer is running on the connection and no one else (a terminal) has
+borrowed it; otherwise the setting is kept.
+
+Profiles are saved in the shared state database, so they survive restarts
+and are shared by the worker processes.
+"""
+
+import contextlib
+import os
+import threading
+import time
+import zlib
+
+import metrics
+import shared_state
+
+# Defaults, overridable through configure()
+settings = {
+    "enabled": True,
+    # Window of hosts without measurements, and of every host if disabled
+    "default_window": 8 * 1024 * 1024,
+    "min_window": 8 * 1024 * 1024,
+    "max_window": 32 * 1024 * 1024,
+    # Links slower than this (bytes/s) get compression for compressible data
+    "compress_below": 4 * 1024 * 1024,
+    # Weight of a new measurement in the smoothed values
+    "smoothing": 0.3,
+    # Transfers smaller than this are too short to measure throughput
+    "min_sample_bytes": 1024 * 1024
+}
+
+SMALL_PACKET = 32 * 1024
+LARGE_PACKET = 64 * 1024
+# Bytes of a chunk compressed to judge whether the data compresses
+SAMPLE_SIZE = 64 * 1024
+# Data that compresses to more than this fraction isn't worth compressing
+MAX_COMPRESSED_RATIO = 0.9
+
+COMPRESSED_EXTENSIONS = frozenset((
+    # Archives and compressed streams
+    '7z', 'apk', 'br', 'bz2', 'cab', 'deb', 'gz', 'jar', 'lz', 'lz4', 'lzma', 'rar', 'rpm',
+    'tbz2', 'tgz', 'txz', 'war', 'whl', 'xz', 'z', 'zip', 'zst',
+    # Media
+    'aac', 'avi', 'avif', 'flac', 'gif', 'heic', 'jpeg', 'jpg', 'm4a', 'm4v', 'mkv', 'mov',
+    'mp3', 'mp4', 'mpeg', 'ogg', 'opus', 'png', 'webm', 'webp', 'wmv',
+    # Zip-based documents
+    'docx', 'epub', 'odp', 'ods', 'odt', 'pptx', 'xlsx'
+))
+
+# Host -> the latest decisions made for a transfer by this process
+last_decisions = {}
+
+
+def configure(**kwargs):
+    settings.update(kwargs)
+
+
+class HostProfile:
+    def __init__(self, host, rtt=None, throughput=None, transfers=0):
+        self.host = host
+        self.rtt = rtt  # seconds
+        self.throughput = throughput  # bytes per second
+        self.transfers = transfers
+
+    @classmethod
+    def load(cls, host):
+        saved = shared_state.get_transport_profile(host) or {}
+        return cls(host, saved.get('rtt'), saved.get('throughput'), saved.get('transfers', 0))
+
+    def save(self):
+        shared_state.save_transport_profile(self.host, {
+            'rtt': self.rtt,
+            'throughput': self.throughput,
+            'transfers': self.transfers
+        })
+
+    def _smooth(self, old, new):
+        if old is None:
+            return new
+        return old + settings["smoothing"] * (new - old)
+
+    def observe_rtt(self, seconds):
+        self.rtt = self._smooth(self.rtt, seconds)
+
+    def observe_transfer(self, size, seconds):
+        """Fold a finished transfer into the throughput; False if it was too short to count."""
+        if size < settings["min_sample_bytes"] or seconds <= 0:
+            return False
+        self.throughput = self._smooth(self.throughput, size / seconds)
+        self.transfers += 1
+        return True
+
+    def slow_link(self):
+        return (settings["enabled"] and self.throughput is not None
+                and self.throughput < settings["compress_below"])
+
+    def window(self):
+        if not settings["enabled"] or self.rtt is None or self.throughput is None:
+            return settings["default_window"]
+        target = 4 * self.throughput * self.rtt
+        window = settings["min_window"]
+        while window < target and window < settings["max_window"]:
+            window *= 2
+        return window
+
+    def packet_size(self):
+        if not settings["enabled"] or self.slow_link():
+            return SMALL_PACKET
+        return LARGE_PACKET
+
+    def snapshot(self):
+        return {
+            'host': self.host,
+            'rttMs': round(self.rtt * 1000, 2) if self.rtt is not None else None,
+            'throughput': int(self.throughput) if self.throughput is not None else None,
+            'transfers': self.transfers,
+            'window': self.window(),
+            'packetSize': self.packet_size(),
+            'slowLink': self.slow_link(),
+            'lastDecision': last_decisions.get(self.host)
+        }
+
+
+def profiles():
+    """Every saved host profile with the settings derived from it."""
+    return [HostProfile(host, saved.get('rtt'), saved.get('throughput'), saved.get('transfers', 0)).snapshot()
+            for host, saved in shared_state.get_transport_profiles().items()]
+
+
+def compressible(filename=None, sample=None):
+    """Whether a transfer's data is worth compressing, and why."""
+    if sample:
+        piece = bytes(sample[:SAMPLE_SIZE])
+        ratio = len(zlib.compress(piece, 1)) / len(piece)
+        return ratio <= MAX_COMPRESSED_RATIO, f"sample compresses to {ratio:.0%}"
+    ext = os.path.splitext(filename or '')[1].lower().lstrip('.')
+    if ext in COMPRESSED_EXTENSIONS:
+        return False, f".{ext} files are already compressed"
+    return True, "not a compressed file type"
+
+
+class Tuner:
+    """The tuning of one connection: its host's profile and the transfers running on it."""
+
+    def __init__(self, host):
+        self.profile = HostProfile.load(host)
+        self.transport = None
+        self.compressed = False
+        self.active = 0
+        # Users of the transport other than transfers, e.g. terminals
+        self.borrowers = 0
+        # A round trip was observed since the profile was last saved
+        self.unsaved = False
+        self.lock = threading.Lock()
+
+    def connect_settings(self):
+        """(window, max packet size, compression) to open the transport with."""
+        # Compression is negotiated in the first key exchange, so a slow
+        # link starts with it on; most interactive traffic compresses well
+        return self.profile.window(), self.profile.packet_size(), self.profile.slow_link()
+
+    def attach(self, transport):
+        """Start tuning a connected transport."""
+        self.transport = transport
+        self.compressed = transport.local_compression != 'none'
+
+    @contextlib.contextmanager
+    def round_trip(self):
+        """
+        Time a single request and its reply as a round trip sample. Only
+        samples taken while no transfer is running count, since bulk data
+        queued ahead of the request would be timed too.
+        """
+        started = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            if not settings["enabled"] or self.active:
+                return
+            self.profile.observe_rtt(elapsed)
+            self.unsaved = True
+
+    def lend(self):
+        """Note that someone else uses the transport, so compression is left alone."""
+        with self.lock:
+            self.borrowers += 1
+
+    def give_back(self):
+        with self.lock:
+            self.borrowers -= 1
+
+    def prefetch(self):
+        return self.profile.window()
+
+    def start(self, filename=None, sample=None):
+        """
+        Tune the connection for a transfer. Returns the decisions made; every
+        call must be paired with finish().
+        """
+        with self.lock:
+            self.active += 1
+            others = self.active > 1 or self.borrowers > 0
+        try:
+            return self._tune(filename, sample, others)
+        except Exception:
+            with self.lock:
+                self.active -= 1
+            raise
+
+    def _tune(self, filename, sample, others):
+        window = self.profile.window()
+        self.transport.default_window_size = window
+        self.transport.default_max_packet_size = self.profile.packet_size()
+
+        if not settings["enabled"]:
+            wanted, reason = self.compressed, "tuning disabled"
+        elif self.profile.throughput is None:
+            wanted, reason = self.compressed, "link speed not measured yet"
+        elif not self.profile.slow_link():
+            wanted, reason = False, "fast link"
+        else:
+            wanted, reason = compressible(filename, sample)
+        if wanted != self.compressed:
+            if others:
+                reason += "; kept as is, the connection is in use by others"
+            else:
+                self.transport.use_compression(wanted)
+                self.transport.renegotiate_keys()
+                self.compressed = self.transport.local_compression != 'none'
+                compression_switches.inc()
+
+        decision = {
+            'rttMs': round(self.profile.rtt * 1000, 2) if self.profile.rtt is not None else None,
+            'throughput': int(self.profile.throughput) if self.profile.throughput is not None else None,
+            'window': window,
+            'packetSize': self.profile.packet_size(),
+            'prefetch': self.prefetch(),
+            'compression': self.compressed,
+            'compressionReason': reason
+        }
+        last_decisions[self.profile.host] = decision
+        return decision
+
+    def finish(self, size, seconds):
+        with self.lock:
+            self.active -= 1
+            unsaved, self.unsaved = self.unsaved, False
+        # A compressed transfer moves more data than crosses the link, so
+        # only uncompressed ones measure the link
+        if not settings["enabled"]:
+            return
+        if (not self.compressed and self.profile.observe_transfer(size, seconds)) or unsaved:
+            self.profile.save()
+
+
+compression_switches = metrics.Counter(
+    "sftp_transport_compression_switches_total",
+    "Key renegotiations that switched SSH compression for a transfer.")
@@ -0,0 +1,98 @@
+# unified_server.py
+"""
+SFTP API and terminal server in one process, on one event loop.
+
+The FastAPI app from local_sftp is served by uvicorn; the Tornado terminal
+application is started on the same asyncio loop when the app starts and
+keeps listening on its own port, so the UI is unchanged. Terminals opened
+for a user who is logged in to the SFTP API get their shells on that
+session's already authenticated transport: no second handshake and no
+credentials read back from shared state.
+
+Run with:  uvicorn unified_server:app --host 0.0.0.0 --port 8000
+"""
+
+import asyncio
+import hmac
+
+import uvicorn
+from fastapi.responses import JSONResponse
+
+import simple_terminal_server
+import terminal_sessions
+from local_sftp import app, client_db, config, RetCls
+
+
+def borrow_transport(host, port, username, password):
+    """terminal_sessions.transport_source backed by the SFTP sessions in client_db."""
+    # Login keys are hostIp + username, with the port only if one was typed
+    keys = [f"{host}:{port}{username}"]
+    if int(port) == 22:
+        keys.append(f"{host}{username}")
+    for key in keys:
+        ssh_client = client_db.peek(key)
+        if ssh_client is None or not hmac.compare_digest(ssh_client.password, password):
+            continue
+        ssh_client = client_db.hold(key)
+        if ssh_client is not None:
+            return ssh_client.t, lend_transport(key, ssh_client)
+    return None
+
+
+def lend_transport(key, ssh_client):
+    """Mark the session's transport as shared with a terminal; returns the release callback."""
+    # Transfers leave compression alone while a terminal uses the transport
+    ssh_client.tuner.lend()
+
+    def release():
+        ssh_client.tuner.give_back()
+        client_db.release(key, ssh_client)
+    return release
+
+
+@app.on_event("startup")
+async def start_terminal_server():
+    terminal_sessions.transport_source = borrow_transport
+    app.state.terminal_server = simple_terminal_server.make_app().listen(config["terminal_port"])
+    print(f"Terminal server running at ws://localhost:{config['terminal_port']}/terminals")
+
+
+@app.on_event("shutdown")
+async def stop_terminal_server():
+    app.state.terminal_server.stop()
+    terminal_sessions.close_all()
+
+
+async def terminal_server_accepts(timeout=1.0):
+    """Whether a connection to the terminal port on this host succeeds."""
+    if getattr(app.state, 'terminal_server', None) is None:
+        return False
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection('127.0.0.1', config["terminal_port"]), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
+
+
+@app.get("/ready")
+async def ready():
+    """
+    Readiness check: true once both the API and the terminal server accept
+    connections. Answered with status 503 while the terminal server doesn't.
+    """
+    data = {
+        'sftpPort': config["port"],
+        'terminalPort': config["terminal_port"]
+    }
+    if not await terminal_server_accepts():
+        return JSONResponse(RetCls.ret(False, 'Terminal server is not accepting connections', data),
+                            status_code=503)
+    return RetCls.ret(True, 'Ready', data)
+
+
+if __name__ == "__main__":
+    print("Starting unified SFTP and terminal server...")
+    print(f"Server running at http://localhost:{config['port']}")
+    uvicorn.run(app, host="0.0.0.0", port=config["port"])
@@ -0,0 +1,114 @@
+# upload_sessions.py
+"""
+Bookkeeping for resumable, chunked uploads.
+
+An upload session writes chunks directly at their offsets into a hidden
+temporary file next to the destination. The session remembers which byte
+ranges have been acknowledged so an interrupted client can ask what is
+missing and resume from there; finalizing renames the temporary file into
+place.
+"""
+
+import secrets
+import time
+
+
+class UploadSession:
+    def __init__(self, key, location, filename, size=None, chunk_size=8 * 1024 * 1024):
+        self.id = id_prefix + secrets.token_urlsafe(16)
+        self.key = key
+        self.location = location.rstrip('/')
+        self.filename = filename
+        self.size = size
+        self.chunk_size = chunk_size
+        self.remote_path = self.location + '/' + filename
+        self.temp_path = self.location + '/.' + filename + '.' + self.id + '.part'
+        self.ranges = []  # sorted, merged list of [start, end) byte ranges
+        self.created = time.time()
+        self.updated = self.created
+
+    def add_range(self, start, end):
+        """
+        Record that bytes [start, end) have been written, merging with any
+        overlapping or adjacent ranges.
+        """
+        self.updated = time.time()
+        if end <= start:
+            return
+        merged = []
+        for r_start, r_end in self.ranges:
+            if r_end < start or r_start > end:
+                merged.append([r_start, r_end])
+            else:
+                start = min(start, r_start)
+                end = max(end, r_end)
+        merged.append([start, end])
+        merged.sort()
+        self.ranges = merged
+
+    def received(self):
+        return sum(end - start for start, end in self.ranges)
+
+    def missing(self):
+        """Return the [start, end) ranges not yet written (size must be known)."""
+        if self.size is None:
+            return []
+        gaps = []
+        pos = 0
+        for start, end in self.ranges:
+            if start > pos:
+                gaps.append([pos, start])
+            pos = max(pos, end)
+        if pos < self.size:
+            gaps.append([pos, self.size])
+        return gaps
+
+    def is_complete(self):
+        if self.size is None:
+            # Without a declared size the file is complete if it has no holes
+            return len(self.ranges) <= 1 and (not self.ranges or self.ranges[0][0] == 0)
+        return not self.missing()
+
+    def info(self):
+        return {
+            'uploadId': self.id,
+            'filename': self.filename,
+            'remotePath': self.remote_path,
+            'size': self.size,
+            'chunkSize': self.chunk_size,
+            'received': self.received(),
+            'ranges': self.ranges,
+            'missing': self.missing(),
+            'complete': self.is_complete()
+        }
+
+
+# Active upload sessions, keyed by upload id
+upload_sessions = {}
+
+# Prepended to new upload ids; with several worker processes it names the
+# worker holding the session, so chunk requests can be routed back to it
+id_prefix = ''
+
+
+def create_session(key, location, filename, size=None, chunk_size=8 * 1024 * 1024):
+    session = UploadSession(key, location, filename, size, chunk_size)
+    upload_sessions[session.id] = session
+    return session
+
+
+def get_session(upload_id):
+    return upload_sessions.get(upload_id)
+
+
+def remove_session(upload_id):
+    return upload_sessions.pop(upload_id, None)
+
+
+def expired_sessions(max_age_seconds):
+    """Pop and return the sessions that have been idle for too long."""
+    now = time.time()
+    expired = [s for s in upload_sessions.values() if now - s.updated > max_age_seconds]
+    for session in expired:
+        del upload_sessions[session.id]
+    return expired
@@ -0,0 +1,270 @@
+# worker_pool.py
+"""
+Run the unified server as several worker processes behind a session router.
+
+SSH sessions live in the memory of the process that logged in, so plain
+`uvicorn --workers N` would send a user's requests to workers that don't
+hold their transport (or their upload sessions, listing snapshots and
+terminals). Instead every worker runs unified_server on its own local
+ports, and a small router process owns the public ports and forwards each
+request to the worker that owns its session:
+
+- the session is (host, port, username), taken from the hostIp/username of
+  the upload-params header, the query string or a small JSON body, or from
+  host/port/username of a terminal WebSocket URL
+- the owner is crc32(session) % workers, the same in every process
+- chunk requests of a resumable upload are routed by the worker prefix of
+  their upload id
+- anything else (static files, /ready, ...) goes to worker 0
+
+The router only parses request heads and then splices bytes, so the SSH,
+SFTP and JSON work scales with the number of workers. Client connections
+are switched to Connection: close so each request is routed on its own.
+
+Run with:  python worker_pool.py --workers 4
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import re
+import zlib
+from urllib.parse import urlsplit, parse_qs
+
+API_PORT = 8000
+TERMINAL_PORT = 8888
+# Workers listen on 127.0.0.1, API on WORKER_BASE_PORT + i and terminals on
+# WORKER_BASE_PORT + 100 + i
+WORKER_BASE_PORT = 9000
+
+MAX_HEAD = 64 * 1024
+# JSON bodies up to this size are read to find the session of a request
+MAX_ROUTING_BODY = 64 * 1024
+STARTUP_TIMEOUT = 30
+
+UPLOAD_ID_PATH = re.compile(r'^/uploadSession/w(\d+)\.')
+
+
+def session_key(host_ip, username):
+    """Routing key for a hostIp ("host" or "host:port") and username."""
+    host, _, port = host_ip.partition(':')
+    return f"{host}:{port or 22}/{username}"
+
+
+def owner(key, workers):
+    return zlib.crc32(key.encode()) % workers
+
+
+def run_worker(index, api_port, terminal_port):
+    """Worker process: the unified server on local ports."""
+    import uvicorn
+    import upload_sessions
+    import unified_server
+
+    unified_server.config["terminal_port"] = terminal_port
+    # Each worker owns its part of the download cache
+    unified_server.config["download_cache_path"] = os.path.join(
+        unified_server.config["download_cache_path"], f"w{index}")
+    upload_sessions.id_prefix = f"w{index}."
+    uvicorn.run(unified_server.app, host="127.0.0.1", port=api_port, log_level="warning")
+
+
+class Worker:
+    def __init__(self, index):
+        self.index = index
+        self.api_port = WORKER_BASE_PORT + index
+        self.terminal_port = WORKER_BASE_PORT + 100 + index
+        self.process = None
+
+    def start(self):
+        context = multiprocessing.get_context("spawn")
+        self.process = context.Process(
+            target=run_worker, args=(self.index, self.api_port, self.terminal_port),
+            name=f"worker-{self.index}", daemon=True)
+        self.process.start()
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join(10)
+
+
+async def _port_ready(port):
+    try:
+        _, writer = await asyncio.open_connection("127.0.0.1", port)
+    except OSError:
+        return False
+    writer.close()
+    return True
+
+
+async def wait_until_ready(worker, timeout=STARTUP_TIMEOUT):
+    """Readiness check: wait until the worker accepts connections on both ports."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        if not worker.is_alive():
+            return False
+        if await _port_ready(worker.api_port) and await _port_ready(worker.terminal_port):
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+def _parse_head(head):
+    """Split a request head into (method, target, [(name, value)])."""
+    lines = head.decode('latin-1').split('\r\n')
+    method, target, _ = lines[0].split(' ', 2)
+    headers = []
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers.append((name.strip(), value.strip()))
+    return method, target, headers
+
+
+def _build_head(method, target, headers):
+    lines = [f"{method} {target} HTTP/1.1"] + [f"{name}: {value}" for name, value in headers]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+class SessionRouter:
+    def __init__(self, workers):
+        self.workers = workers
+
+    def route(self, target, headers, body, terminal):
+        """Index of the worker for a request, from what its head (and small body) say."""
+        fields = {name.lower(): value for name, value in headers}
+        url = urlsplit(target)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        key = None
+        if terminal:
+            if query.get('host') and query.get('username'):
+                key = session_key(f"{query['host']}:{query.get('port', '22')}", query['username'])
+        else:
+            match = UPLOAD_ID_PATH.match(url.path)
+            if match and int(match.group(1)) < len(self.workers):
+                return int(match.group(1))
+            params = query
+            if 'upload-params' in fields:
+                try:
+                    params = json.loads(fields['upload-params'])
+                except ValueError:
+                    pass
+            elif body:
+                try:
+                    params = json.loads(body)
+                except ValueError:
+                    pass
+            if isinstance(params, dict) and params.get('hostIp') and params.get('username'):
+                key = session_key(str(params['hostIp']), str(params['username']))
+        if key is None:
+            return 0
+        return owner(key, len(self.workers))
+
+    async def handle(self, reader, writer, terminal):
+        upstream = None
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+            method, target, headers = _parse_head(head[:-4])
+
+            # Read a small JSON body up front to find its session
+            body = b''
+            fields = {name.lower(): value for name, value in headers}
+            length = int(fields.get('content-length', 0) or 0)
+            if ('json' in fields.get('content-type', '') and 0 < length <= MAX_ROUTING_BODY
+                    and 'upload-params' not in fields):
+                body = await reader.readexactly(length)
+
+            worker = self.workers[self.route(target, headers, body, terminal)]
+            if 'upgrade' not in fields:
+                # One request per client connection, so the next one is routed again
+                headers = [(name, value) for name, value in headers
+                           if name.lower() not in ('connection', 'keep-alive')]
+                headers.append(('Connection', 'close'))
+
+            port = worker.terminal_port if terminal else worker.api_port
+            try:
+                up_reader, upstream = await asyncio.open_connection("127.0.0.1", port)
+            except OSError:
+                writer.write(b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                await writer.drain()
+                return
+            upstream.write(_build_head(method, target, headers) + body)
+
+            to_worker = asyncio.ensure_future(self._pipe(reader, upstream))
+            try:
+                await self._pipe(up_reader, writer)
+            finally:
+                to_worker.cancel()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        except Exception as e:
+            print(f"Error routing request: {str(e)}")
+        finally:
+            if upstream is not None:
+                upstream.close()
+            writer.close()
+
+    async def _pipe(self, reader, writer):
+        while True:
+            data = await reader.read(256 * 1024)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        if writer.can_write_eof():
+            try:
+                writer.write_eof()
+            except OSError:
+                pass
+
+
+async def serve(workers_count, api_port=API_PORT, terminal_port=TERMINAL_PORT):
+    workers = [Worker(i) for i in range(workers_count)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        if not await wait_until_ready(worker):
+            for w in workers:
+                w.stop()
+            raise RuntimeError(f"Worker {worker.index} failed to start")
+
+    router = SessionRouter(workers)
+    api_server = await asyncio.start_server(
+        lambda r, w: router.handle(r, w, terminal=False), "0.0.0.0", api_port, limit=MAX_HEAD)
+    terminal_server = await asyncio.start_server(
+        lambda r, w: router.handle(r, w, terminal=True), "0.0.0.0", terminal_port, limit=MAX_HEAD)
+    print(f"Session router on ports {api_port} and {terminal_port} with {workers_count} workers")
+
+    try:
+        # Restart workers that die; their sessions reconnect from shared_state
+        while True:
+            await asyncio.sleep(2)
+            for worker in workers:
+                if not worker.is_alive():
+                    print(f"WARNING: worker {worker.index} has stopped unexpectedly. Restarting...")
+                    worker.start()
+                    await wait_until_ready(worker)
+    finally:
+        api_server.close()
+        terminal_server.close()
+        for worker in workers:
+            worker.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SFTP and terminal server with several worker processes")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--port", type=int, default=API_PORT)
+    parser.add_argument("--terminal-port", type=int, default=TERMINAL_PORT)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.workers, args.port, args.terminal_port))
+    except KeyboardInterrupt:
+        print("Servers stopped.")